@@ -0,0 +1,398 @@
+from collision_bsp import CollisionBSP, PLANE, BACK_CHILD, FRONT_CHILD, BSP2D_REFERENCE_COUNT, FIRST_BSP2D_REFERENCE, BSP2D_NODE, SURFACE_FLAGS, MATERIAL, NULL_INDEX, flagged, unflag
+from surface_flags import surface_normals
+from tag_cache import load_bsp_arrays
+from scipy.spatial import cKDTree
+from time import perf_counter
+import numpy as np
+import argparse
+import json
+
+# Structural diff of two versions of a BSP tag. Collision vertices, planes,
+# surfaces and render vertices are aligned by position and attributes rather
+# than by index, since small edits renumber everything. Elements identical in
+# both versions are paired by hashing their values; the rest are matched to
+# the nearest compatible element of the other version found through a k-d
+# tree, keeping pairs which are each other's best match. bsp3d subtrees are
+# then compared by hashing them bottom up over the matched plane and surface
+# ids, so identical subtrees hash the same in both versions wherever they
+# ended up in the node array.
+
+# Points within this distance can match
+DEFAULT_RADIUS = 0.01
+# Nearest neighbours considered per element, enough for render vertices
+# duplicated at one position with different normals or UVs
+NEIGHBOURS = 16
+# Largest squared distance between matched normals, and render vertex UVs
+NORMAL_TOLERANCE = 0.001
+UV_TOLERANCE = 0.001
+# Lowest changed subtrees listed in text output
+SHOWN_SUBTREES = 20
+
+# Nearest point for each query point within radius whose key matches and
+# whose features are within feature_tolerance (squared distance), or -1
+def nearest_compatible(query_points, points, radius, query_keys=None, keys=None, query_features=None, features=None, feature_tolerance=0.0):
+    if len(points) == 0 or len(query_points) == 0:
+        return np.full(len(query_points), -1, dtype=np.int64)
+    k = min(NEIGHBOURS, len(points))
+    dists, indices = cKDTree(points).query(query_points, k=k, distance_upper_bound=radius)
+    dists = dists.reshape(len(query_points), k)
+    indices = indices.reshape(len(query_points), k)
+    valid = indices < len(points)
+    indices = np.where(valid, indices, 0)
+    if keys is not None:
+        valid &= keys[indices] == query_keys[:, None]
+    if features is not None:
+        valid &= np.sum((features[indices] - query_features[:, None, :]) ** 2, axis=2) < feature_tolerance
+    dists = np.where(valid, dists, np.inf)
+    best = np.argmin(dists, axis=1)
+    rows = np.arange(len(query_points))
+    return np.where(np.isfinite(dists[rows, best]), indices[rows, best], -1)
+
+# Hash of each row of a float array, from the bits of its values
+def row_hashes(rows):
+    # adding zero turns -0.0 into 0.0, so equal values have equal bits
+    bits = np.ascontiguousarray(rows + 0.0, dtype=np.float64).view(np.uint64)
+    hashes = np.zeros(len(rows), dtype=np.uint64)
+    for column in bits.T:
+        hashes = mix(hashes ^ column)
+    return hashes
+
+# Group id of each row, shared by identical rows, along with the order
+# sorting rows by group and where each group starts in it. Rows are grouped
+# by hash, falling back to sorting the rows themselves if two different rows
+# ever share one.
+def row_groups(rows):
+    hashes = row_hashes(rows)
+    order = np.argsort(hashes, kind="stable")
+    sorted_rows = rows[order]
+    is_start = np.ones(len(rows), dtype=bool)
+    is_start[1:] = hashes[order][1:] != hashes[order][:-1]
+    if np.any(np.any(sorted_rows[1:] != sorted_rows[:-1], axis=1) & ~is_start[1:]):
+        order = np.lexsort(rows.T[::-1])
+        sorted_rows = rows[order]
+        is_start[1:] = np.any(sorted_rows[1:] != sorted_rows[:-1], axis=1)
+    groups = np.empty(len(rows), dtype=np.int64)
+    groups[order] = np.cumsum(is_start) - 1
+    return groups, order, np.flatnonzero(is_start)
+
+# Mutual best matches as old to new and new to old index arrays, -1 where
+# an element has no counterpart. Identical elements are matched as one group,
+# since ties between them would leave most unmatched, and their occurrences
+# are then paired up in order. Groups identical in both versions, usually
+# nearly all of them, are paired by hash; only the rest, and occurrences left
+# over from pairing, are searched for in k-d trees.
+def match_points(old_points, new_points, radius, old_keys=None, new_keys=None, old_features=None, new_features=None, feature_tolerance=0.0):
+    def with_attributes(points, keys, features):
+        return np.concatenate([points] + ([keys[:, None].astype(np.float64)] if keys is not None else []) + ([features] if features is not None else []), axis=1)
+    old_rows = with_attributes(old_points, old_keys, old_features)
+    new_rows = with_attributes(new_points, new_keys, new_features)
+    old_groups, old_order, old_starts = row_groups(old_rows)
+    new_groups, new_order, new_starts = row_groups(new_rows)
+    old_firsts = old_order[old_starts]
+    new_firsts = new_order[new_starts]
+
+    # groups with the same rows in both versions
+    joint_groups = row_groups(np.concatenate([old_rows[old_firsts], new_rows[new_firsts]]))[0]
+    new_group_of_joint = np.full(len(old_firsts) + len(new_firsts), -1, dtype=np.int64)
+    new_group_of_joint[joint_groups[len(old_firsts):]] = np.arange(len(new_firsts))
+    group_matches = new_group_of_joint[joint_groups[:len(old_firsts)]]
+
+    # mutual nearest matches between subsets of old and new elements, as
+    # positions in those subsets
+    def mutual_matches(old_subset, new_subset):
+        def subset(values, indices):
+            return None if values is None else values[indices]
+        old_to_new = nearest_compatible(old_points[old_subset], new_points[new_subset], radius, subset(old_keys, old_subset), subset(new_keys, new_subset), subset(old_features, old_subset), subset(new_features, new_subset), feature_tolerance)
+        new_to_old = nearest_compatible(new_points[new_subset], old_points[old_subset], radius, subset(new_keys, new_subset), subset(old_keys, old_subset), subset(new_features, new_subset), subset(old_features, old_subset), feature_tolerance)
+        found = np.flatnonzero(old_to_new != -1)
+        mutual = found[new_to_old[old_to_new[found]] == found]
+        return mutual, old_to_new[mutual]
+
+    old_rest = np.flatnonzero(group_matches == -1)
+    new_unmatched = np.ones(len(new_firsts), dtype=bool)
+    new_unmatched[group_matches[group_matches != -1]] = False
+    new_rest = np.flatnonzero(new_unmatched)
+    old_found, new_found = mutual_matches(old_firsts[old_rest], new_firsts[new_rest])
+    group_matches[old_rest[old_found]] = new_rest[new_found]
+
+    # the nth occurrence in an old group pairs with the nth in its new group
+    old_ranks = np.empty(len(old_points), dtype=np.int64)
+    old_ranks[old_order] = np.arange(len(old_points)) - np.repeat(old_starts, np.diff(np.append(old_starts, len(old_points))))
+    new_counts = np.diff(np.append(new_starts, len(new_points)))
+    partner_groups = group_matches[old_groups]
+    paired = partner_groups != -1
+    paired[paired] = old_ranks[paired] < new_counts[partner_groups[paired]]
+    matched_old_to_new = np.full(len(old_points), -1, dtype=np.int64)
+    matched_new_to_old = np.full(len(new_points), -1, dtype=np.int64)
+    matched_old_to_new[paired] = new_order[new_starts[partner_groups[paired]] + old_ranks[paired]]
+    matched_new_to_old[matched_old_to_new[paired]] = np.flatnonzero(paired)
+
+    # occurrences left over where a group has more of them in one version
+    # than its partner, such as one of two coincident vertices having moved,
+    # are matched one by one to what's left of the other version
+    old_left = np.flatnonzero(matched_old_to_new == -1)
+    new_left = np.flatnonzero(matched_new_to_old == -1)
+    old_found, new_found = mutual_matches(old_left, new_left)
+    matched_old_to_new[old_left[old_found]] = new_left[new_found]
+    matched_new_to_old[new_left[new_found]] = old_left[old_found]
+    return matched_old_to_new, matched_new_to_old
+
+def match_stats(old_points, new_points, old_to_new, new_to_old):
+    matched = np.flatnonzero(old_to_new != -1)
+    distances = np.linalg.norm(new_points[old_to_new[matched]] - old_points[matched], axis=1)
+    return {
+        "old": len(old_points),
+        "new": len(new_points),
+        "matched": len(matched),
+        "moved": int(np.sum(distances > 0.0)),
+        "max_move": float(distances.max(initial=0.0)),
+        "removed": int(np.sum(old_to_new == -1)),
+        "added": int(np.sum(new_to_old == -1)),
+    }
+
+# Ids shared by matched elements of both versions: new elements take their
+# old partner's id, and unmatched ones get fresh ids
+def shared_ids(old_ids, new_to_old):
+    fresh = old_ids.max(initial=-1) + np.cumsum(new_to_old == -1)
+    return np.where(new_to_old != -1, old_ids[new_to_old], fresh)
+
+# splitmix64's finalizer, mixing uint64 hashes
+def mix(values):
+    values = np.asarray(values).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+NULL_HASH = mix(0x6E756C6C)
+LEAF_SALT = np.uint64(0x6C656166)
+FRONT_SALT = np.uint64(0x66726F6E74)
+
+# (leaf, surface) pairs for every surface in each leaf's bsp2d trees. The
+# trees are walked a level at a time, carrying each reference's leaf along.
+def leaf_surface_pairs(collision_bsp):
+    leaves = collision_bsp.leaves.astype(np.int64)
+    counts = leaves[:, BSP2D_REFERENCE_COUNT]
+    reference_leaves = np.repeat(np.arange(len(leaves)), counts)
+    references = np.repeat(leaves[:, FIRST_BSP2D_REFERENCE] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    children = collision_bsp.bsp2d_node_children.astype(np.int64)
+    refs = collision_bsp.bsp2d_references[references, BSP2D_NODE].astype(np.int64)
+    pair_leaves, pair_surfaces = [], []
+    for _level in range(len(children) + 1):
+        is_surface = flagged(refs) & (refs != NULL_INDEX)
+        is_node = ~flagged(refs)
+        pair_leaves.append(reference_leaves[is_surface])
+        pair_surfaces.append(unflag(refs[is_surface]))
+        reference_leaves = np.repeat(reference_leaves[is_node], 2)
+        refs = children[refs[is_node]].ravel()
+        if len(refs) == 0:
+            return np.concatenate(pair_leaves), np.concatenate(pair_surfaces)
+    raise Exception("bsp2d trees have a cycle")
+
+# Depth of each bsp3d node from the root, the longest path where subtrees
+# are shared, or -1 if unreachable
+def node_depths(bsp3d_nodes):
+    depths = np.full(len(bsp3d_nodes), -1, dtype=np.int64)
+    frontier = np.array([0] if len(bsp3d_nodes) > 0 else [], dtype=np.int64)
+    for depth in range(len(bsp3d_nodes) + 1):
+        if len(frontier) == 0:
+            return depths
+        depths[frontier] = depth
+        children = bsp3d_nodes[frontier][:, [BACK_CHILD, FRONT_CHILD]].ravel()
+        frontier = np.sort(children[(children != NULL_INDEX) & ~flagged(children)])
+        frontier = frontier[np.concatenate([[True], frontier[1:] != frontier[:-1]])] if len(frontier) > 0 else frontier
+    raise Exception("bsp3d tree has a cycle")
+
+# Hash of every bsp3d node's subtree from its plane and its children's
+# hashes, computed a level at a time from the deepest up. Leaves hash the
+# set of their surfaces. Unreachable nodes hash to 0.
+def subtree_hashes(collision_bsp, plane_ids, surface_ids):
+    pair_leaves, pair_surfaces = leaf_surface_pairs(collision_bsp)
+    leaf_sums = np.zeros(len(collision_bsp.leaves), dtype=np.uint64)
+    np.add.at(leaf_sums, pair_leaves, mix(surface_ids[pair_surfaces]))
+    leaf_hashes = mix(leaf_sums ^ LEAF_SALT)
+
+    bsp3d_nodes = collision_bsp.bsp3d_nodes.astype(np.int64)
+    depths = node_depths(bsp3d_nodes)
+    node_hashes = np.zeros(len(bsp3d_nodes), dtype=np.uint64)
+    node_planes = bsp3d_nodes[:, PLANE]
+    plane_hashes = mix(plane_ids[unflag(node_planes)] * 2 + flagged(node_planes))
+
+    def child_hashes(children):
+        hashes = np.full(len(children), NULL_HASH, dtype=np.uint64)
+        is_leaf = (children != NULL_INDEX) & flagged(children)
+        is_node = (children != NULL_INDEX) & ~is_leaf
+        hashes[is_leaf] = leaf_hashes[unflag(children[is_leaf])]
+        hashes[is_node] = node_hashes[children[is_node]]
+        return hashes
+
+    order = np.argsort(-depths, kind="stable")
+    level_starts = np.flatnonzero(np.diff(depths[order], prepend=np.inf))
+    for start, end in zip(level_starts, np.append(level_starts[1:], len(order))):
+        level = order[start:end]
+        if depths[level[0]] < 0:
+            continue
+        back_hashes = child_hashes(bsp3d_nodes[level, BACK_CHILD])
+        front_hashes = child_hashes(bsp3d_nodes[level, FRONT_CHILD])
+        node_hashes[level] = mix(mix(plane_hashes[level] + back_hashes) ^ (front_hashes + FRONT_SALT))
+    return node_hashes, depths
+
+# Nodes whose subtree has no identical subtree in the other version, and of
+# those, the lowest: ones with no changed node below them
+def changed_subtrees(bsp3d_nodes, hashes, depths, other_hashes, other_depths):
+    reachable = depths >= 0
+    changed = reachable & ~np.isin(hashes, other_hashes[other_depths >= 0])
+    children = bsp3d_nodes[:, [BACK_CHILD, FRONT_CHILD]].astype(np.int64)
+    is_node = (children != NULL_INDEX) & ~flagged(children)
+    changed_children = np.zeros(children.shape, dtype=bool)
+    changed_children[is_node] = changed[children[is_node]]
+    lowest = np.flatnonzero(changed & ~changed_children.any(axis=1))
+    return changed, lowest
+
+def surface_centroids(collision_bsp):
+    pair_surfaces, pair_vertices = collision_bsp.surface_vertex_pairs()
+    counts = np.bincount(pair_surfaces, minlength=len(collision_bsp.surfaces))
+    vertices = collision_bsp.vertices[pair_vertices].astype(np.float64)
+    sums = np.stack([np.bincount(pair_surfaces, vertices[:, axis], minlength=len(counts)) for axis in range(3)], axis=1)
+    return sums / np.maximum(counts, 1)[:, None], counts
+
+# Render vertices with each one's shader id and lightmap page. Shader paths
+# are interned into ids shared by both versions.
+def render_vertices(bsp_arrays, shader_ids):
+    vert_counts = bsp_arrays["material_vert_counts"]
+    material_shaders = np.array([shader_ids.setdefault(shader, len(shader_ids)) for shader in bsp_arrays["material_shaders"].tolist()], dtype=np.int64)
+    material_pages = bsp_arrays["lightmap_bitmap_indices"][bsp_arrays["material_lightmaps"]]
+    verts = bsp_arrays["rendered_verts"]
+    features = np.concatenate([verts["normal"], verts["tex_uv"]], axis=1).astype(np.float64)
+    return verts["position"].astype(np.float64), features, np.repeat(material_shaders, vert_counts), np.repeat(material_pages, vert_counts)
+
+def diff_collision_bsps(old_bsp, new_bsp, radius=DEFAULT_RADIUS):
+    result = {}
+
+    old_vertices = old_bsp.vertices.astype(np.float64)
+    new_vertices = new_bsp.vertices.astype(np.float64)
+    result["collision_vertices"] = match_stats(old_vertices, new_vertices, *match_points(old_vertices, new_vertices, radius))
+
+    old_planes = old_bsp.planes.astype(np.float64)
+    new_planes = new_bsp.planes.astype(np.float64)
+    old_to_new_planes, new_to_old_planes = match_points(old_planes, new_planes, radius)
+    result["planes"] = match_stats(old_planes, new_planes, old_to_new_planes, new_to_old_planes)
+
+    # surfaces match by centroid, with the same facing and vertex count
+    old_centroids, old_counts = surface_centroids(old_bsp)
+    new_centroids, new_counts = surface_centroids(new_bsp)
+    old_to_new_surfaces, new_to_old_surfaces = match_points(old_centroids, new_centroids, radius, old_counts, new_counts, surface_normals(old_bsp), surface_normals(new_bsp), NORMAL_TOLERANCE)
+    surface_stats = match_stats(old_centroids, new_centroids, old_to_new_surfaces, new_to_old_surfaces)
+    matched = np.flatnonzero(old_to_new_surfaces != -1)
+    old_rows = old_bsp.surfaces[matched]
+    new_rows = new_bsp.surfaces[old_to_new_surfaces[matched]]
+    surface_stats["flags_changed"] = int(np.sum(old_rows[:, SURFACE_FLAGS] != new_rows[:, SURFACE_FLAGS]))
+    surface_stats["material_changed"] = int(np.sum(old_rows[:, MATERIAL] != new_rows[:, MATERIAL]))
+    result["surfaces"] = surface_stats
+
+    # identical planes are interchangeable, so they share an id
+    old_plane_ids = row_groups(old_planes)[0]
+    new_plane_ids = shared_ids(old_plane_ids, new_to_old_planes)
+    old_surface_ids = np.arange(len(old_centroids))
+    new_surface_ids = shared_ids(old_surface_ids, new_to_old_surfaces)
+    old_hashes, old_depths = subtree_hashes(old_bsp, old_plane_ids, old_surface_ids)
+    new_hashes, new_depths = subtree_hashes(new_bsp, new_plane_ids, new_surface_ids)
+    old_changed, old_lowest = changed_subtrees(old_bsp.bsp3d_nodes, old_hashes, old_depths, new_hashes, new_depths)
+    new_changed, new_lowest = changed_subtrees(new_bsp.bsp3d_nodes, new_hashes, new_depths, old_hashes, old_depths)
+    result["bsp3d"] = {
+        "old_nodes": int(np.sum(old_depths >= 0)),
+        "new_nodes": int(np.sum(new_depths >= 0)),
+        "old_changed": int(old_changed.sum()),
+        "new_changed": int(new_changed.sum()),
+        "identical": bool(len(old_hashes) > 0 and len(new_hashes) > 0 and old_hashes[0] == new_hashes[0]),
+        # the lowest changed subtrees of the new version, shallowest first
+        "lowest_changed": [
+            {"node": int(node), "plane": int(unflag(new_bsp.bsp3d_nodes[node, PLANE])), "depth": int(new_depths[node])}
+            for node in new_lowest[np.argsort(new_depths[new_lowest], kind="stable")].tolist()
+        ],
+    }
+    return result
+
+def diff_render_vertices(old_arrays, new_arrays, radius=DEFAULT_RADIUS):
+    result = {}
+    shader_ids = {}
+    old_positions, old_features, old_shaders, old_pages = render_vertices(old_arrays, shader_ids)
+    new_positions, new_features, new_shaders, new_pages = render_vertices(new_arrays, shader_ids)
+    # normals and UVs are compared together, so the tolerances add
+    old_to_new_verts, new_to_old_verts = match_points(old_positions, new_positions, radius, old_shaders, new_shaders, old_features, new_features, NORMAL_TOLERANCE + UV_TOLERANCE)
+    result["render_vertices"] = match_stats(old_positions, new_positions, old_to_new_verts, new_to_old_verts)
+
+    matched = np.flatnonzero(old_to_new_verts != -1)
+    page_pairs = np.stack([old_pages[matched], new_pages[old_to_new_verts[matched]]], axis=1)
+    page_pairs = page_pairs[page_pairs[:, 0] != page_pairs[:, 1]]
+    transitions, counts = np.unique(page_pairs, axis=0, return_counts=True) if len(page_pairs) > 0 else (np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.int64))
+    result["lightmap_pages"] = {
+        "moved_verts": len(page_pairs),
+        "transitions": [{"old_page": int(old), "new_page": int(new), "verts": int(count)} for (old, new), count in zip(transitions.tolist(), counts.tolist())],
+    }
+    return result
+
+def has_collision_bsp(bsp_arrays):
+    return "collision_bsp3d_nodes" in bsp_arrays
+
+# Diff of two BSP tags' arrays from load_bsp_arrays. Collision BSPs are only
+# compared when both tags have one.
+def diff_bsps(old_arrays, new_arrays, radius=DEFAULT_RADIUS):
+    result = {"collision_bsp": "both" if has_collision_bsp(old_arrays) and has_collision_bsp(new_arrays) else "old" if has_collision_bsp(old_arrays) else "new" if has_collision_bsp(new_arrays) else "neither"}
+    if result["collision_bsp"] == "both":
+        result.update(diff_collision_bsps(CollisionBSP.from_bsp_arrays(old_arrays), CollisionBSP.from_bsp_arrays(new_arrays), radius))
+    result.update(diff_render_vertices(old_arrays, new_arrays, radius))
+    return result
+
+def format_matches(name, stats):
+    return "{}: {} old, {} new; {} matched ({} moved, up to {:.3g}), {} removed, {} added".format(
+        name, stats["old"], stats["new"], stats["matched"], stats["moved"], stats["max_move"], stats["removed"], stats["added"])
+
+def format_diff(result):
+    if result["collision_bsp"] != "both":
+        lines = ["Collision BSP: " + {"old": "only in the old version", "new": "only in the new version", "neither": "in neither version"}[result["collision_bsp"]]]
+    else:
+        lines = format_collision_diff(result)
+    pages = result["lightmap_pages"]
+    lines.append(format_matches("Render vertices", result["render_vertices"]))
+    lines.append("Lightmap pages: {} matched render vertices changed page".format(pages["moved_verts"]))
+    for transition in pages["transitions"]:
+        lines.append("  page {} -> {}: {} verts".format(transition["old_page"], transition["new_page"], transition["verts"]))
+    return "\n".join(lines)
+
+def format_collision_diff(result):
+    surfaces = result["surfaces"]
+    bsp3d = result["bsp3d"]
+    lines = [
+        format_matches("Collision vertices", result["collision_vertices"]),
+        format_matches("Planes", result["planes"]),
+        format_matches("Surfaces", surfaces) + "; {} with changed flags, {} with changed material".format(surfaces["flags_changed"], surfaces["material_changed"]),
+    ]
+    if bsp3d["identical"]:
+        lines.append("bsp3d tree: identical")
+    else:
+        lines.append("bsp3d tree: {} of {} old and {} of {} new nodes have no identical subtree in the other version; lowest changed subtrees:".format(
+            bsp3d["old_changed"], bsp3d["old_nodes"], bsp3d["new_changed"], bsp3d["new_nodes"]))
+        for subtree in bsp3d["lowest_changed"][:SHOWN_SUBTREES]:
+            lines.append("  bsp3d_node_{} (plane {}, depth {})".format(subtree["node"], subtree["plane"], subtree["depth"]))
+        if len(bsp3d["lowest_changed"]) > SHOWN_SUBTREES:
+            lines.append("  ... {} more".format(len(bsp3d["lowest_changed"]) - SHOWN_SUBTREES))
+    return lines
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show what changed between two versions of a BSP tag, matching geometry by position rather than index")
+    parser.add_argument("old_bsp", help="Path to the original BSP file")
+    parser.add_argument("new_bsp", help="Path to the edited BSP file")
+    parser.add_argument("--radius", type=float, default=DEFAULT_RADIUS, help="Distance within which vertices, planes and surfaces can match")
+    parser.add_argument("--format", choices=["text", "ndjson"], default="text", help="Output format")
+    parser.add_argument("--no-cache", action="store_true", help="Parse the tags instead of using the tag cache")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    result = diff_bsps(load_bsp_arrays(args.old_bsp, not args.no_cache), load_bsp_arrays(args.new_bsp, not args.no_cache), args.radius)
+    result["seconds"] = perf_counter() - start
+    if args.format == "ndjson":
+        print(json.dumps({"type": "diff", "old_bsp": args.old_bsp, "new_bsp": args.new_bsp, **result}))
+    else:
+        print(format_diff(result))
+        print("Diffed in {:.3f}s".format(result["seconds"]))
@@ -1,25 +1,39 @@
-from reclaimer.hek.defs.sbsp import sbsp_def
+from collision_bsp import CollisionBSP, PlaneSurfaces, PLANE, BSP2D_NODE, BSP2D_REF_PLANE, FIRST_BSP2D_REFERENCE, BSP2D_REFERENCE_COUNT, LEFT_CHILD, RIGHT_CHILD, SURFACE_PLANE
+from bsp_traversal import walk_bsp3d, walk_bsp2d
 from inspect import getmembers
+from datetime import datetime
+import json
+import struct
 import collada
 import numpy as np
+import argparse
 from scipy.spatial.transform import Rotation as R
 
+parser = argparse.ArgumentParser(description="Export the collision BSP tree of a scenario_structure_bsp tag as a Collada or binary glTF scene")
+parser.add_argument("bsp", nargs="?", default="./dangercanyon.scenario_structure_bsp", help="Path to the scenario_structure_bsp tag")
+parser.add_argument("-o", "--output", help="Path of the file to write, ./bsp.dae or ./bsp.glb by default")
+parser.add_argument("--node", type=int, default=0, help="bsp3d node to export the subtree of, instead of the whole tree")
+parser.add_argument("--bbox", type=float, nargs=6, metavar=("MIN_X", "MIN_Y", "MIN_Z", "MAX_X", "MAX_Y", "MAX_Z"), help="Only export the parts of the tree whose space touches this box")
+parser.add_argument("--max-depth", type=int, help="Only export bsp3d nodes and leaves up to this many levels below the exported subtree's root")
+parser.add_argument("--skip-planes", action="store_true", help="Don't write each bsp3d node's plane geometry, only the leaves' surfaces")
+parser.add_argument("--stream", action="store_true", help="Stream the Collada file out with one geometry per surface instead of building it in memory")
+parser.add_argument("--glb", action="store_true", help="Write a binary glTF file instead of Collada")
+parser.add_argument("--glb-meshes", choices=["leaf", "surface"], default="leaf", help="With --glb, write one mesh per leaf with a primitive per surface, or one mesh per surface under the leaves' bsp2d nodes like the Collada scene")
+args = parser.parse_args()
+
 #https://github.com/Sigmmma/reclaimer/blob/master/reclaimer/hek/defs/coll.py
-bsp_path = "./dangercanyon.scenario_structure_bsp"
-bsp = sbsp_def.build(filepath=bsp_path).data.tagdata
-bsp3d_nodes = bsp.collision_bsp.collision_bsp_array[0].bsp3d_nodes.bsp3d_nodes_array
-bsp2d_nodes = bsp.collision_bsp.collision_bsp_array[0].bsp2d_nodes.bsp2d_nodes_array
-bsp2d_references = bsp.collision_bsp.collision_bsp_array[0].bsp2d_references.bsp2d_references_array
-bsp_leaves = bsp.collision_bsp.collision_bsp_array[0].leaves.leaves_array
-bsp_planes = bsp.collision_bsp.collision_bsp_array[0].planes.planes_array
-bsp_surfaces = bsp.collision_bsp.collision_bsp_array[0].surfaces.surfaces_array
-bsp_edges = bsp.collision_bsp.collision_bsp_array[0].edges.edges_array
-bsp_verts = bsp.collision_bsp.collision_bsp_array[0].vertices.vertices_array
+collision_bsp = CollisionBSP.load(args.bsp)
+bsp3d_nodes = collision_bsp.bsp3d_nodes
+bsp2d_node_children = collision_bsp.bsp2d_node_children
+bsp2d_references = collision_bsp.bsp2d_references
+bsp_leaves = collision_bsp.leaves
+bsp_surfaces = collision_bsp.surfaces
+plane_surfaces = PlaneSurfaces(collision_bsp)
 
 dae = collada.Collada()
 
-vert_floats = [[v.x, v.y, v.z] for v in bsp_verts]
-normal_floats = [[p.i, p.j, p.k] for p in bsp_planes]
+vert_floats = collision_bsp.vertices
+normal_floats = collision_bsp.planes[:, 0:3]
 
 mtl_effect_surface = collada.material.Effect("mtl_effect_surface", [], "phong", diffuse=(0.5, 0.5, 0.5), specular=(0, 1, 0))
 mtl_surface = collada.material.Material("mtl_surface", "mtl_surface", mtl_effect_surface)
@@ -58,67 +72,110 @@ def gen_surface_geometry(bsp_vert_indices, bsp_plane_index, surface_name):
     return collada.scene.GeometryNode(geom, [matnode])
 
 def gen_surface_node(bsp_surface_index, node_name):
-    bsp_surface = bsp_surfaces[bsp_surface_index]
-    first_edge = bsp_edges[bsp_surface.first_edge]
-    bsp_vert_indices = []
-    curr_edge = first_edge
-
-    while True:
-        forward = curr_edge.left_surface == bsp_surface_index
-        bsp_vert_indices.append(curr_edge.start_vertex if forward else curr_edge.end_vertex)
-        next_edge_index = curr_edge["forward_edge" if forward else "reverse_edge"]
-        if next_edge_index == bsp_surface.first_edge:
-            break
-        curr_edge = bsp_edges[next_edge_index]
-    geometry_node = gen_surface_geometry(bsp_vert_indices, bsp_surface.plane, node_name)
+    bsp_vert_indices = collision_bsp.surface_vertices(bsp_surface_index)
+    geometry_node = gen_surface_geometry(bsp_vert_indices, int(bsp_surfaces[bsp_surface_index, SURFACE_PLANE]), node_name)
     return collada.scene.Node(node_name, children=[geometry_node])
 
-def gen_bsp2d_node(bsp2d_node_index):
-    if bsp2d_node_index & 0x80000000 != 0:
-        bsp_surface_index = bsp2d_node_index & 0x7FFFFFFF
-        return gen_surface_node(bsp_surface_index, "surface_" + str(bsp_surface_index))
-    else:
-        bsp2d_node = bsp2d_nodes[bsp2d_node_index]
-        children = [
-            gen_bsp2d_node(bsp2d_node.left_child),
-            gen_bsp2d_node(bsp2d_node.right_child)
-        ]
-        return collada.scene.Node("bsp2d_node_" + str(bsp2d_node_index), children=children)
+# Scene nodes are built bottom up: each child's node is pushed to a stack
+# which its parent pops once all its children are done
+def gen_bsp2d_node(bsp2d_root_index):
+    scene_nodes = []
+
+    def enter(bsp2d_node_index):
+        if bsp2d_node_index & 0x80000000 != 0:
+            bsp_surface_index = bsp2d_node_index & 0x7FFFFFFF
+            scene_nodes.append(gen_surface_node(bsp_surface_index, "surface_" + str(bsp_surface_index)))
+
+    def leave(bsp2d_node_index):
+        right_child_node = scene_nodes.pop()
+        left_child_node = scene_nodes.pop()
+        children = [left_child_node, right_child_node]
+        scene_nodes.append(collada.scene.Node("bsp2d_node_" + str(bsp2d_node_index), children=children))
+
+    walk_bsp2d(bsp2d_node_children, bsp2d_root_index, enter, leave)
+    return scene_nodes.pop()
 
 def gen_bsp2d_reference_node(bsp2d_reference_index):
-    bsp2d_reference = bsp2d_references[bsp2d_reference_index]
-    return gen_bsp2d_node(bsp2d_reference.bsp2d_node)
+    return gen_bsp2d_node(int(bsp2d_references[bsp2d_reference_index, BSP2D_NODE]))
 
 def gen_leaf_node(bsp_leaf_index):
-    bsp_leaf = bsp_leaves[bsp_leaf_index]
-    bsp2d_ref_count = bsp_leaf.bsp2d_reference_count
-    bsp2d_ref_first = bsp_leaf.first_bsp2d_reference
+    bsp2d_ref_count = int(bsp_leaves[bsp_leaf_index, BSP2D_REFERENCE_COUNT])
+    bsp2d_ref_first = int(bsp_leaves[bsp_leaf_index, FIRST_BSP2D_REFERENCE])
     children = []
     if bsp2d_ref_count > 0:
         children = [gen_bsp2d_reference_node(i) for i in range(bsp2d_ref_first, bsp2d_ref_first + bsp2d_ref_count)]
     return collada.scene.Node("leaf_" + str(bsp_leaf_index), children=children)
 
+# The last surface on a plane, or None
+def find_plane_surface(plane_index):
+    matching_bsp_surface_index = plane_surfaces.last_surface(plane_index)
+    return None if matching_bsp_surface_index == -1 else matching_bsp_surface_index
+
 def gen_plane_geometry_node(plane_index):
-    matching_bsp_surface_index = None
-    for i, bsp_surface in enumerate(bsp_surfaces):
-        if bsp_surface.plane & 0x7FFFFFFF == plane_index & 0x7FFFFFFF:
-            matching_bsp_surface_index = i
+    matching_bsp_surface_index = find_plane_surface(plane_index)
     if matching_bsp_surface_index is None:
         return None
     return gen_surface_node(matching_bsp_surface_index, "plane_" + str(plane_index))
 
-def gen_bsp3d_node(bsp3d_node_index):
+# The corners of --bbox, to test which sides of a plane the box touches
+bbox_corners = None
+if args.bbox is not None:
+    bbox_min, bbox_max = np.array(args.bbox[0:3]), np.array(args.bbox[3:6])
+    if np.any(bbox_min > bbox_max):
+        raise Exception("bbox minimum " + str(bbox_min.tolist()) + " is above its maximum " + str(bbox_max.tolist()))
+    bbox_corners = np.array([[x, y, z] for x in (bbox_min[0], bbox_max[0]) for y in (bbox_min[1], bbox_max[1]) for z in (bbox_min[2], bbox_max[2])])
+
+# Whether the bbox touches the (front, back) sides of a plane
+def bbox_plane_sides(plane_index):
+    plane = collision_bsp.planes[plane_index & 0x7FFFFFFF]
+    dists = bbox_corners @ plane[0:3] - plane[3]
+    return (bool(dists.max() >= 0.0), bool(dists.min() < 0.0))
+
+# The root of the exported subtree: --node, moved down past nodes whose plane
+# the bbox is entirely on one side of, so exports of small boxes don't carry
+# the long chain of nodes above them
+def export_root():
+    if args.node < 0 or args.node >= len(bsp3d_nodes):
+        raise Exception("bsp3d node " + str(args.node) + " is out of range, the tree has " + str(len(bsp3d_nodes)) + " nodes")
+    bsp3d_node_index = args.node
+    while bbox_corners is not None and bsp3d_node_index & 0x80000000 == 0:
+        plane_index, back_child, front_child = bsp3d_nodes[bsp3d_node_index].tolist()
+        touches_front, touches_back = bbox_plane_sides(plane_index)
+        if touches_front and touches_back:
+            break
+        bsp3d_node_index = front_child if touches_front else back_child
     if bsp3d_node_index == -1:
-        return None
-    elif bsp3d_node_index & 0x80000000 != 0:
-        bsp_leaf_index = bsp3d_node_index & 0x7FFFFFFF
-        return gen_leaf_node(bsp_leaf_index)
-    else:
-        bsp3d_node = bsp3d_nodes[bsp3d_node_index]
+        raise Exception("bbox is entirely in solid space under bsp3d node " + str(args.node))
+    return bsp3d_node_index
+
+# Children left out of the export: those more than --max-depth levels below
+# the root, and those on the side of their parent's plane away from the bbox
+def skip_child(_bsp3d_child_index, halfspaces):
+    if args.max_depth is not None and len(halfspaces) > args.max_depth:
+        return True
+    if bbox_corners is not None and len(halfspaces) > 0:
+        plane_index, is_front, _bsp3d_node_index = halfspaces.peek()
+        touches_front, touches_back = bbox_plane_sides(plane_index)
+        return not (touches_front if is_front else touches_back)
+    return False
+
+def gen_bsp3d_node(bsp3d_root_index):
+    scene_nodes = []
+
+    def enter(bsp3d_node_index, halfspaces):
+        if bsp3d_node_index == -1 or skip_child(bsp3d_node_index, halfspaces):
+            scene_nodes.append(None)
+            return False
+        elif bsp3d_node_index & 0x80000000 != 0:
+            bsp_leaf_index = bsp3d_node_index & 0x7FFFFFFF
+            scene_nodes.append(gen_leaf_node(bsp_leaf_index))
+
+    def leave(bsp3d_node_index, _halfspaces):
+        plane_index = int(bsp3d_nodes[bsp3d_node_index, PLANE])
         bsp3d_node_name = "bsp3d_node_" + str(bsp3d_node_index)
-        back_child_node = gen_bsp3d_node(bsp3d_node.back_child)
-        front_child_node = gen_bsp3d_node(bsp3d_node.front_child)
-        plane = gen_plane_geometry_node(bsp3d_node.plane)
+        front_child_node = scene_nodes.pop()
+        back_child_node = scene_nodes.pop()
+        plane = None if args.skip_planes else gen_plane_geometry_node(plane_index)
 
         children = []
 
@@ -128,14 +185,349 @@ def gen_bsp3d_node(bsp3d_node_index):
             children.append(back_child_node)
         if front_child_node is not None:
             children.append(front_child_node)
-        return collada.scene.Node(bsp3d_node_name, children=children)
+        scene_nodes.append(collada.scene.Node(bsp3d_node_name, children=children))
+
+    # back first so geometry is generated in the same order as before
+    walk_bsp3d(bsp3d_nodes, bsp3d_root_index, enter, leave, front_first=False, visit_shared=True)
+    return scene_nodes.pop()
+
+def write_collada(out_path):
+    #https://pycollada.readthedocs.io/en/latest/creating.html
+    root_node = gen_bsp3d_node(export_root())
+    scene = collada.scene.Scene("bsp_scene", [root_node])
+    dae.scenes.append(scene)
+    dae.scene = scene
+    dae.write(out_path)
+
+    print("BSP surfaces: " + str(len(bsp_surfaces)))
+    print("Gen surfaces: " + str(sfc_count))
+
+# Writes the same node hierarchy as write_collada, but streams the XML out as
+# the tree is walked instead of building the scene in memory, and writes each
+# surface's geometry once no matter how many leaves and node planes instance
+# it. Collada sources can't be shared between meshes, so sharing is done at
+# the geometry level.
+class StreamingColladaWriter:
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.depth = 0
+        self.used_surfaces = set()
+
+    def line(self, text):
+        self.out_file.write("  " * self.depth + text + "\n")
+
+    def open(self, text):
+        self.line(text)
+        self.depth += 1
+
+    def close(self, text):
+        self.depth -= 1
+        self.line(text)
+
+    def surface_instance_node(self, bsp_surface_index, node_name):
+        self.used_surfaces.add(bsp_surface_index)
+        self.open(f'<node id="{node_name}" name="{node_name}">')
+        self.open(f'<instance_geometry url="#surface_{bsp_surface_index}-geometry">')
+        self.line('<bind_material><technique_common><instance_material symbol="mtl" target="#mtl_surface" /></technique_common></bind_material>')
+        self.close("</instance_geometry>")
+        self.close("</node>")
+
+    def bsp2d_tree(self, bsp2d_root_index):
+        def enter(bsp2d_node_index):
+            if bsp2d_node_index & 0x80000000 != 0:
+                bsp_surface_index = bsp2d_node_index & 0x7FFFFFFF
+                self.surface_instance_node(bsp_surface_index, "surface_" + str(bsp_surface_index))
+            else:
+                self.open(f'<node id="bsp2d_node_{bsp2d_node_index}" name="bsp2d_node_{bsp2d_node_index}">')
+
+        def leave(_bsp2d_node_index):
+            self.close("</node>")
+
+        walk_bsp2d(bsp2d_node_children, bsp2d_root_index, enter, leave)
+
+    def bsp3d_tree(self, bsp3d_root_index):
+        def enter(bsp3d_node_index, halfspaces):
+            if bsp3d_node_index == -1 or skip_child(bsp3d_node_index, halfspaces):
+                return False
+            elif bsp3d_node_index & 0x80000000 != 0:
+                bsp_leaf_index = bsp3d_node_index & 0x7FFFFFFF
+                self.open(f'<node id="leaf_{bsp_leaf_index}" name="leaf_{bsp_leaf_index}">')
+                bsp2d_ref_count = int(bsp_leaves[bsp_leaf_index, BSP2D_REFERENCE_COUNT])
+                bsp2d_ref_first = int(bsp_leaves[bsp_leaf_index, FIRST_BSP2D_REFERENCE])
+                for i in range(bsp2d_ref_first, bsp2d_ref_first + bsp2d_ref_count):
+                    self.bsp2d_tree(int(bsp2d_references[i, BSP2D_NODE]))
+                self.close("</node>")
+            else:
+                plane_index = int(bsp3d_nodes[bsp3d_node_index, PLANE])
+                self.open(f'<node id="bsp3d_node_{bsp3d_node_index}" name="bsp3d_node_{bsp3d_node_index}">')
+                plane_surface_index = None if args.skip_planes else find_plane_surface(plane_index)
+                if plane_surface_index is not None:
+                    self.surface_instance_node(plane_surface_index, "plane_" + str(plane_index))
+
+        def leave(_bsp3d_node_index, _halfspaces):
+            self.close("</node>")
+
+        walk_bsp3d(bsp3d_nodes, bsp3d_root_index, enter, leave, front_first=False, visit_shared=True)
+
+    def surface_geometry(self, bsp_surface_index):
+        name = f"surface_{bsp_surface_index}-geometry"
+        bsp_vert_indices = collision_bsp.surface_vertices(bsp_surface_index)
+        # 9 significant digits round-trip the tag's float32 values
+        positions = " ".join("{:.9g}".format(f) for f in vert_floats[bsp_vert_indices].flatten().tolist())
+        normal = " ".join("{:.9g}".format(f) for f in normal_floats[int(bsp_surfaces[bsp_surface_index, SURFACE_PLANE]) & 0x7FFFFFFF].tolist())
+        num_verts = len(bsp_vert_indices)
+        self.open(f'<geometry id="{name}" name="{name}">')
+        self.open("<mesh>")
+        for source_name, count, floats in [(name + "_verts", num_verts, positions), (name + "_normals", 1, normal)]:
+            self.open(f'<source id="{source_name}">')
+            self.line(f'<float_array count="{count * 3}" id="{source_name}-array">{floats}</float_array>')
+            self.line(f'<technique_common><accessor count="{count}" source="#{source_name}-array" stride="3"><param type="float" name="X" /><param type="float" name="Y" /><param type="float" name="Z" /></accessor></technique_common>')
+            self.close("</source>")
+        self.line(f'<vertices id="{name}_vertices"><input semantic="POSITION" source="#{name}_verts" /></vertices>')
+        self.open(f'<polylist count="1" material="mtl">')
+        self.line(f'<input offset="0" semantic="VERTEX" source="#{name}_vertices" />')
+        self.line(f'<input offset="1" semantic="NORMAL" source="#{name}_normals" />')
+        self.line(f"<vcount>{num_verts}</vcount>")
+        self.line("<p>" + " ".join(f"{v} 0" for v in range(num_verts)) + "</p>")
+        self.close("</polylist>")
+        self.close("</mesh>")
+        self.close("</geometry>")
+
+    def write(self, bsp3d_root_index=0):
+        now = datetime.now().isoformat()
+        self.line('<?xml version="1.0" encoding="utf-8"?>')
+        self.open('<COLLADA xmlns="http://www.collada.org/2005/11/COLLADASchema" version="1.4.1">')
+        self.line(f"<asset><created>{now}</created><modified>{now}</modified><up_axis>Y_UP</up_axis></asset>")
+        self.open("<library_effects>")
+        self.line('<effect id="mtl_effect_surface" name="mtl_effect_surface"><profile_COMMON><technique sid="common"><phong><diffuse><color>0.5 0.5 0.5 1.0</color></diffuse><specular><color>0 1 0 1.0</color></specular></phong></technique></profile_COMMON></effect>')
+        self.close("</library_effects>")
+        self.open("<library_materials>")
+        self.line('<material id="mtl_surface" name="mtl_surface"><instance_effect url="#mtl_effect_surface" /></material>')
+        self.close("</library_materials>")
+        # libraries can come in any order, so geometries are written after
+        # the scene once it's known which surfaces it uses
+        self.open("<library_visual_scenes>")
+        self.open('<visual_scene id="bsp_scene">')
+        self.bsp3d_tree(bsp3d_root_index)
+        self.close("</visual_scene>")
+        self.close("</library_visual_scenes>")
+        self.open("<library_geometries>")
+        for bsp_surface_index in sorted(self.used_surfaces):
+            self.surface_geometry(bsp_surface_index)
+        self.close("</library_geometries>")
+        self.line('<scene><instance_visual_scene url="#bsp_scene" /></scene>')
+        self.close("</COLLADA>")
+
+def write_collada_streaming(out_path):
+    with open(out_path, "w") as out_file:
+        writer = StreamingColladaWriter(out_file)
+        writer.write(export_root())
+    print("BSP surfaces: " + str(len(bsp_surfaces)))
+    print("Gen surfaces: " + str(len(writer.used_surfaces)))
+
+# Writes the same tree as the Collada writers as a single binary glTF file.
+# Every surface is fanned into triangles with a flat normal up front, and the
+# vertices and indices of the surfaces the scene uses are gathered into one
+# packed buffer, so each surface's mesh or primitive is just accessors into
+# it. Plane, flag and material indices are kept in each glTF node's extras.
+class GlbWriter:
+    GLB_MAGIC = 0x46546C67
+    JSON_CHUNK = 0x4E4F534A
+    BIN_CHUNK = 0x004E4942
+    FLOAT = 5126
+    UNSIGNED_INT = 5125
+    ARRAY_BUFFER = 34962
+    ELEMENT_ARRAY_BUFFER = 34963
+
+    def __init__(self, mesh_per_leaf):
+        self.mesh_per_leaf = mesh_per_leaf
+        self.nodes = []
+        self.meshes = []
+        self.used_surfaces = []
+        # surface index to its position in used_surfaces, and to its mesh
+        self.surface_slots = {}
+        self.surface_meshes = {}
+
+    # Vertex rings of all surfaces, so the tree walk only deals in indices
+    def triangulate_surfaces(self):
+        rings = [collision_bsp.surface_vertices(i) for i in range(len(bsp_surfaces))]
+        self.vert_counts = np.array([len(ring) for ring in rings], dtype=np.int64)
+        self.ring_vertices = np.array([v for ring in rings for v in ring], dtype=np.int64)
+        self.vert_offsets = np.concatenate([[0], np.cumsum(self.vert_counts)[:-1]])
+
+    # Surfaces with fewer than 3 vertices have no triangles, and glTF doesn't
+    # allow the empty accessors they'd need, so they get no geometry
+    def degenerate(self, bsp_surface_index):
+        return self.vert_counts[bsp_surface_index] < 3
+
+    def surface_extras(self, bsp_surface_index):
+        plane_index, _first_edge, flags, breakable_surface, material = bsp_surfaces[bsp_surface_index].tolist()
+        return {"surface": bsp_surface_index, "plane": plane_index & 0x7FFFFFFF, "flags": flags, "breakable_surface": breakable_surface, "material": material}
+
+    def surface_slot(self, bsp_surface_index):
+        if bsp_surface_index not in self.surface_slots:
+            self.surface_slots[bsp_surface_index] = len(self.used_surfaces)
+            self.used_surfaces.append(bsp_surface_index)
+        return self.surface_slots[bsp_surface_index]
+
+    # Primitives refer to their surface's slot until the buffer is laid out
+    def surface_primitive(self, bsp_surface_index):
+        return {"slot": self.surface_slot(bsp_surface_index), "material": 0, "extras": self.surface_extras(bsp_surface_index)}
+
+    # The surface's mesh, or None for degenerate surfaces
+    def surface_mesh(self, bsp_surface_index):
+        if self.degenerate(bsp_surface_index):
+            return None
+        if bsp_surface_index not in self.surface_meshes:
+            self.surface_meshes[bsp_surface_index] = len(self.meshes)
+            self.meshes.append({"name": "surface_" + str(bsp_surface_index), "primitives": [self.surface_primitive(bsp_surface_index)]})
+        return self.surface_meshes[bsp_surface_index]
+
+    def add_node(self, parent_node, node):
+        self.nodes.append(node)
+        if parent_node is not None:
+            parent_node.setdefault("children", []).append(len(self.nodes) - 1)
+        return node
+
+    def surface_node(self, parent_node, bsp_surface_index, node_name, extras):
+        mesh = self.surface_mesh(bsp_surface_index)
+        if mesh is None:
+            self.add_node(parent_node, {"name": node_name, "extras": extras})
+        else:
+            self.add_node(parent_node, {"name": node_name, "mesh": mesh, "extras": extras})
+
+    def bsp2d_tree(self, parent_node, bsp2d_root_index):
+        open_nodes = [parent_node]
+
+        def enter(bsp2d_node_index):
+            if bsp2d_node_index & 0x80000000 != 0:
+                bsp_surface_index = bsp2d_node_index & 0x7FFFFFFF
+                self.surface_node(open_nodes[-1], bsp_surface_index, "surface_" + str(bsp_surface_index), self.surface_extras(bsp_surface_index))
+            else:
+                open_nodes.append(self.add_node(open_nodes[-1], {"name": "bsp2d_node_" + str(bsp2d_node_index), "extras": {"bsp2d_node": bsp2d_node_index}}))
+
+        def leave(_bsp2d_node_index):
+            open_nodes.pop()
+
+        walk_bsp2d(bsp2d_node_children, bsp2d_root_index, enter, leave)
+
+    def leaf(self, parent_node, bsp_leaf_index):
+        flags, bsp2d_ref_count, bsp2d_ref_first = bsp_leaves[bsp_leaf_index].tolist()
+        bsp2d_ref_range = range(bsp2d_ref_first, bsp2d_ref_first + bsp2d_ref_count)
+        extras = {"leaf": bsp_leaf_index, "flags": flags, "planes": [int(bsp2d_references[i, BSP2D_REF_PLANE]) & 0x7FFFFFFF for i in bsp2d_ref_range]}
+        leaf_node = self.add_node(parent_node, {"name": "leaf_" + str(bsp_leaf_index), "extras": extras})
+        if not self.mesh_per_leaf:
+            for i in bsp2d_ref_range:
+                self.bsp2d_tree(leaf_node, int(bsp2d_references[i, BSP2D_NODE]))
+            return
+        primitives = [self.surface_primitive(s) for i in bsp2d_ref_range for s in collision_bsp.bsp2d_surfaces(int(bsp2d_references[i, BSP2D_NODE])) if not self.degenerate(s)]
+        if primitives:
+            leaf_node["mesh"] = len(self.meshes)
+            self.meshes.append({"name": "leaf_" + str(bsp_leaf_index), "primitives": primitives})
+
+    def bsp3d_tree(self, bsp3d_root_index):
+        open_nodes = [None]
+
+        def enter(bsp3d_node_index, halfspaces):
+            if bsp3d_node_index == -1 or skip_child(bsp3d_node_index, halfspaces):
+                return False
+            elif bsp3d_node_index & 0x80000000 != 0:
+                self.leaf(open_nodes[-1], bsp3d_node_index & 0x7FFFFFFF)
+            else:
+                plane_index = int(bsp3d_nodes[bsp3d_node_index, PLANE]) & 0x7FFFFFFF
+                bsp3d_node = self.add_node(open_nodes[-1], {"name": "bsp3d_node_" + str(bsp3d_node_index), "extras": {"bsp3d_node": bsp3d_node_index, "plane": plane_index}})
+                open_nodes.append(bsp3d_node)
+                plane_surface_index = None if args.skip_planes else find_plane_surface(plane_index)
+                if plane_surface_index is not None:
+                    self.surface_node(bsp3d_node, plane_surface_index, "plane_" + str(plane_index), {"plane": plane_index, "surface": plane_surface_index})
+
+        def leave(_bsp3d_node_index, _halfspaces):
+            open_nodes.pop()
+
+        walk_bsp3d(bsp3d_nodes, bsp3d_root_index, enter, leave, front_first=False, visit_shared=True)
+
+    # Gathers the used surfaces' fanned vertices and triangles into the
+    # buffer, returning the buffer and the accessors for each surface slot
+    def pack_surfaces(self):
+        used = np.array(self.used_surfaces, dtype=np.int64)
+        vert_counts = self.vert_counts[used]
+        vert_offsets = np.concatenate([[0], np.cumsum(vert_counts)[:-1]])
+        surface_of_vert = np.repeat(np.arange(len(used)), vert_counts)
+        verts = np.arange(len(surface_of_vert)) - vert_offsets[surface_of_vert]
+        ring_indices = self.ring_vertices[self.vert_offsets[used][surface_of_vert] + verts]
+        positions = vert_floats[ring_indices].astype(np.float32)
+        surface_planes = bsp_surfaces[used, SURFACE_PLANE] & 0x7FFFFFFF
+        normals = normal_floats[surface_planes].astype(np.float32)[surface_of_vert]
+
+        # triangle fans with indices relative to each surface's first vertex
+        tri_counts = np.maximum(vert_counts - 2, 0)
+        tri_offsets = np.concatenate([[0], np.cumsum(tri_counts)[:-1]])
+        surface_of_tri = np.repeat(np.arange(len(used)), tri_counts)
+        fan = np.arange(len(surface_of_tri)) - tri_offsets[surface_of_tri] + 1
+        indices = np.stack([np.zeros_like(fan), fan, fan + 1], axis=1).astype(np.uint32)
+
+        mins = np.minimum.reduceat(positions, vert_offsets, axis=0) if len(used) else positions
+        maxs = np.maximum.reduceat(positions, vert_offsets, axis=0) if len(used) else positions
+        buffer = positions.tobytes() + normals.tobytes() + indices.tobytes()
+        self.buffer_views = [
+            {"buffer": 0, "byteOffset": 0, "byteLength": positions.nbytes, "byteStride": 12, "target": GlbWriter.ARRAY_BUFFER},
+            {"buffer": 0, "byteOffset": positions.nbytes, "byteLength": normals.nbytes, "byteStride": 12, "target": GlbWriter.ARRAY_BUFFER},
+            {"buffer": 0, "byteOffset": positions.nbytes + normals.nbytes, "byteLength": indices.nbytes, "target": GlbWriter.ELEMENT_ARRAY_BUFFER},
+        ]
+        self.accessors = []
+        for slot in range(len(used)):
+            first_vert, vert_count = int(vert_offsets[slot]), int(vert_counts[slot])
+            first_index, index_count = int(tri_offsets[slot]) * 3, int(tri_counts[slot]) * 3
+            self.accessors.append({"bufferView": 0, "byteOffset": first_vert * 12, "componentType": GlbWriter.FLOAT, "count": vert_count, "type": "VEC3", "min": mins[slot].tolist(), "max": maxs[slot].tolist()})
+            self.accessors.append({"bufferView": 1, "byteOffset": first_vert * 12, "componentType": GlbWriter.FLOAT, "count": vert_count, "type": "VEC3"})
+            self.accessors.append({"bufferView": 2, "byteOffset": first_index * 4, "componentType": GlbWriter.UNSIGNED_INT, "count": index_count, "type": "SCALAR"})
+        return buffer
+
+    def write(self, out_file, bsp3d_root_index=0):
+        self.triangulate_surfaces()
+        self.bsp3d_tree(bsp3d_root_index)
+        buffer = self.pack_surfaces()
+        for mesh in self.meshes:
+            for primitive in mesh["primitives"]:
+                slot = primitive.pop("slot")
+                primitive["attributes"] = {"POSITION": slot * 3, "NORMAL": slot * 3 + 1}
+                primitive["indices"] = slot * 3 + 2
+        gltf = {
+            "asset": {"version": "2.0", "generator": "bsp-to-collada.py"},
+            "scene": 0,
+            "scenes": [{"name": "bsp_scene", "nodes": [0]}],
+            "nodes": self.nodes,
+            "meshes": self.meshes,
+            "materials": [{"name": "mtl_surface", "doubleSided": True, "pbrMetallicRoughness": {"baseColorFactor": [0.5, 0.5, 0.5, 1.0], "metallicFactor": 0.0}}],
+        }
+        # glTF doesn't allow empty buffers or buffer views, so a selection
+        # without any surface geometry has neither, nor a binary chunk
+        if len(buffer) > 0:
+            gltf["accessors"] = self.accessors
+            gltf["bufferViews"] = self.buffer_views
+            gltf["buffers"] = [{"byteLength": len(buffer)}]
+        # chunks are padded to 4 bytes, JSON with spaces and binary with zeros
+        json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+        json_chunk += b" " * (-len(json_chunk) % 4)
+        buffer += b"\0" * (-len(buffer) % 4)
+        bin_chunk_size = 8 + len(buffer) if len(buffer) > 0 else 0
+        out_file.write(struct.pack("<III", GlbWriter.GLB_MAGIC, 2, 12 + 8 + len(json_chunk) + bin_chunk_size))
+        out_file.write(struct.pack("<II", len(json_chunk), GlbWriter.JSON_CHUNK))
+        out_file.write(json_chunk)
+        if len(buffer) > 0:
+            out_file.write(struct.pack("<II", len(buffer), GlbWriter.BIN_CHUNK))
+            out_file.write(buffer)
 
-#https://pycollada.readthedocs.io/en/latest/creating.html
-root_node = gen_bsp3d_node(0)
-scene = collada.scene.Scene("bsp_scene", [root_node])
-dae.scenes.append(scene)
-dae.scene = scene
-dae.write("./bsp.dae")
+def write_glb(out_path):
+    with open(out_path, "wb") as out_file:
+        writer = GlbWriter(args.glb_meshes == "leaf")
+        writer.write(out_file, export_root())
+    print("BSP surfaces: " + str(len(bsp_surfaces)))
+    print("Gen surfaces: " + str(len(writer.used_surfaces)))
 
-print("BSP surfaces: " + str(len(bsp_surfaces)))
-print("Gen surfaces: " + str(sfc_count))
+if args.glb:
+    write_glb(args.output or "./bsp.glb")
+elif args.stream:
+    write_collada_streaming(args.output or "./bsp.dae")
+else:
+    write_collada(args.output or "./bsp.dae")
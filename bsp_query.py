@@ -0,0 +1,215 @@
+from collision_bsp import PLANE, BACK_CHILD, FRONT_CHILD, BSP2D_REFERENCE_COUNT, FIRST_BSP2D_REFERENCE, BSP2D_REF_PLANE, BSP2D_NODE, LEFT_CHILD, RIGHT_CHILD, FLAG, INDEX_MASK, NULL_INDEX
+from dataclasses import dataclass
+import numpy as np
+
+# Batched versions of the questions the game asks the collision BSP: which
+# leaf contains a point, and where a segment first enters solid space. Rather
+# than walking the tree once per query, every query advances one level of the
+# tree per step as a NumPy operation, so the number of Python-level steps is
+# the depth of the tree regardless of how many queries there are.
+#
+# A point on a plane counts as in front of it. A -1 bsp3d child is solid
+# space, and a leaf is open space.
+
+# The 2D axes surfaces on a plane are projected to for their bsp2d tree: the
+# plane normal's dominant axis is dropped, and the other two swapped if that
+# component is negative so the projection keeps the surfaces' winding
+PROJECTION_AXES = np.array([[1, 2], [2, 0], [0, 1]])
+
+# The (u, v) projection axes and dropped dominant axis for each of Nx3 normals
+def projection_axes(normals):
+    dominant = np.argmax(np.abs(normals), axis=1)
+    axes = PROJECTION_AXES[dominant]
+    negative = normals[np.arange(len(normals)), dominant] < 0.0
+    return np.where(negative[:, None], axes[:, ::-1], axes), dominant
+
+# Segment pieces are only split at planes their ends are further than this
+# from, so a piece starting on a plane it just crossed stays on that side
+PLANE_EPSILON = 0.000001
+
+# Segment hits, one element per segment. Segments which start in solid space
+# hit at t=0 with no plane. surface is -1 where the hit plane has no surface
+# in the leaf the segment came from, which is what phantom BSP looks like.
+# For casts into open space, leaf is the leaf entered and surface is -1.
+@dataclass
+class SegmentHits:
+    hit: np.ndarray
+    # fraction along the segment, inf for misses
+    t: np.ndarray
+    point: np.ndarray
+    # plane the segment crossed into solid space, and whether it came from the
+    # plane's front
+    plane: np.ndarray
+    from_front: np.ndarray
+    # leaf the segment was in before the hit
+    leaf: np.ndarray
+    surface: np.ndarray
+
+class CollisionQuery:
+    def __init__(self, collision_bsp):
+        self.collision_bsp = collision_bsp
+        self.bsp3d_nodes = collision_bsp.bsp3d_nodes.astype(np.int64)
+        self.planes = collision_bsp.planes
+
+    # Leaf index containing each of the Nx3 points, or -1 where they're in
+    # solid space. If forced_planes (and forced_fronts) are given, nodes on
+    # each point's forced plane send it to the given side regardless of the
+    # point's position; -1 forces nothing. That classifies points lying on a
+    # plane as being on a particular side of it.
+    def leaves_at(self, points, root=0, forced_planes=None, forced_fronts=None):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        refs = np.full(len(points), root, dtype=np.int64)
+        active = np.flatnonzero(refs & FLAG == 0)
+        while len(active) > 0:
+            nodes = self.bsp3d_nodes[refs[active]]
+            plane_indices = nodes[:, PLANE] & INDEX_MASK
+            planes = self.planes[plane_indices]
+            front = np.einsum("ij,ij->i", points[active], planes[:, 0:3]) - planes[:, 3] >= 0.0
+            if forced_planes is not None:
+                forced = forced_planes[active] == plane_indices
+                front = np.where(forced, forced_fronts[active], front)
+            refs[active] = np.where(front, nodes[:, FRONT_CHILD], nodes[:, BACK_CHILD])
+            active = active[refs[active] & FLAG == 0]
+        return np.where(refs == NULL_INDEX, -1, refs & INDEX_MASK)
+
+    def points_solid(self, points):
+        return self.leaves_at(points) == -1
+
+    # Finds where each segment (Nx3 starts and ends) first enters solid space,
+    # or open space if into_solid is False. Segments are split at the node
+    # planes they cross into pieces, and all pieces move down the tree
+    # together; pieces starting after the nearest entry found so far for their
+    # segment are dropped.
+    def cast_segments(self, starts, ends, into_solid=True):
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+        offsets = ends - starts
+        count = len(starts)
+
+        best_t = np.full(count, np.inf)
+        best_plane = np.full(count, -1, dtype=np.int64)
+        best_from_front = np.zeros(count, dtype=bool)
+        best_ref = np.full(count, NULL_INDEX, dtype=np.int64)
+
+        # pieces of segments: (segment, child reference, t range, and the plane
+        # and side the segment crossed at the start of the range)
+        segments = np.arange(count)
+        refs = np.zeros(count, dtype=np.int64)
+        t0 = np.zeros(count)
+        t1 = np.ones(count)
+        entry_planes = np.full(count, -1, dtype=np.int64)
+        entry_fronts = np.zeros(count, dtype=bool)
+
+        while len(segments) > 0:
+            solid = refs == NULL_INDEX if into_solid else (refs & FLAG != 0) & (refs != NULL_INDEX)
+            if np.any(solid):
+                solid_segments = segments[solid]
+                # the nearest solid piece of each segment, in case of several
+                order = np.lexsort((t0[solid], solid_segments))
+                first = np.ones(len(order), dtype=bool)
+                first[1:] = solid_segments[order][1:] != solid_segments[order][:-1]
+                nearest = np.flatnonzero(solid)[order[first]]
+                closer = t0[nearest] < best_t[segments[nearest]]
+                nearest = nearest[closer]
+                best_t[segments[nearest]] = t0[nearest]
+                best_plane[segments[nearest]] = entry_planes[nearest]
+                best_from_front[segments[nearest]] = entry_fronts[nearest]
+                best_ref[segments[nearest]] = refs[nearest]
+
+            # only pieces in nodes carry on
+            keep = (refs & FLAG == 0) & (t0 < best_t[segments])
+            segments, refs, t0, t1 = segments[keep], refs[keep], t0[keep], t1[keep]
+            entry_planes, entry_fronts = entry_planes[keep], entry_fronts[keep]
+            if len(segments) == 0:
+                break
+
+            nodes = self.bsp3d_nodes[refs]
+            plane_indices = nodes[:, PLANE] & INDEX_MASK
+            planes = self.planes[plane_indices]
+            # plane distance along each segment is start_dist + t * rate
+            start_dists = np.einsum("ij,ij->i", starts[segments], planes[:, 0:3]) - planes[:, 3]
+            rates = np.einsum("ij,ij->i", offsets[segments], planes[:, 0:3])
+            dists0 = start_dists + rates * t0
+            dists1 = start_dists + rates * t1
+            crossing = ((dists0 > PLANE_EPSILON) & (dists1 < -PLANE_EPSILON)) | ((dists0 < -PLANE_EPSILON) & (dists1 > PLANE_EPSILON))
+            # pieces which don't cross go by whichever end is further from the plane
+            front0 = np.where(crossing, dists0 > 0.0, dists0 + dists1 >= 0.0)
+            near_refs = np.where(front0, nodes[:, FRONT_CHILD], nodes[:, BACK_CHILD])
+            far_refs = np.where(front0, nodes[:, BACK_CHILD], nodes[:, FRONT_CHILD])
+
+            # pieces crossing the plane are split into a near and far piece
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t_split = np.clip(-start_dists / rates, t0, t1)
+            near_t1 = np.where(crossing, t_split, t1)
+            segments = np.concatenate([segments, segments[crossing]])
+            refs = np.concatenate([near_refs, far_refs[crossing]])
+            t0 = np.concatenate([t0, t_split[crossing]])
+            t1 = np.concatenate([near_t1, t1[crossing]])
+            entry_planes = np.concatenate([entry_planes, plane_indices[crossing]])
+            entry_fronts = np.concatenate([entry_fronts, front0[crossing]])
+
+        hit = np.isfinite(best_t)
+        t = best_t
+        points = starts + offsets * np.where(hit, t, 0.0)[:, None]
+        # the leaf the segment came from is on the approach side of the plane
+        leaf = np.full(count, -1, dtype=np.int64)
+        surface = np.full(count, -1, dtype=np.int64)
+        from_plane = hit & (best_plane != -1)
+        if not into_solid:
+            leaf = np.where(hit, best_ref & INDEX_MASK, -1)
+        elif np.any(from_plane):
+            leaf[from_plane] = self.leaves_at(points[from_plane], forced_planes=best_plane[from_plane], forced_fronts=best_from_front[from_plane])
+            surface[from_plane] = self.leaf_plane_surfaces(leaf[from_plane], best_plane[from_plane], points[from_plane])
+        return SegmentHits(hit, t, points, best_plane, best_from_front, leaf, surface)
+
+    # Rays are cast as segments max_distance long along their directions,
+    # which can't be zero
+    def cast_rays(self, origins, directions, max_distance):
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        lengths = np.linalg.norm(directions, axis=1)
+        zero = np.flatnonzero(lengths == 0.0)
+        if len(zero) > 0:
+            raise Exception(f"{len(zero)} rays have a zero length direction, the first is ray {zero[0]}")
+        return self.cast_segments(origins, origins + directions / lengths[:, None] * max_distance)
+
+    # The surface of each leaf on the given plane containing each point, found
+    # through the leaf's bsp2d reference for the plane, or -1 if the leaf has
+    # no surfaces on it
+    def leaf_plane_surfaces(self, leaf_indices, plane_indices, points):
+        leaves = self.collision_bsp.leaves
+        references = self.collision_bsp.bsp2d_references
+        leaf_indices = np.asarray(leaf_indices, dtype=np.int64)
+        plane_indices = np.asarray(plane_indices, dtype=np.int64)
+        refs = np.full(len(leaf_indices), NULL_INDEX, dtype=np.int64)
+        in_leaf = leaf_indices != -1
+        counts = np.where(in_leaf, leaves[leaf_indices, BSP2D_REFERENCE_COUNT], 0)
+        firsts = leaves[leaf_indices, FIRST_BSP2D_REFERENCE]
+        # leaves only reference a few planes, so check them one slot at a time
+        for slot in range(int(counts.max(initial=0))):
+            has_slot = np.flatnonzero((counts > slot) & (refs == NULL_INDEX))
+            reference_indices = firsts[has_slot] + slot
+            matches = references[reference_indices, BSP2D_REF_PLANE] & INDEX_MASK == plane_indices[has_slot]
+            refs[has_slot[matches]] = references[reference_indices[matches], BSP2D_NODE]
+        return self.bsp2d_surfaces_at(refs, plane_indices, points)
+
+    # Descends bsp2d trees (one root reference per point, -1 for none) with
+    # each point projected onto its plane, returning the surfaces reached. A
+    # projected point in front of a bsp2d node's line goes to its right child.
+    def bsp2d_surfaces_at(self, roots, plane_indices, points):
+        children = self.collision_bsp.bsp2d_node_children
+        node_planes = self.collision_bsp.bsp2d_node_planes
+        normals = self.planes[np.asarray(plane_indices, dtype=np.int64) & INDEX_MASK, 0:3]
+        axes, _dominant = projection_axes(normals)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        projected = np.take_along_axis(points, axes, axis=1)
+
+        refs = np.asarray(roots, dtype=np.int64).copy()
+        active = np.flatnonzero(refs & FLAG == 0)
+        while len(active) > 0:
+            lines = node_planes[refs[active]]
+            front = np.einsum("ij,ij->i", projected[active], lines[:, 0:2]) - lines[:, 2] >= 0.0
+            node_children = children[refs[active]]
+            refs[active] = np.where(front, node_children[:, RIGHT_CHILD], node_children[:, LEFT_CHILD])
+            active = active[refs[active] & FLAG == 0]
+        return np.where(refs == NULL_INDEX, -1, refs & INDEX_MASK)
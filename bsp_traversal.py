@@ -0,0 +1,115 @@
+import numpy as np
+
+# Explicit-stack walks of bsp3d and bsp2d trees, so deep trees from large maps
+# don't run into Python's recursion limit. Child references use the high bit
+# as a flag like in the tag: a flagged bsp3d child is a leaf, a flagged bsp2d
+# child is a surface, and -1 means no child.
+
+# Planes of the bsp3d nodes above a point in a walk, as (plane, is_front,
+# bsp3d_node) halfspaces. The columns are preallocated arrays which grow by
+# doubling, so pushing and popping never copies the path.
+class HalfspaceStack:
+    def __init__(self, capacity=64):
+        self.planes = np.empty(capacity, dtype=np.int64)
+        self.is_front = np.empty(capacity, dtype=bool)
+        self.nodes = np.empty(capacity, dtype=np.int64)
+        self.depth = 0
+
+    @staticmethod
+    def from_list(halfspaces):
+        stack = HalfspaceStack(max(64, len(halfspaces)))
+        for plane, is_front, node in halfspaces:
+            stack.push(plane, is_front, node)
+        return stack
+
+    def __len__(self):
+        return self.depth
+
+    def push(self, plane, is_front, node):
+        if self.depth == len(self.planes):
+            self.planes = np.concatenate([self.planes, np.empty_like(self.planes)])
+            self.is_front = np.concatenate([self.is_front, np.empty_like(self.is_front)])
+            self.nodes = np.concatenate([self.nodes, np.empty_like(self.nodes)])
+        self.planes[self.depth] = plane
+        self.is_front[self.depth] = is_front
+        self.nodes[self.depth] = node
+        self.depth += 1
+
+    def pop(self):
+        self.depth -= 1
+        return (int(self.planes[self.depth]), bool(self.is_front[self.depth]), int(self.nodes[self.depth]))
+
+    # The innermost halfspace, which is the parent plane of the current child
+    def peek(self):
+        return (int(self.planes[self.depth - 1]), bool(self.is_front[self.depth - 1]), int(self.nodes[self.depth - 1]))
+
+    def truncate(self, depth):
+        self.depth = depth
+
+    # Copy as a list of tuples, e.g. to keep or send to another process
+    def to_list(self):
+        return list(zip(self.planes[:self.depth].tolist(), self.is_front[:self.depth].tolist(), self.nodes[:self.depth].tolist()))
+
+    def node_path(self):
+        return (self.nodes[:self.depth] & 0x7FFFFFFF).tolist()
+
+    # front (0) or back (1) side taken at each node on the path
+    def sides(self):
+        return tuple(np.where(self.is_front[:self.depth], 0, 1).tolist())
+
+# Depth-first walk of the bsp3d tree under root (a node, flagged leaf, or -1).
+# pre(child, halfspaces) is called entering every child reference, with the
+# halfspaces of the nodes above it, and can return False to skip a node's
+# children. post(node, halfspaces) is called for nodes after their children.
+# halfspaces is one stack reused for the whole walk, so visitors must copy
+# it to keep it. A stack can be given to start below some parent halfspaces.
+# Front children are visited first unless front_first is False, and a back
+# child which is the same as the front child is skipped unless visit_shared.
+def walk_bsp3d(bsp3d_nodes, root=0, pre=None, post=None, halfspaces=None, front_first=True, visit_shared=False):
+    halfspaces = halfspaces if halfspaces is not None else HalfspaceStack()
+    base_depth = len(halfspaces)
+    # entries are (child, depth, halfspace to push or None, is_post)
+    stack = [(root, base_depth, None, False)]
+    while stack:
+        child, depth, halfspace, is_post = stack.pop()
+        halfspaces.truncate(depth)
+        if is_post:
+            post(child, halfspaces)
+            continue
+        if halfspace is not None:
+            halfspaces.push(*halfspace)
+        if pre is not None and pre(child, halfspaces) is False:
+            continue
+        if child & 0x80000000 != 0:
+            continue
+
+        plane, back_child, front_child = bsp3d_nodes[child].tolist()
+        depth = len(halfspaces)
+        if post is not None:
+            stack.append((child, depth, None, True))
+        front = (front_child, depth, (plane, True, child), False)
+        back = (back_child, depth, (plane, False, child), False) if back_child != front_child or visit_shared else None
+        for entry in ([back, front] if front_first else [front, back]):
+            if entry is not None:
+                stack.append(entry)
+    halfspaces.truncate(base_depth)
+
+# Depth-first walk of a bsp2d tree under root (a node or flagged surface),
+# left child first. pre(child) is called entering every child reference and
+# post(node) for nodes after their children.
+def walk_bsp2d(bsp2d_node_children, root, pre=None, post=None):
+    stack = [(int(root), False)]
+    while stack:
+        child, is_post = stack.pop()
+        if is_post:
+            post(child)
+            continue
+        if pre is not None:
+            pre(child)
+        if child & 0x80000000 != 0:
+            continue
+        left_child, right_child = bsp2d_node_children[child].tolist()
+        if post is not None:
+            stack.append((child, True))
+        stack.append((right_child, False))
+        stack.append((left_child, False))
@@ -0,0 +1,204 @@
+from collision_bsp import PLANE, BACK_CHILD, FRONT_CHILD, BSP2D_REFERENCE_COUNT, FIRST_BSP2D_REFERENCE, BSP2D_REF_PLANE, BSP2D_NODE, SURFACE_PLANE, FIRST_EDGE, START_VERTEX, END_VERTEX, FORWARD_EDGE, REVERSE_EDGE, LEFT_SURFACE, RIGHT_SURFACE, NULL_INDEX, flagged, unflag
+from dataclasses import dataclass
+import numpy as np
+
+# Integrity checks of a collision BSP, each done as whole-array operations so
+# it can run after every automated edit of a large map. Tree walks advance a
+# whole level of the tree per step, like bsp_query.
+#
+# A bsp3d node whose back and front children are the same (the phantom BSP
+# fix) references that child once. Other children with several parents are
+# shared subtrees, which are only reported unless allow_shared.
+
+CHECKS = ["ranges", "edge_loops", "surface_planes", "tree"]
+# Checks of the tag's structure, which edits of links should never break;
+# surface_planes also depends on how precisely the tag was compiled
+STRUCTURAL_CHECKS = ["ranges", "edge_loops", "tree"]
+# Surface vertices further than this from their plane are reported
+DEFAULT_TOLERANCE = 0.001
+# Indices listed in an issue's text
+SHOWN_INDICES = 10
+
+@dataclass
+class Issue:
+    check: str
+    message: str
+    # offending rows of the block the message is about
+    indices: list
+
+    def __str__(self):
+        shown = ", ".join(str(i) for i in self.indices[:SHOWN_INDICES])
+        more = ", ..." if len(self.indices) > SHOWN_INDICES else ""
+        return f"{self.check}: {len(self.indices)} {self.message} ({shown}{more})"
+
+    def to_record(self):
+        return {"check": self.check, "message": self.message, "count": len(self.indices), "indices": self.indices}
+
+def add_issue(issues, check, message, mask):
+    indices = np.flatnonzero(mask)
+    if len(indices) > 0:
+        issues.append(Issue(check, message, indices.tolist()))
+
+def in_range(indices, count):
+    return (indices >= 0) & (indices < count)
+
+# Whether each child reference is -1, a flagged index below flagged_count, or
+# an unflagged index below count
+def valid_children(children, count, flagged_count, allow_null=True):
+    is_flagged = flagged(children)
+    return np.where(children == NULL_INDEX, allow_null, np.where(is_flagged, unflag(children) < flagged_count, in_range(children, count)))
+
+def check_ranges(collision_bsp, issues):
+    nodes = collision_bsp.bsp3d_nodes.astype(np.int64)
+    leaves = collision_bsp.leaves.astype(np.int64)
+    references = collision_bsp.bsp2d_references.astype(np.int64)
+    bsp2d_children = collision_bsp.bsp2d_node_children.astype(np.int64)
+    surfaces = collision_bsp.surfaces.astype(np.int64)
+    edges = collision_bsp.edges.astype(np.int64)
+    plane_count = len(collision_bsp.planes)
+    surface_count = len(surfaces)
+    edge_count = len(edges)
+    vertex_count = len(collision_bsp.vertices)
+
+    add_issue(issues, "ranges", "bsp3d nodes with a plane out of range", unflag(nodes[:, PLANE]) >= plane_count)
+    add_issue(issues, "ranges", "bsp3d nodes with a child out of range", ~np.all(valid_children(nodes[:, [BACK_CHILD, FRONT_CHILD]], len(nodes), len(leaves)), axis=1))
+    first_references = leaves[:, FIRST_BSP2D_REFERENCE]
+    reference_counts = leaves[:, BSP2D_REFERENCE_COUNT]
+    add_issue(issues, "ranges", "leaves with bsp2d references out of range", (reference_counts < 0) | ((reference_counts > 0) & ((first_references < 0) | (first_references + reference_counts > len(references)))))
+    add_issue(issues, "ranges", "bsp2d references with a plane out of range", unflag(references[:, BSP2D_REF_PLANE]) >= plane_count)
+    add_issue(issues, "ranges", "bsp2d references with a node or surface out of range", ~valid_children(references[:, BSP2D_NODE], len(bsp2d_children), surface_count, allow_null=False))
+    add_issue(issues, "ranges", "bsp2d nodes with a child out of range", ~np.all(valid_children(bsp2d_children, len(bsp2d_children), surface_count, allow_null=False), axis=1))
+    add_issue(issues, "ranges", "surfaces with a plane out of range", unflag(surfaces[:, SURFACE_PLANE]) >= plane_count)
+    add_issue(issues, "ranges", "surfaces with a first edge out of range", ~in_range(surfaces[:, FIRST_EDGE], edge_count))
+    add_issue(issues, "ranges", "edges with a vertex out of range", ~np.all(in_range(edges[:, [START_VERTEX, END_VERTEX]], vertex_count), axis=1))
+    add_issue(issues, "ranges", "edges with a forward or reverse edge out of range", ~np.all(in_range(edges[:, [FORWARD_EDGE, REVERSE_EDGE]], edge_count), axis=1))
+    add_issue(issues, "ranges", "edges with a surface out of range", ~in_range(edges[:, LEFT_SURFACE], surface_count) | ~((edges[:, RIGHT_SURFACE] == NULL_INDEX) | in_range(edges[:, RIGHT_SURFACE], surface_count)))
+    first_edges = collision_bsp.vertex_first_edges.astype(np.int64)
+    add_issue(issues, "ranges", "vertices with a first edge out of range", ~((first_edges == NULL_INDEX) | in_range(first_edges, edge_count)))
+
+# Each edge is split into a half-edge for each of its surfaces, 2 * edge for
+# the left surface and 2 * edge + 1 for the right. A surface's half-edges
+# follow each other through the forward edge on the left and the reverse edge
+# on the right, and must form one closed loop joined end to start.
+def check_edge_loops(collision_bsp, issues):
+    edges = collision_bsp.edges.astype(np.int64)
+    edge_count = len(edges)
+    surfaces = collision_bsp.surfaces.astype(np.int64)
+    half_surfaces = edges[:, [LEFT_SURFACE, RIGHT_SURFACE]].ravel()
+    half_starts = edges[:, [START_VERTEX, END_VERTEX]].ravel()
+    half_ends = edges[:, [END_VERTEX, START_VERTEX]].ravel()
+    next_edges = edges[:, [FORWARD_EDGE, REVERSE_EDGE]].ravel()
+    exists = half_surfaces != NULL_INDEX
+
+    # the next half-edge is whichever side of the next edge has the surface
+    on_left = edges[next_edges, LEFT_SURFACE] == half_surfaces
+    on_right = edges[next_edges, RIGHT_SURFACE] == half_surfaces
+    next_halves = np.where(on_left, 2 * next_edges, np.where(on_right, 2 * next_edges + 1, -1))
+    broken = exists & (next_halves == -1)
+    add_issue(issues, "edge_loops", "edges whose next edge doesn't border the same surface", broken.reshape(edge_count, 2).any(axis=1))
+    joined = np.zeros(len(next_halves), dtype=bool)
+    joined[~broken] = half_ends[~broken] == half_starts[next_halves[~broken]]
+    add_issue(issues, "edge_loops", "edges whose next edge doesn't start where they end", (exists & ~broken & ~joined).reshape(edge_count, 2).any(axis=1))
+    entries = np.bincount(next_halves[exists & ~broken], minlength=len(next_halves))
+    add_issue(issues, "edge_loops", "edges which several edges of a surface lead into", (entries > 1).reshape(edge_count, 2).any(axis=1))
+
+    first_edges = surfaces[:, FIRST_EDGE]
+    surface_indices = np.arange(len(surfaces))
+    first_halves = np.where(edges[first_edges, LEFT_SURFACE] == surface_indices, 2 * first_edges, np.where(edges[first_edges, RIGHT_SURFACE] == surface_indices, 2 * first_edges + 1, -1))
+    add_issue(issues, "edge_loops", "surfaces whose first edge doesn't border them", first_halves == -1)
+    add_issue(issues, "edge_loops", "surfaces with fewer than 3 edges", np.bincount(half_surfaces[exists], minlength=len(surfaces)) < 3)
+    if any(issue.check == "edge_loops" for issue in issues):
+        return
+
+    # every half-edge now has exactly one next and one previous, so they form
+    # disjoint loops; label each loop by its smallest half-edge by doubling
+    labels = np.where(exists, np.arange(len(next_halves)), len(next_halves))
+    jumps = np.where(exists, next_halves, np.arange(len(next_halves)))
+    for _ in range(max(1, int(np.ceil(np.log2(max(len(jumps), 2)))))):
+        labels = np.minimum(labels, labels[jumps])
+        jumps = jumps[jumps]
+    surface_labels = labels[first_halves]
+    outside = exists.copy()
+    outside[exists] = labels[exists] != surface_labels[half_surfaces[exists]]
+    add_issue(issues, "edge_loops", "surfaces with edges outside the loop from their first edge", np.bincount(half_surfaces[outside], minlength=len(surfaces)) > 0)
+
+def check_surface_planes(collision_bsp, issues, tolerance):
+    pair_surfaces, pair_vertices = collision_bsp.surface_vertex_pairs()
+    planes = collision_bsp.planes[unflag(collision_bsp.surfaces[pair_surfaces, SURFACE_PLANE])].astype(np.float64)
+    distances = np.abs(np.einsum("ij,ij->i", collision_bsp.vertices[pair_vertices].astype(np.float64), planes[:, 0:3]) - planes[:, 3])
+    off_plane = np.bincount(pair_surfaces[distances > tolerance], minlength=len(collision_bsp.surfaces)) > 0
+    add_issue(issues, "surface_planes", f"surfaces with vertices further than {tolerance} from their plane", off_plane)
+
+# In-degrees of a binary tree's nodes from an Nx2 array of child references
+# (unflagged ones being nodes), which nodes are reached from the roots, and
+# which are in or below a cycle: those left once nodes with no remaining
+# parents are repeatedly removed, a level at a time
+def tree_structure(children, roots):
+    count = len(children)
+    is_node = (children != NULL_INDEX) & ~flagged(children)
+    is_node[:, 0] &= children[:, 0] != children[:, 1]
+    child_nodes = children[is_node]
+    in_degrees = np.bincount(child_nodes, minlength=count)
+
+    reached = np.zeros(count, dtype=bool)
+    frontier = np.unique(roots)
+    while len(frontier) > 0:
+        reached[frontier] = True
+        next_nodes = children[frontier][is_node[frontier]]
+        frontier = np.unique(next_nodes[~reached[next_nodes]])
+
+    remaining = in_degrees.copy()
+    removed = np.zeros(count, dtype=bool)
+    frontier = np.flatnonzero(remaining == 0)
+    while len(frontier) > 0:
+        removed[frontier] = True
+        next_nodes = children[frontier][is_node[frontier]]
+        np.subtract.at(remaining, next_nodes, 1)
+        frontier = np.unique(next_nodes[remaining[next_nodes] == 0])
+    return in_degrees, reached, ~removed
+
+def check_tree(collision_bsp, issues, allow_shared):
+    nodes = collision_bsp.bsp3d_nodes.astype(np.int64)
+    children = nodes[:, [BACK_CHILD, FRONT_CHILD]]
+    if len(nodes) > 0:
+        in_degrees, reached, in_cycle = tree_structure(children, [0])
+        add_issue(issues, "tree", "bsp3d nodes in or below a cycle", in_cycle)
+        add_issue(issues, "tree", "bsp3d nodes not under the root", ~reached & ~in_cycle)
+        if not allow_shared:
+            add_issue(issues, "tree", "bsp3d nodes under several parents", in_degrees > 1)
+
+        is_leaf = (children != NULL_INDEX) & flagged(children)
+        is_leaf[:, 0] &= children[:, 0] != children[:, 1]
+        leaf_parents = np.bincount(unflag(children[is_leaf]), minlength=len(collision_bsp.leaves))
+        reached_leaves = np.zeros(len(collision_bsp.leaves), dtype=bool)
+        reached_leaves[unflag(children[reached][is_leaf[reached]])] = True
+        add_issue(issues, "tree", "leaves not under the root", ~reached_leaves)
+        if not allow_shared:
+            add_issue(issues, "tree", "leaves under several parents", leaf_parents > 1)
+
+    # bsp2d trees hang from the references, which may share a tree
+    bsp2d_children = collision_bsp.bsp2d_node_children.astype(np.int64)
+    root_references = collision_bsp.bsp2d_references[:, BSP2D_NODE].astype(np.int64)
+    roots = root_references[~flagged(root_references)]
+    in_degrees, reached, in_cycle = tree_structure(bsp2d_children, roots)
+    add_issue(issues, "tree", "bsp2d nodes in or below a cycle", in_cycle)
+    add_issue(issues, "tree", "bsp2d nodes not under any bsp2d reference", ~reached & ~in_cycle)
+    if not allow_shared:
+        root_nodes = np.zeros(len(bsp2d_children), dtype=bool)
+        root_nodes[roots] = True
+        add_issue(issues, "tree", "bsp2d nodes under several parents", (in_degrees > 1) | ((in_degrees > 0) & root_nodes))
+
+# Runs the given checks, returning a list of Issues. Later checks index with
+# the links the range check covers, so they're skipped if it fails.
+def validate_collision_bsp(collision_bsp, checks=CHECKS, tolerance=DEFAULT_TOLERANCE, allow_shared=False):
+    issues = []
+    check_ranges(collision_bsp, issues)
+    if len(issues) > 0:
+        return issues
+    if "edge_loops" in checks:
+        check_edge_loops(collision_bsp, issues)
+    if "surface_planes" in checks:
+        check_surface_planes(collision_bsp, issues, tolerance)
+    if "tree" in checks:
+        check_tree(collision_bsp, issues, allow_shared)
+    return issues
@@ -0,0 +1,331 @@
+from tag_cache import extract_collision_arrays, load_bsp_arrays
+from bsp_traversal import walk_bsp3d, walk_bsp2d
+import numpy as np
+
+# Child and surface references use the high bit as a flag: a flagged bsp3d
+# child is a leaf index, a flagged bsp2d child is a surface index, and -1
+# (which is also flagged) means no child.
+FLAG = 0x80000000
+INDEX_MASK = 0x7FFFFFFF
+NULL_INDEX = -1
+
+# bsp3d_nodes columns
+PLANE, BACK_CHILD, FRONT_CHILD = 0, 1, 2
+# leaves columns
+LEAF_FLAGS, BSP2D_REFERENCE_COUNT, FIRST_BSP2D_REFERENCE = 0, 1, 2
+# bsp2d_references columns
+BSP2D_REF_PLANE, BSP2D_NODE = 0, 1
+# bsp2d_node_children columns
+LEFT_CHILD, RIGHT_CHILD = 0, 1
+# surfaces columns
+SURFACE_PLANE, FIRST_EDGE, SURFACE_FLAGS, BREAKABLE_SURFACE, MATERIAL = 0, 1, 2, 3, 4
+# edges columns
+START_VERTEX, END_VERTEX, FORWARD_EDGE, REVERSE_EDGE, LEFT_SURFACE, RIGHT_SURFACE = 0, 1, 2, 3, 4, 5
+
+# surface flags bits
+TWO_SIDED, INVISIBLE, CLIMBABLE, BREAKABLE = 0x1, 0x2, 0x4, 0x8
+
+# These work on plain ints as well as arrays of indices
+def flagged(indices):
+    return (np.asarray(indices, dtype=np.int64) & FLAG) != 0
+
+def unflag(indices):
+    return np.asarray(indices, dtype=np.int64) & INDEX_MASK
+
+# Block name and the arrays it's split into, with the reclaimer field backing
+# each array column. Fields named "flags" are flags blocks and are written
+# through their data attribute.
+TAG_BLOCKS = [
+    ("bsp3d_nodes", [("bsp3d_nodes", ["plane", "back_child", "front_child"])]),
+    ("planes", [("planes", ["i", "j", "k", "d"])]),
+    ("leaves", [("leaves", ["flags", "bsp2d_reference_count", "first_bsp2d_reference"])]),
+    ("bsp2d_references", [("bsp2d_references", ["plane", "bsp2d_node"])]),
+    ("bsp2d_nodes", [("bsp2d_node_planes", ["plane_i", "plane_j", "plane_d"]), ("bsp2d_node_children", ["left_child", "right_child"])]),
+    ("surfaces", [("surfaces", ["plane", "first_edge", "flags", "breakable_surface", "material"])]),
+    ("edges", [("edges", ["start_vertex", "end_vertex", "forward_edge", "reverse_edge", "left_surface", "right_surface"])]),
+    ("vertices", [("vertices", ["x", "y", "z"]), ("vertex_first_edges", ["first_edge"])]),
+]
+
+# Columnar copy of a collision BSP. Each block array is held as typed NumPy
+# columns so analysis code can index and mask it in bulk; the tag's block
+# objects are only touched when loading and by write_back.
+class CollisionBSP:
+    # With copy=False, arrays already of the right dtype are used as-is (e.g.
+    # views of shared memory) and the instance can't write_back
+    def __init__(self, arrays, copy=True):
+        to_array = np.array if copy else np.asarray
+        self.bsp3d_nodes = to_array(arrays["bsp3d_nodes"], dtype=np.int32).reshape(-1, 3)
+        # float64 holds the tag's float32 values exactly and matches the
+        # precision reclaimer's Python floats were used at
+        self.planes = to_array(arrays["planes"], dtype=np.float64).reshape(-1, 4)
+        self.leaves = to_array(arrays["leaves"], dtype=np.int32).reshape(-1, 3)
+        self.bsp2d_references = to_array(arrays["bsp2d_references"], dtype=np.int32).reshape(-1, 2)
+        self.bsp2d_node_planes = to_array(arrays["bsp2d_node_planes"], dtype=np.float64).reshape(-1, 3)
+        self.bsp2d_node_children = to_array(arrays["bsp2d_node_children"], dtype=np.int32).reshape(-1, 2)
+        self.surfaces = to_array(arrays["surfaces"], dtype=np.int32).reshape(-1, 5)
+        self.edges = to_array(arrays["edges"], dtype=np.int32).reshape(-1, 6)
+        self.vertices = to_array(arrays["vertices"], dtype=np.float64).reshape(-1, 3)
+        self.vertex_first_edges = to_array(arrays["vertex_first_edges"], dtype=np.int32)
+        # snapshot used by write_back to only touch changed rows
+        self._loaded = {name: getattr(self, name).copy() for name in self.array_names()} if copy else None
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.array_names()}
+
+    @staticmethod
+    def array_names():
+        return [name for _block, columns in TAG_BLOCKS for name, _fields in columns]
+
+    @staticmethod
+    def from_tag(bsp_tag, index=0):
+        return CollisionBSP(extract_collision_arrays(bsp_tag.data.tagdata.collision_bsp.STEPTREE[index]))
+
+    # From the arrays of tag_cache.load_bsp_arrays
+    @staticmethod
+    def from_bsp_arrays(bsp_arrays):
+        return CollisionBSP({name: bsp_arrays["collision_" + name] for name in CollisionBSP.array_names()})
+
+    # Read-only loading which goes through the tag cache
+    @staticmethod
+    def load(bsp_path, use_cache=True):
+        return CollisionBSP.from_bsp_arrays(load_bsp_arrays(bsp_path, use_cache))
+
+    # Writes changed rows (and any resized blocks) back to the tag's blocks
+    def write_back(self, bsp_tag, index=0):
+        if self._loaded is None:
+            raise Exception("CollisionBSP was created without copying its arrays and can't be written back")
+        collision_bsp = bsp_tag.data.tagdata.collision_bsp.STEPTREE[index]
+        for block_name, columns in TAG_BLOCKS:
+            block = collision_bsp[block_name].STEPTREE
+            count = len(getattr(self, columns[0][0]))
+            if len(block) < count:
+                block.extend(count - len(block))
+            elif len(block) > count:
+                del block[count:]
+
+            for name, fields in columns:
+                array = getattr(self, name).reshape(count, -1)
+                loaded = self._loaded[name].reshape(len(self._loaded[name]), -1)
+                common = min(len(loaded), count)
+                changed = np.flatnonzero(np.any(array[:common] != loaded[:common], axis=1))
+                for i in np.concatenate([changed, np.arange(common, count)]).tolist():
+                    write_row(block[i], fields, array[i].tolist())
+        self._loaded = {name: getattr(self, name).copy() for name in self.array_names()}
+
+    # Planes as (normal, dist) with the normal flipped for back halfspaces
+    def plane(self, plane_index, is_front=True):
+        i, j, k, d = self.planes[plane_index & INDEX_MASK]
+        normal = np.array([i, j, k])
+        return (normal, d) if is_front else (normal * -1.0, d * -1.0)
+
+    # Edge indices of a surface in winding order
+    def surface_edges(self, surface_index):
+        first_edge = int(self.surfaces[surface_index, FIRST_EDGE])
+        edge_indices = []
+        curr_edge_index = first_edge
+        while True:
+            edge_indices.append(curr_edge_index)
+            start, end, forward_edge, reverse_edge, left, right = self.edges[curr_edge_index].tolist()
+            next_edge_index = forward_edge if left == surface_index else reverse_edge
+            if next_edge_index == first_edge:
+                return edge_indices
+            curr_edge_index = next_edge_index
+
+    # Vertex indices of a surface in winding order
+    def surface_vertices(self, surface_index):
+        vert_indices = []
+        for edge_index in self.surface_edges(surface_index):
+            start, end, _f, _r, left, _right = self.edges[edge_index].tolist()
+            vert_indices.append(start if left == surface_index else end)
+        return vert_indices
+
+    # Every (surface, vertex) pair as two arrays sorted by surface, gathered
+    # from the edges since both ends of an edge are on both of its surfaces
+    def surface_vertex_pairs(self):
+        edges = self.edges.astype(np.int64)
+        surfaces = np.concatenate([edges[:, LEFT_SURFACE], edges[:, LEFT_SURFACE], edges[:, RIGHT_SURFACE], edges[:, RIGHT_SURFACE]])
+        vertices = np.concatenate([edges[:, START_VERTEX], edges[:, END_VERTEX], edges[:, START_VERTEX], edges[:, END_VERTEX]])
+        has_surface = surfaces != NULL_INDEX
+        # deduplicated by sorting one packed key, much faster than unique rows
+        stride = int(vertices.max(initial=0)) + 1
+        keys = np.sort(surfaces[has_surface] * stride + vertices[has_surface])
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        keys = keys[first]
+        return keys // stride, keys % stride
+
+    def bsp2d_surfaces(self, bsp2d_node_index):
+        surface_indices = []
+        def visit(child):
+            if child & FLAG != 0:
+                surface_indices.append(child & INDEX_MASK)
+        walk_bsp2d(self.bsp2d_node_children, bsp2d_node_index, visit)
+        return surface_indices
+
+    def leaf_bsp2d_references(self, leaf_index):
+        _flags, count, first = self.leaves[leaf_index].tolist()
+        return range(first, first + count)
+
+    def leaf_surfaces(self, leaf_index):
+        surface_indices = []
+        for r in self.leaf_bsp2d_references(leaf_index):
+            surface_indices += self.bsp2d_surfaces(int(self.bsp2d_references[r, BSP2D_NODE]))
+        return surface_indices
+
+# Surfaces grouped by their unflagged plane index, in surface order. Built
+# with one stable sort, so each plane's surfaces are a slice.
+class PlaneSurfaces:
+    def __init__(self, collision_bsp):
+        surface_planes = unflag(collision_bsp.surfaces[:, SURFACE_PLANE])
+        plane_count = max(len(collision_bsp.planes), int(surface_planes.max(initial=-1)) + 1)
+        self.surface_indices = np.argsort(surface_planes, kind="stable")
+        self.offsets = np.zeros(plane_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(surface_planes, minlength=plane_count), out=self.offsets[1:])
+
+    def surfaces_on(self, plane_index):
+        plane_index = plane_index & INDEX_MASK
+        if plane_index + 1 >= len(self.offsets):
+            return self.surface_indices[0:0]
+        return self.surface_indices[self.offsets[plane_index]:self.offsets[plane_index + 1]]
+
+    # The last surface on a plane, or -1 if there isn't one
+    def last_surface(self, plane_index):
+        surfaces = self.surfaces_on(plane_index)
+        return int(surfaces[-1]) if len(surfaces) > 0 else -1
+
+def write_row(block, fields, values):
+    for field, value in zip(fields, values):
+        if field == "flags":
+            block.flags.data = int(value)
+        else:
+            block[field] = value
+
+# Surfaces under every bsp3d node, precomputed in one depth-first pass. Leaf
+# surfaces are emitted front child first, matching the order a recursive
+# front-then-back gather would produce, so each node's surfaces are one
+# contiguous range of a single flattened surface index array. The ranges
+# reflect the tree as it was when this was built.
+class SubtreeSurfaces:
+    ARRAY_NAMES = ["leaf_offsets", "leaf_surface_indices", "node_starts", "node_ends", "surface_indices", "node_plane_surfaces"]
+
+    # arrays can be given to reuse a previous build's arrays()
+    def __init__(self, collision_bsp, arrays=None):
+        self.collision_bsp = collision_bsp
+        if arrays is not None:
+            for name in SubtreeSurfaces.ARRAY_NAMES:
+                setattr(self, name, arrays[name])
+        else:
+            self._build()
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in SubtreeSurfaces.ARRAY_NAMES}
+
+    def _build(self):
+        collision_bsp = self.collision_bsp
+        leaf_count = len(collision_bsp.leaves)
+        node_count = len(collision_bsp.bsp3d_nodes)
+
+        leaf_surfaces = [collision_bsp.leaf_surfaces(leaf_index) for leaf_index in range(leaf_count)]
+        self.leaf_offsets = np.zeros(leaf_count + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in leaf_surfaces], out=self.leaf_offsets[1:])
+        self.leaf_surface_indices = np.array([s for surfaces in leaf_surfaces for s in surfaces], dtype=np.int64)
+
+        self.node_starts = np.full(node_count, -1, dtype=np.int64)
+        self.node_ends = np.full(node_count, -1, dtype=np.int64)
+        flat = []
+        flat_len = 0
+        on_path = set()
+
+        def enter(child_index, _halfspaces):
+            nonlocal flat_len
+            if child_index & FLAG != 0:
+                if child_index != NULL_INDEX:
+                    surfaces = self.surfaces_under(child_index)
+                    flat.append(surfaces)
+                    flat_len += len(surfaces)
+                return
+            if child_index in on_path:
+                raise Exception(f"bsp3d node {child_index} is its own descendant")
+            on_path.add(child_index)
+            if self.node_starts[child_index] == -1:
+                self.node_starts[child_index] = flat_len
+
+        def leave(node_index, _halfspaces):
+            on_path.discard(node_index)
+            if self.node_ends[node_index] == -1:
+                self.node_ends[node_index] = flat_len
+
+        for root in range(node_count):
+            if self.node_starts[root] == -1:
+                walk_bsp3d(collision_bsp.bsp3d_nodes, root, enter, leave, visit_shared=True)
+        self.surface_indices = np.concatenate(flat) if flat else np.empty(0, dtype=np.int64)
+        self.node_plane_surfaces = self._find_node_plane_surfaces()
+
+    # Surface indices under a bsp3d child reference (node, flagged leaf, or -1)
+    def surfaces_under(self, child_index):
+        if child_index == NULL_INDEX:
+            return self.surface_indices[0:0]
+        elif child_index & FLAG != 0:
+            leaf_index = child_index & INDEX_MASK
+            return self.leaf_surface_indices[self.leaf_offsets[leaf_index]:self.leaf_offsets[leaf_index + 1]]
+        return self.surface_indices[self.node_starts[child_index]:self.node_ends[child_index]]
+
+    # The surface which defines a node's plane: the last surface under its
+    # front child on the same (unflagged) plane, or -1 if there isn't one
+    def plane_surface(self, bsp3d_node_index):
+        return int(self.node_plane_surfaces[bsp3d_node_index])
+
+    # Refreshes bsp3d nodes edited in place since the build, including nodes
+    # appended to the array. Plane surfaces of edited nodes with a leaf front
+    # child are recomputed, but flattened node ranges aren't, so surfaces_under
+    # an edited node or its ancestors still gives the surfaces from before the
+    # edit. Leaf ranges and leaf-fronted plane surfaces are all phantom
+    # detection needs to rescan an edited subtree.
+    def update_nodes(self, node_indices):
+        nodes = self.collision_bsp.bsp3d_nodes
+        added = len(nodes) - len(self.node_plane_surfaces)
+        if added > 0:
+            self.node_starts = np.concatenate([self.node_starts, np.full(added, -1, dtype=np.int64)])
+            self.node_ends = np.concatenate([self.node_ends, np.full(added, -1, dtype=np.int64)])
+            self.node_plane_surfaces = np.concatenate([self.node_plane_surfaces, np.full(added, -1, dtype=np.int64)])
+        surface_planes = unflag(self.collision_bsp.surfaces[:, SURFACE_PLANE])
+        for node_index in node_indices:
+            plane, _back_child, front_child = nodes[node_index].tolist()
+            self.node_plane_surfaces[node_index] = -1
+            if front_child & FLAG != 0 and front_child != NULL_INDEX:
+                surfaces = self.surfaces_under(front_child)
+                on_plane = surfaces[surface_planes[surfaces] == plane & INDEX_MASK]
+                if len(on_plane) > 0:
+                    self.node_plane_surfaces[node_index] = on_plane[-1]
+
+    def _find_node_plane_surfaces(self):
+        nodes = self.collision_bsp.bsp3d_nodes
+        surface_planes = unflag(self.collision_bsp.surfaces[:, SURFACE_PLANE])
+        node_planes = unflag(nodes[:, PLANE])
+        front_children = nodes[:, FRONT_CHILD].astype(np.int64)
+
+        # ranges of each node's front child within its own array
+        front_is_leaf = flagged(front_children) & (front_children != NULL_INDEX)
+        front_is_node = ~flagged(front_children)
+        leaf_indices = front_children & INDEX_MASK
+        result = np.full(len(nodes), -1, dtype=np.int64)
+        for array, is_child, starts, ends in [
+            (self.leaf_surface_indices, front_is_leaf, self.leaf_offsets[:-1], self.leaf_offsets[1:]),
+            (self.surface_indices, front_is_node, self.node_starts, self.node_ends),
+        ]:
+            query_nodes = np.flatnonzero(is_child)
+            if len(query_nodes) == 0 or len(array) == 0:
+                continue
+            child_refs = leaf_indices[query_nodes] if array is self.leaf_surface_indices else front_children[query_nodes]
+            range_starts = starts[child_refs]
+            range_ends = ends[child_refs]
+            # sort positions by (plane, position) and search for the last
+            # position before each range's end on the node's plane
+            stride = len(array) + 1
+            keys = np.sort(surface_planes[array] * stride + np.arange(len(array)))
+            found = np.searchsorted(keys, node_planes[query_nodes] * stride + range_ends) - 1
+            found_keys = keys[np.maximum(found, 0)]
+            found_positions = found_keys % stride
+            valid = (found >= 0) & (found_keys // stride == node_planes[query_nodes]) & (found_positions >= range_starts)
+            result[query_nodes[valid]] = array[found_positions[valid]]
+        return result
@@ -1,112 +1,286 @@
 from reclaimer.hek.defs.sbsp import sbsp_def
 from reclaimer.hek.defs.scnr import scnr_def
-from struct import unpack, pack_into
-from types import MethodType
+from vert_buffers import rendered_verts, lightmap_verts, iter_materials
+from collision_bsp import write_row, FLAG, INDEX_MASK
+from bsp_query import projection_axes
+from bsp_traversal import walk_bsp2d
+from scipy.spatial.transform import Rotation as R
 import numpy as np
 import argparse
+import sys
 
-def offset_point(point, offset):
-    point.x += offset[0]
-    point.y += offset[1]
-    point.z += offset[2]
+# Transforms a whole level by a 4x4 matrix acting on column vectors. Blocks of
+# the same kind are gathered from the whole level, transformed as arrays, and
+# written back in one pass:
+# * points (blocks starting with x, y, z) by the matrix
+# * directions (blocks starting with i, j, k) by its linear part
+# * normals and planes (i, j, k, d) by the inverse-transpose
+# Directions and normals keep their original lengths, so unit vectors stay
+# unit length and zero vectors stay zero, and planes with zero normals are
+# left as they are. Sums are done in float64 like the Python floats the tag
+# fields hold, so a pure translation serializes the same as offsetting each
+# field in turn.
 
-def offset_plane(plane, offset):
-    offset = np.array([offset[0], offset[1], offset[2]])
-    plane_normal = np.array([plane.i, plane.j, plane.k])
-    offset_d = np.dot(plane_normal, offset)
-    plane.d += offset_d
+def translation_matrix(offset):
+    matrix = np.eye(4)
+    matrix[0:3, 3] = offset
+    return matrix
 
-vert_unpacker = MethodType(unpack, "<3f")
-vert_packer = MethodType(pack_into, "<3f")
+# Scales uniformly, then rotates by XYZ Euler angles in degrees, then translates
+def level_matrix(offset=(0.0, 0.0, 0.0), rotation_degrees=(0.0, 0.0, 0.0), scale=1.0):
+    matrix = translation_matrix(offset)
+    if any(rotation_degrees):
+        matrix[0:3, 0:3] = R.from_euler("xyz", rotation_degrees, degrees=True).as_matrix()
+    matrix[0:3, 0:3] *= scale
+    return matrix
 
-def offset_level(bsp_path, scenario_path, offset):
+def tag_block_rows(blocks, width):
+    return np.array([block[0:width] for block in blocks], dtype=np.float64).reshape(-1, width)
+
+def write_rows(blocks, fields, rows):
+    for block, values in zip(blocks, rows.tolist()):
+        write_row(block, fields, values)
+
+# Rows scaled back to the lengths of the original rows
+def keep_lengths(rows, original_rows):
+    lengths = np.linalg.norm(rows, axis=1)
+    original_lengths = np.linalg.norm(original_rows, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factors = np.where(lengths > 0.0, original_lengths / lengths, 0.0)
+    return rows * factors[:, None]
+
+class LevelTransform:
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+        if not np.array_equal(self.matrix[3], [0.0, 0.0, 0.0, 1.0]):
+            raise Exception("Level transform must be affine, its bottom row is " + str(self.matrix[3].tolist()))
+        self.linear = self.matrix[0:3, 0:3]
+        self.translation = self.matrix[0:3, 3]
+        determinant = np.linalg.det(self.linear)
+        # a mirroring transform would turn every surface inside out
+        if determinant <= 0.0:
+            raise Exception("Level transform must keep handedness, its determinant is " + str(determinant))
+        self.normal_matrix = np.linalg.inv(self.linear).T
+        self.is_translation = np.array_equal(self.linear, np.eye(3))
+        # radii grow by the largest stretch so spheres still bound their contents
+        self.radius_scale = float(np.linalg.svd(self.linear, compute_uv=False)[0])
+        self.rotation = R.from_matrix(self.linear / np.cbrt(determinant))
+        # spawn facings and vehicle heights are about the z axis, which rigid
+        # turns about z and uniform scales keep vertical
+        self.keeps_vertical = self.linear[0, 2] == 0.0 and self.linear[1, 2] == 0.0 and self.linear[2, 0] == 0.0 and self.linear[2, 1] == 0.0
+        self.yaw = float(np.arctan2(self.linear[1, 0], self.linear[0, 0]))
+
+    def points(self, rows):
+        return rows @ self.linear.T + self.translation
+
+    def directions(self, rows):
+        return rows if self.is_translation else keep_lengths(rows @ self.linear.T, rows)
+
+    def normals(self, rows):
+        return rows if self.is_translation else keep_lengths(rows @ self.normal_matrix.T, rows)
+
+    # A plane n.p = d maps to (A^-T n).p' = d + (A^-T n).t
+    def planes(self, rows):
+        normals = rows[:, 0:3] if self.is_translation else rows[:, 0:3] @ self.normal_matrix.T
+        dists = rows[:, 3] + normals @ self.translation
+        planes = np.column_stack([normals, dists])
+        return planes if self.is_translation else planes * self.plane_factors(normals, rows[:, 0:3])[:, None]
+
+    # zero normals only come from zero original normals, whose d is kept
+    @staticmethod
+    def plane_factors(normals, original_normals):
+        lengths = np.linalg.norm(normals, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(lengths > 0.0, np.linalg.norm(original_normals, axis=1) / lengths, 1.0)
+
+    # Nx3x2 (min, max) bounds, as the bounds of their transformed corners
+    def bounds(self, rows):
+        corners = np.stack(np.meshgrid([0, 1], [0, 1], [0, 1], indexing="ij"), axis=-1).reshape(8, 3)
+        points = rows[:, np.arange(3)[None, :], corners].reshape(-1, 3)
+        points = self.points(points).reshape(len(rows), 8, 3)
+        return np.stack([points.min(axis=1), points.max(axis=1)], axis=-1)
+
+    def heights(self, heights, level_center):
+        if not self.keeps_vertical:
+            print("WARNING: the transform tilts the z axis, vehicle floor and ceiling are only approximate", file=sys.stderr)
+        points = np.tile(level_center, (len(heights), 1))
+        points[:, 2] = heights
+        return self.points(points)[:, 2]
+
+    # i, j, k, w quaternions rotated by the transform's rotation
+    def orientations(self, rows):
+        if self.is_translation or len(rows) == 0:
+            return rows
+        return (self.rotation * R.from_quat(rows)).as_quat()
+
+    # bsp2d node lines a*u + b*v = c are in the 2D projection of their surface
+    # plane, which a rotation can change. Each line is lifted to the 3D plane
+    # through it perpendicular to the projection, transformed, and projected
+    # onto the transformed surface plane's axes by eliminating its dropped
+    # coordinate.
+    def bsp2d_lines(self, lines, surface_planes):
+        if self.is_translation:
+            # the d of a line's lifted plane only moves along the projection, so
+            # a translation moves it by the projected offset
+            axes, _dominant = projection_axes(surface_planes[:, 0:3])
+            offsets = np.take_along_axis(np.tile(self.translation, (len(lines), 1)), axes, axis=1)
+            return np.column_stack([lines[:, 0:2], lines[:, 2] + np.einsum("ij,ij->i", lines[:, 0:2], offsets)])
+        count = len(lines)
+        rows = np.arange(count)
+        axes, _dominant = projection_axes(surface_planes[:, 0:3])
+        lifted = np.zeros((count, 4))
+        lifted[rows, axes[:, 0]] = lines[:, 0]
+        lifted[rows, axes[:, 1]] = lines[:, 1]
+        lifted[:, 3] = lines[:, 2]
+        lifted = self.planes(lifted)
+        new_surface_planes = self.planes(surface_planes)
+        new_axes, new_dominant = projection_axes(new_surface_planes[:, 0:3])
+        elimination = lifted[rows, new_dominant] / new_surface_planes[rows, new_dominant]
+        new_lines = np.column_stack([
+            lifted[rows, new_axes[:, 0]] - elimination * new_surface_planes[rows, new_axes[:, 0]],
+            lifted[rows, new_axes[:, 1]] - elimination * new_surface_planes[rows, new_axes[:, 1]],
+            lifted[:, 3] - elimination * new_surface_planes[:, 3],
+        ])
+        return new_lines * self.plane_factors(new_lines[:, 0:2], lines[:, 0:2])[:, None]
+
+    # Collision BSP planes, vertices and bsp2d node lines
+    def collision_bsp(self, collision_bsp):
+        planes = collision_bsp.planes.STEPTREE
+        bsp2d_nodes = collision_bsp.bsp2d_nodes.STEPTREE
+        vertices = collision_bsp.vertices.STEPTREE
+        plane_rows = tag_block_rows(planes, 4)
+
+        # each bsp2d node's surface plane, from the bsp2d reference its tree
+        # hangs from
+        node_rows = np.array([node[0:5] for node in bsp2d_nodes], dtype=np.float64).reshape(-1, 5)
+        node_children = node_rows[:, 3:5].astype(np.int64) & 0xFFFFFFFF
+        node_planes = np.full(len(bsp2d_nodes), -1, dtype=np.int64)
+        for plane_index, bsp2d_root in collision_bsp.bsp2d_references.STEPTREE:
+            def visit(child, plane_index=plane_index):
+                if child & FLAG == 0:
+                    node_planes[child] = plane_index & INDEX_MASK
+            walk_bsp2d(node_children, bsp2d_root & 0xFFFFFFFF, visit)
+        # nodes no reference reaches have no surface plane to project through,
+        # so their lines are left as they are
+        orphans = node_planes == -1
+        if np.any(orphans):
+            print("WARNING: " + str(int(np.sum(orphans))) + " bsp2d nodes aren't under any bsp2d reference, leaving their lines unchanged", file=sys.stderr)
+
+        node_lines = node_rows[:, 0:3].copy()
+        node_lines[~orphans] = self.bsp2d_lines(node_lines[~orphans], plane_rows[node_planes[~orphans]])
+        write_rows(bsp2d_nodes, ["plane_i", "plane_j", "plane_d"], node_lines)
+        write_rows(planes, ["i", "j", "k", "d"], self.planes(plane_rows))
+        write_rows(vertices, ["x", "y", "z"], self.points(tag_block_rows(vertices, 3)))
+
+    # Positions, normals, tangent frames and lightmap incident vectors, in
+    # place through views of the material's vertex buffer
+    def material_vertices(self, material):
+        verts = rendered_verts(material)
+        verts["position"] = self.points(verts["position"].astype(np.float64))
+        if self.is_translation:
+            return
+        verts["normal"] = self.normals(verts["normal"].astype(np.float64))
+        verts["bitangent"] = self.directions(verts["bitangent"].astype(np.float64))
+        verts["tangent"] = self.directions(verts["tangent"].astype(np.float64))
+        lm_verts = lightmap_verts(material)
+        lm_verts["incident"] = self.directions(lm_verts["incident"].astype(np.float64))
+
+def transform_level(bsp_path, scenario_path, matrix):
+    transform = LevelTransform(matrix)
     bsp_tag = sbsp_def.build(filepath=bsp_path)
     bsp = bsp_tag.data.tagdata
     scenario_tag = scnr_def.build(filepath=scenario_path)
     scenario = scenario_tag.data.tagdata
+    points = []
+    directions = []
+    planes = []
+    # (x, y, z) bounds blocks, and (block, field) radii
+    bounds = []
+    radii = []
 
     for collision_bsp in bsp.collision_bsp.STEPTREE:
-        for plane in collision_bsp.planes.STEPTREE:
-            offset_plane(plane, offset)
-        for vert in collision_bsp.vertices.STEPTREE:
-            offset_point(vert, offset)
-
-    for lightmap in bsp.lightmaps.STEPTREE:
-        for material in lightmap.materials.STEPTREE:
-            # material planes not included because zero length normals
-            offset_point(material.centroid, offset)
-            vert_count = material.vertices_count
-            vert_buffer = material.uncompressed_vertices.STEPTREE
-            for i in range(vert_count):
-                vert_offset = i * 56
-                x, y, z = vert_unpacker(vert_buffer[vert_offset: vert_offset + 12])
-                vert_packer(vert_buffer, vert_offset, x + offset[0], y + offset[1], z + offset[2])
-
-    for flare_marker in bsp.lens_flare_markers.STEPTREE:
-        offset_point(flare_marker.position, offset)
+        transform.collision_bsp(collision_bsp)
+
+    directions.extend([bsp.default_distant_light_0_direction, bsp.default_distant_light_1_direction, bsp.default_shadow_vector])
+
+    for _lightmap, material in iter_materials(bsp):
+        points.append(material.centroid)
+        # material planes can have zero length normals, which are left alone
+        planes.append(material.plane)
+        directions.extend([material.distant_light_0_direction, material.distant_light_1_direction, material.shadow_vector])
+        transform.material_vertices(material)
+
+    points.extend(flare_marker.position for flare_marker in bsp.lens_flare_markers.STEPTREE)
 
     for cluster in bsp.clusters.STEPTREE:
         for subcluster in cluster.subclusters.STEPTREE:
-            subcluster.world_bounds_x[0] += offset[0]
-            subcluster.world_bounds_x[1] += offset[0]
-            subcluster.world_bounds_y[0] += offset[1]
-            subcluster.world_bounds_y[1] += offset[1]
-            subcluster.world_bounds_z[0] += offset[2]
-            subcluster.world_bounds_z[1] += offset[2]
+            bounds.append((subcluster.world_bounds_x, subcluster.world_bounds_y, subcluster.world_bounds_z))
         for mirror in cluster.mirrors.STEPTREE:
-            offset_plane(mirror.plane, offset)
-            for vert in mirror.vertices.STEPTREE:
-                offset_point(vert, offset)
+            planes.append(mirror.plane)
+            points.extend(mirror.vertices.STEPTREE)
 
     for cluster_portal in bsp.cluster_portals.STEPTREE:
-        offset_point(cluster_portal.centroid, offset)
-        for vert in cluster_portal.vertices.STEPTREE:
-            offset_point(vert, offset)
+        points.append(cluster_portal.centroid)
+        radii.append((cluster_portal, "bounding_radius"))
+        points.extend(cluster_portal.vertices.STEPTREE)
 
     for surface in bsp.breakable_surfaces.STEPTREE:
-        offset_point(surface.centroid, offset)
+        points.append(surface.centroid)
+        radii.append((surface, "radius"))
 
     for fog_plane in bsp.fog_planes.STEPTREE:
-        offset_plane(fog_plane.plane, offset)
-        for vert in fog_plane.vertices.STEPTREE:
-            offset_point(vert, offset)
+        planes.append(fog_plane.plane)
+        points.extend(fog_plane.vertices.STEPTREE)
 
     for weather_polyhedra in bsp.weather_polyhedras.STEPTREE:
-        offset_point(weather_polyhedra.bounding_sphere_center, offset)
-        for plane in weather_polyhedra.planes.STEPTREE:
-            offset_plane(plane, offset)
+        points.append(weather_polyhedra.bounding_sphere_center)
+        radii.append((weather_polyhedra, "bounding_sphere_radius"))
+        planes.extend(weather_polyhedra.planes.STEPTREE)
 
-    for marker in bsp.markers.STEPTREE:
-        offset_point(marker.position, offset)
-
-    for decal in bsp.runtime_decals.STEPTREE:
-        offset_point(decal.position, offset)
+    markers = bsp.markers.STEPTREE
+    points.extend(marker.position for marker in markers)
+    write_rows([marker.rotation for marker in markers], ["i", "j", "k", "w"], transform.orientations(tag_block_rows([marker.rotation for marker in markers], 4)))
+    # decal and lens flare orientations are packed integers and aren't turned
+    points.extend(decal.position for decal in bsp.runtime_decals.STEPTREE)
 
     for leaf_map_portal in bsp.leaf_map_portals.STEPTREE:
-        for vert in leaf_map_portal.vertices.STEPTREE:
-            offset_point(vert, offset)
+        points.extend(leaf_map_portal.vertices.STEPTREE)
+
+    player_spawns = scenario.player_starting_locations.STEPTREE
+    points.extend(player_spawn.position for player_spawn in player_spawns)
+    for player_spawn in player_spawns:
+        player_spawn.facing += transform.yaw
 
-    bsp.world_bounds_x[0] += offset[0]
-    bsp.world_bounds_x[1] += offset[0]
-    bsp.world_bounds_y[0] += offset[1]
-    bsp.world_bounds_y[1] += offset[1]
-    bsp.world_bounds_z[0] += offset[2]
-    bsp.world_bounds_z[1] += offset[2]
-    bsp.vehicle_floor += offset[2]
-    bsp.vehicle_ceiling += offset[2]
+    write_rows(points, ["x", "y", "z"], transform.points(tag_block_rows(points, 3)))
+    write_rows(directions, ["i", "j", "k"], transform.directions(tag_block_rows(directions, 3)))
+    write_rows(planes, ["i", "j", "k", "d"], transform.planes(tag_block_rows(planes, 4)))
+    for (block, field), radius in zip(radii, (np.array([block[field] for block, field in radii]) * transform.radius_scale).tolist()):
+        block[field] = radius
 
-    for player_spawn in scenario.player_starting_locations.STEPTREE:
-        offset_point(player_spawn.position, offset)
+    level_center = np.array([sum(bsp.world_bounds_x) / 2.0, sum(bsp.world_bounds_y) / 2.0, sum(bsp.world_bounds_z) / 2.0])
+    bounds.append((bsp.world_bounds_x, bsp.world_bounds_y, bsp.world_bounds_z))
+    bound_rows = np.array([[axis_bounds[0:2] for axis_bounds in block_bounds] for block_bounds in bounds], dtype=np.float64)
+    for block_bounds, new_bounds in zip(bounds, transform.bounds(bound_rows).tolist()):
+        for axis_bounds, (low, high) in zip(block_bounds, new_bounds):
+            axis_bounds[0], axis_bounds[1] = low, high
+    bsp.vehicle_floor, bsp.vehicle_ceiling = transform.heights(np.array([bsp.vehicle_floor, bsp.vehicle_ceiling]), level_center).tolist()
 
     bsp_tag.serialize(backup=False, temp=False)
     scenario_tag.serialize(backup=False, temp=False)
 
+def offset_level(bsp_path, scenario_path, offset):
+    transform_level(bsp_path, scenario_path, translation_matrix(offset))
 
-parser = argparse.ArgumentParser()
-parser.add_argument("bsp", help="Path to the BSP file to modify")
-parser.add_argument("scenario", help="Path to the scenario file to modify")
-parser.add_argument("x", type=float, help="X offset")
-parser.add_argument("y", type=float, help="Y offset")
-parser.add_argument("z", type=float, help="Z (vertical) offset")
-args = parser.parse_args()
-offset_level(args.bsp, args.scenario, (args.x, args.y, args.z))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Translate, rotate and uniformly scale a BSP and its scenario's player spawns")
+    parser.add_argument("bsp", help="Path to the BSP file to modify")
+    parser.add_argument("scenario", help="Path to the scenario file to modify")
+    parser.add_argument("x", type=float, help="X offset")
+    parser.add_argument("y", type=float, help="Y offset")
+    parser.add_argument("z", type=float, help="Z (vertical) offset")
+    parser.add_argument("--rotate", type=float, nargs=3, default=[0.0, 0.0, 0.0], metavar=("X", "Y", "Z"), help="XYZ Euler angles in degrees to rotate by about the origin, before the offset")
+    parser.add_argument("--scale", type=float, default=1.0, help="Uniform scale about the origin, before the rotation and offset")
+    parser.add_argument("--matrix", type=float, nargs=16, help="Row-major 4x4 affine matrix to transform by instead of the offset, rotation and scale")
+    args = parser.parse_args()
+    matrix = args.matrix if args.matrix is not None else level_matrix((args.x, args.y, args.z), args.rotate, args.scale)
+    transform_level(args.bsp, args.scenario, matrix)
@@ -1,4 +1,6 @@
 from reclaimer.hek.defs.sbsp import sbsp_def
+from collision_bsp import CollisionBSP
+from bsp_validation import validate_collision_bsp, STRUCTURAL_CHECKS
 
 bsp_path = "/home/csauve/haloce/tags/levels/test/dangercanyon/dangercanyon.scenario_structure_bsp"
 tag = sbsp_def.build(filepath=bsp_path)
@@ -39,4 +41,9 @@ def fix_a():
 
 fix_d()
 
+# fix_c deliberately shares a subtree, but nothing should break the structure
+issues = validate_collision_bsp(CollisionBSP.from_tag(tag), STRUCTURAL_CHECKS, allow_shared=True)
+if len(issues) > 0:
+    raise Exception("Not saving, the edit broke the collision BSP: " + "; ".join(str(issue) for issue in issues))
+
 tag.serialize(backup=False, temp=False)
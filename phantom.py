@@ -0,0 +1,471 @@
+from bsp_traversal import HalfspaceStack, walk_bsp3d
+from collision_bsp import CollisionBSP, SubtreeSurfaces, flagged, PLANE, BACK_CHILD, FRONT_CHILD, START_VERTEX, END_VERTEX, LEFT_SURFACE, RIGHT_SURFACE
+from multiprocessing import Pool, shared_memory
+from dataclasses import dataclass, field, asdict
+from collections import Counter
+import numpy as np
+import math
+import sys
+
+# If an edge is co-planar with one of the halfspace planes it cannot be inside
+# the volume. This thredshold is super sensitive... too high and we miss
+# phantom BSP on very similar planes to parent node planes, but too low and we
+# get false positive phantom BSP from low precision.
+COPLANAR_THRESHOLD = 0.0001
+# Entry and exit points closer than this are treated as the same point
+DEGENERATE_INTERVAL = 0.05
+# Entry and exit points this close to a plane count as on it
+ON_PLANE_THRESHOLD = 0.00001
+# Bump whenever a change to detection could change its results, so results
+# remembered for unchanged tags (like batch clean runs) are invalidated
+DETECTOR_VERSION = 1
+
+# check for numbers "close enough" to zero to account for rounding/precision issues
+def zeroish(n, threshold):
+    return abs(n) < threshold
+
+# the following few math functions expect numpy types
+def point_cmp_plane(point, plane):
+    plane_normal, plane_dist = plane
+    plane_origin = plane_normal * plane_dist
+    point_vec = point - plane_origin
+    product = np.dot(point_vec, plane_normal)
+    return product
+
+def dist(point_a, point_b):
+    offset = point_b - point_a
+    return np.sqrt(offset.dot(offset))
+
+# https://en.wikipedia.org/wiki/Line%E2%80%93plane_intersection
+def t_line_plane_intersection(start, end, plane):
+    plane_normal, plane_dist = plane
+    plane_origin = plane_normal * plane_dist
+    line_offset = end - start
+    line_dot_normal = np.dot(line_offset, plane_normal)
+    if line_dot_normal == 0.0:
+        return (None, None)
+    t = np.dot((plane_origin - start), plane_normal) / line_dot_normal
+    entering = line_dot_normal > 0.0
+    return (None, None) if t > 1.0 or t < 0.0 else (t, entering)
+
+def lerp_points(start_point, end_point, t):
+    offset = end_point - start_point
+    return start_point + offset * t
+
+# Halfspaces are a HalfspaceStack or a list of (plane_index, is_front,
+# bsp3d_node_index) tuples. Returns the Hx3 normals and H dists, flipped for
+# back halfspaces, of the convex polyhedron they bound.
+def halfspace_planes(collision_bsp, halfspaces):
+    if isinstance(halfspaces, HalfspaceStack):
+        plane_indices = halfspaces.planes[:len(halfspaces)] & 0x7FFFFFFF
+        signs = np.where(halfspaces.is_front[:len(halfspaces)], 1.0, -1.0)
+    else:
+        plane_indices = np.array([h[0] for h in halfspaces], dtype=np.int64) & 0x7FFFFFFF
+        signs = np.where([h[1] for h in halfspaces], 1.0, -1.0)
+    planes = collision_bsp.planes[plane_indices].reshape(-1, 4)
+    return planes[:, 0:3] * signs[:, None], planes[:, 3] * signs
+
+# True if the edge passes through the convex polyhedron defined by node
+# plane half-spaces. It is not considered inside of it is co-planar.
+# This is the one edge at a time reference for edges_inside_polyhedron.
+# See: http://web.cse.ohio-state.edu/~parent.1/classes/681/Lectures/14.ObjectIntersection.pdf
+def edge_inside_polyhedron(edge_start, edge_end, planes):
+    t_entry_max = None
+    t_exit_min = None
+
+    for plane in planes:
+        start_cmp = point_cmp_plane(edge_start, plane)
+        end_cmp = point_cmp_plane(edge_end, plane)
+        if zeroish(start_cmp, COPLANAR_THRESHOLD) and zeroish(end_cmp, COPLANAR_THRESHOLD):
+            return False
+        t_intersection, entering = t_line_plane_intersection(edge_start, edge_end, plane)
+        if t_intersection is not None:
+            if entering:
+                if t_entry_max is None or t_intersection > t_entry_max:
+                    t_entry_max = t_intersection
+            else:
+                if t_exit_min is None or t_intersection < t_exit_min:
+                    t_exit_min = t_intersection
+
+    # If we miss the planes then there's no way it can be interecting the volume
+    if t_entry_max is None or t_exit_min is None:
+        return False
+
+    entry_point = lerp_points(edge_start, edge_end, t_entry_max)
+    exit_point = lerp_points(edge_start, edge_end, t_exit_min)
+
+    # If entry and exit are essentially the same point, ignore
+    if zeroish(dist(entry_point, exit_point), DEGENERATE_INTERVAL):
+        return False
+
+    # We still need to check if the intersection points are outside the volume
+    for plane in planes:
+        entry_cmp = point_cmp_plane(entry_point, plane)
+        exit_cmp = point_cmp_plane(exit_point, plane)
+        if not zeroish(entry_cmp, ON_PLANE_THRESHOLD) and entry_cmp < 0.0:
+            return False
+        if not zeroish(exit_cmp, ON_PLANE_THRESHOLD) and exit_cmp < 0.0:
+            return False
+
+    return t_entry_max < t_exit_min
+
+# Dot products of ExHx3 vectors with the Hx3 normals, summed in the same
+# x, y, z order as np.dot on single vectors
+def dot_normals(vectors, normals):
+    return (vectors[..., 0] * normals[None, :, 0] +
+        vectors[..., 1] * normals[None, :, 1] +
+        vectors[..., 2] * normals[None, :, 2])
+
+# point_cmp_plane for every pair of Ex3 points and H planes
+def points_cmp_planes(points, origins, normals):
+    return dot_normals(points[:, None, :] - origins[None, :, :], normals)
+
+# Batched edge_inside_polyhedron: clips all E edges (Ex3 starts and ends)
+# against all H halfspaces at once, Cyrus-Beck style, returning E bools. Also
+# returns the E entry and exit parameters along each edge, which are only
+# meaningful where the result is True.
+def edges_inside_polyhedron(starts, ends, normals, dists):
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+    normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+    dists = np.asarray(dists, dtype=np.float64).reshape(-1)
+    origins = normals * dists[:, None]
+
+    start_cmps = points_cmp_planes(starts, origins, normals)
+    end_cmps = points_cmp_planes(ends, origins, normals)
+    coplanar = np.any((np.abs(start_cmps) < COPLANAR_THRESHOLD) & (np.abs(end_cmps) < COPLANAR_THRESHOLD), axis=1)
+
+    line_offsets = ends - starts
+    line_dot_normals = dot_normals(line_offsets[:, None, :], normals)
+    numerators = dot_normals(origins[None, :, :] - starts[:, None, :], normals)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = numerators / line_dot_normals
+    crossing = (line_dot_normals != 0.0) & (t >= 0.0) & (t <= 1.0)
+    entering = line_dot_normals > 0.0
+    t_entry_max = np.max(np.where(crossing & entering, t, -np.inf), axis=1, initial=-np.inf)
+    t_exit_min = np.min(np.where(crossing & ~entering, t, np.inf), axis=1, initial=np.inf)
+    # If we miss the planes then there's no way it can be interecting the volume
+    has_interval = np.isfinite(t_entry_max) & np.isfinite(t_exit_min)
+
+    entry_points = starts + line_offsets * np.where(has_interval, t_entry_max, 0.0)[:, None]
+    exit_points = starts + line_offsets * np.where(has_interval, t_exit_min, 0.0)[:, None]
+    interval = exit_points - entry_points
+    interval_lengths = np.sqrt(interval[:, 0] * interval[:, 0] + interval[:, 1] * interval[:, 1] + interval[:, 2] * interval[:, 2])
+    degenerate = interval_lengths < DEGENERATE_INTERVAL
+
+    # the intersection points may still be outside the volume
+    entry_cmps = points_cmp_planes(entry_points, origins, normals)
+    exit_cmps = points_cmp_planes(exit_points, origins, normals)
+    outside = np.any(
+        ((np.abs(entry_cmps) >= ON_PLANE_THRESHOLD) & (entry_cmps < 0.0)) |
+        ((np.abs(exit_cmps) >= ON_PLANE_THRESHOLD) & (exit_cmps < 0.0)),
+        axis=1
+    )
+
+    inside = ~coplanar & has_interval & ~degenerate & ~outside & (t_entry_max < t_exit_min)
+    return inside, t_entry_max, t_exit_min
+
+@dataclass
+class Detection:
+    plane: int
+    surface: int
+    edge: int
+    leaf: int
+    # bsp3d nodes from the root down to the detected node's parent
+    path: list
+    node: int
+    # front (0) or back (1) side taken at each node of path, which orders
+    # detections the same as a front-first depth-first scan
+    sides: tuple
+    # parameters along the edge where it enters and exits the node's space
+    t_entry: float
+    t_exit: float
+
+    def to_record(self):
+        record = asdict(self)
+        del record["sides"]
+        return record
+
+    def __str__(self):
+        return "Phantom BSP detected: plane={} surface={} edge={} leaf={} path={}/{}".format(
+            self.plane,
+            self.surface,
+            self.edge,
+            self.leaf,
+            "/".join([str(n) for n in self.path]),
+            self.node
+        )
+
+# Counters for the detector's own cost. depth_histogram counts edge clipping
+# calls by the number of halfspaces the edges were clipped against.
+@dataclass
+class ScanStats:
+    nodes_visited: int = 0
+    candidates_checked: int = 0
+    edges_clipped: int = 0
+    depth_histogram: Counter = field(default_factory=Counter)
+
+    def merge(self, other):
+        self.nodes_visited += other.nodes_visited
+        self.candidates_checked += other.candidates_checked
+        self.edges_clipped += other.edges_clipped
+        self.depth_histogram.update(other.depth_histogram)
+
+    def to_record(self):
+        return {
+            "nodes_visited": self.nodes_visited,
+            "candidates_checked": self.candidates_checked,
+            "edges_clipped": self.edges_clipped,
+            "depth_histogram": {str(depth): count for depth, count in sorted(self.depth_histogram.items())},
+        }
+
+# Finds phantom BSP without modifying the tree. Detections only depend on a
+# node's front leaf and its parent halfspaces, so the fix for a detection
+# (setting the -1 back child to the front leaf) can be applied after the scan.
+class PhantomDetector:
+    def __init__(self, collision_bsp, subtree_surfaces=None):
+        self.collision_bsp = collision_bsp
+        # surfaces under each node and the surface defining each node's plane
+        self.subtree_surfaces = subtree_surfaces if subtree_surfaces is not None else SubtreeSurfaces(collision_bsp)
+        self.stats = ScanStats()
+
+    def get_extended_surface_outer_edges(self, plane_surface_index, surface_indices):
+        edges = self.collision_bsp.edges
+        unvisited_surface_indices = set([plane_surface_index])
+        visited_surface_indices = set()
+        outer_edge_indices = set()
+        surface_indices = set(surface_indices)
+
+        while len(unvisited_surface_indices) > 0:
+            surface_index = unvisited_surface_indices.pop()
+            visited_surface_indices.add(surface_index)
+
+            for curr_edge_index in self.collision_bsp.surface_edges(surface_index):
+                curr_edge = edges[curr_edge_index]
+                forward = curr_edge[LEFT_SURFACE] == surface_index
+                neighbour_surface_index = int(curr_edge[RIGHT_SURFACE] if forward else curr_edge[LEFT_SURFACE])
+                if neighbour_surface_index in surface_indices:
+                    if neighbour_surface_index not in visited_surface_indices:
+                        unvisited_surface_indices.add(neighbour_surface_index)
+                else:
+                    outer_edge_indices.add(curr_edge_index)
+
+        return outer_edge_indices
+
+    # True for each edge which passes through the convex polyhedron defined by
+    # node plane half-spaces. It is not considered inside of it is co-planar.
+    # Also returns the entry and exit parameters along each edge.
+    def edges_inside_halfspaces(self, edge_indices, halfspaces):
+        self.stats.edges_clipped += len(edge_indices)
+        self.stats.depth_histogram[len(halfspaces)] += 1
+        edges = self.collision_bsp.edges
+        verts = self.collision_bsp.vertices
+        normals, dists = halfspace_planes(self.collision_bsp, halfspaces)
+        edge_starts = verts[edges[edge_indices, START_VERTEX]]
+        edge_ends = verts[edges[edge_indices, END_VERTEX]]
+        return edges_inside_polyhedron(edge_starts, edge_ends, normals, dists)
+
+    # Returns a Detection if the plane is not obstructed by the surfaces under this node
+    def plane_unoccluded(self, dividing_plane_index, child_bsp3d_node_index, bsp3d_node_index, parent_halfspaces):
+        # meaning of flagged plane index is unknown...
+        if dividing_plane_index & 0x80000000:
+            dividing_plane_index = dividing_plane_index & 0x7FFFFFFF
+            print("UNEXPECTED FLAGGED PLANE: Converting to " + str(dividing_plane_index), file=sys.stderr)
+
+        # first we need the set of all surface indices under this node
+        surface_indices = self.subtree_surfaces.surfaces_under(child_bsp3d_node_index).tolist()
+
+        # Next, identify which surface was used to define parent node's plane
+        plane_surface_index = self.subtree_surfaces.plane_surface(bsp3d_node_index)
+
+        if plane_surface_index == -1:
+            return None
+
+        # Get the bounding edges of the extended surface which was used for the plane
+        outer_edge_indices = self.get_extended_surface_outer_edges(plane_surface_index, surface_indices)
+
+        # todo: ignore cases where surrounding faces are convex
+
+        # If any of the bounding edges pass inside the node's space, then the parent plane is exposed
+        outer_edge_indices = list(outer_edge_indices)
+        edges_inside, t_entry, t_exit = self.edges_inside_halfspaces(outer_edge_indices, parent_halfspaces)
+        for i, outer_edge_index in enumerate(outer_edge_indices):
+            if edges_inside[i]:
+                return Detection(
+                    plane=dividing_plane_index,
+                    surface=plane_surface_index,
+                    edge=outer_edge_index,
+                    leaf=child_bsp3d_node_index & 0x7FFFFFFF,
+                    path=parent_halfspaces.node_path(),
+                    node=bsp3d_node_index,
+                    sides=parent_halfspaces.sides(),
+                    t_entry=float(t_entry[i]),
+                    t_exit=float(t_exit[i]),
+                )
+        return None
+
+    # Walks bsp3d nodes under a node (the root by default) returning detections
+    # in depth-first order, and passing each to on_detection as it's found.
+    # parent_halfspaces are the (plane, is_front, node) halfspaces above the
+    # node. If split_depth is given, nodes at that depth aren't scanned but are
+    # appended to frontier with their parent halfspaces instead.
+    def scan(self, bsp3d_node_index=0, parent_halfspaces=[], split_depth=None, frontier=None, on_detection=None):
+        bsp3d_nodes = self.collision_bsp.bsp3d_nodes
+        detections = []
+
+        def visit(node_index, halfspaces):
+            # Ignore leaves (flagged) and non-existent nodes (-1)
+            if node_index & 0x80000000 != 0:
+                return False
+            if split_depth is not None and len(halfspaces) == split_depth:
+                frontier.append((node_index, halfspaces.to_list()))
+                return False
+            self.stats.nodes_visited += 1
+
+            # Currently just checking for -1 back child and leaf front child, the
+            # most common case. What a -1 front child looks like is unknown and how
+            # to fix it (if it even needs fixing) is TBD with more research.
+            plane, back_child, front_child = bsp3d_nodes[node_index].tolist()
+            if back_child == -1 and front_child & 0x80000000 != 0:
+                self.stats.candidates_checked += 1
+                detection = self.plane_unoccluded(plane, front_child, node_index, halfspaces)
+                if detection is not None:
+                    detections.append(detection)
+                    if on_detection is not None:
+                        on_detection(detection)
+
+        # Shared children only need scanning once, so visit_shared is off
+        walk_bsp3d(bsp3d_nodes, bsp3d_node_index, visit, halfspaces=HalfspaceStack.from_list(parent_halfspaces))
+        return detections
+
+# Halfspace stacks of every path from the root to the given bsp3d nodes, as
+# (node, halfspaces) in depth-first scan order. Paths stop at the first given
+# node on them, since scanning it covers any others below. Only ancestors of
+# the nodes are walked, so this costs the depth of the tree and not its size.
+def paths_to_nodes(collision_bsp, node_indices):
+    nodes = collision_bsp.bsp3d_nodes
+    targets = set(node_indices)
+
+    # parents of each child node through a sorted (child, parent) lookup
+    child_refs = nodes[:, [FRONT_CHILD, BACK_CHILD]].astype(np.int64).reshape(-1)
+    parent_refs = np.repeat(np.arange(len(nodes)), 2)
+    is_node = ~flagged(child_refs)
+    order = np.argsort(child_refs[is_node], kind="stable")
+    sorted_children = child_refs[is_node][order]
+    sorted_parents = parent_refs[is_node][order]
+
+    ancestors = set()
+    unvisited = list(targets)
+    while len(unvisited) > 0:
+        node_index = unvisited.pop()
+        lo, hi = np.searchsorted(sorted_children, [node_index, node_index + 1])
+        for parent_index in sorted_parents[lo:hi].tolist():
+            if parent_index not in ancestors:
+                ancestors.add(parent_index)
+                unvisited.append(parent_index)
+
+    paths = []
+    def visit(child_index, halfspaces):
+        if child_index in targets:
+            paths.append((child_index, halfspaces.to_list()))
+            return False
+        # also skips leaves and -1, which are never ancestors
+        return child_index in ancestors
+    walk_bsp3d(nodes, 0, visit)
+    return paths
+
+# Re-checks for phantom BSP after the given bsp3d nodes of the detector's
+# tree were edited in place (children or planes changed, or nodes appended),
+# given the detections from before the edit. A node's detection only depends
+# on its path and front leaf, so previous detections whose path doesn't pass
+# through an edited node still hold and only the edited subtrees are
+# rescanned. Returns what a full scan of the edited tree would.
+def recheck(detector, modified_nodes, previous_detections):
+    modified_nodes = set(modified_nodes)
+    detector.subtree_surfaces.update_nodes(sorted(modified_nodes))
+
+    detections = [
+        d for d in previous_detections
+        if d.node not in modified_nodes and modified_nodes.isdisjoint(d.path)
+    ]
+    for node_index, halfspaces in paths_to_nodes(detector.collision_bsp, modified_nodes):
+        detections += detector.scan(node_index, halfspaces)
+    detections.sort(key=lambda d: d.sides)
+    return detections
+
+def halfspace_sides(halfspaces):
+    return tuple(0 if is_front else 1 for (_p, is_front, _n) in halfspaces)
+
+# Copies named arrays into one shared memory block. The spec returned by
+# describe() is all a worker process needs to map them back as views.
+class SharedArrays:
+    def __init__(self, arrays):
+        self.layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            # keep every array 8-byte aligned
+            offset = (offset + 7) & ~7
+            self.layout[name] = (offset, array.shape, array.dtype.str)
+            offset += array.nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for name, array in arrays.items():
+            view_array(self.shm, *self.layout[name])[...] = array
+
+    def describe(self):
+        return (self.shm.name, self.layout)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+def view_array(shm, offset, shape, dtype):
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+
+def attach_shared_arrays(spec):
+    shm_name, layout = spec
+    shm = shared_memory.SharedMemory(name=shm_name)
+    return shm, {name: view_array(shm, *entry) for name, entry in layout.items()}
+
+# Per-process detector built from shared memory by init_scan_worker
+worker_shm = None
+worker_detector = None
+
+def init_scan_worker(spec):
+    global worker_shm, worker_detector
+    worker_shm, arrays = attach_shared_arrays(spec)
+    collision_bsp = CollisionBSP({name: arrays[name] for name in CollisionBSP.array_names()}, copy=False)
+    subtree_surfaces = SubtreeSurfaces(collision_bsp, {name: arrays[name] for name in SubtreeSurfaces.ARRAY_NAMES})
+    worker_detector = PhantomDetector(collision_bsp, subtree_surfaces)
+
+def scan_subtree(task):
+    bsp3d_node_index, parent_halfspaces = task
+    worker_detector.stats = ScanStats()
+    detections = worker_detector.scan(bsp3d_node_index, parent_halfspaces)
+    return detections, worker_detector.stats
+
+# Scans the tree with a pool of worker processes. The tree is split into the
+# subtrees at split_depth (by default enough for several per worker); nodes
+# above the split are scanned here. Detections are yielded as each subtree
+# finishes, in the same order a single process scan would produce, and worker
+# counters are merged into detector.stats.
+def scan_parallel(detector, jobs, split_depth=None):
+    if split_depth is None:
+        split_depth = math.ceil(math.log2(jobs)) + 3
+    frontier = []
+    # a front-first depth-first scan visits nodes in order of their sides
+    top_detections = sorted(detector.scan(0, [], split_depth, frontier), key=lambda d: d.sides)
+
+    shared = SharedArrays({**detector.collision_bsp.arrays(), **detector.subtree_surfaces.arrays()})
+    try:
+        with Pool(jobs, initializer=init_scan_worker, initargs=(shared.describe(),)) as pool:
+            results = pool.imap(scan_subtree, frontier)
+            for (_node, parent_halfspaces), (subtree_detections, subtree_stats) in zip(frontier, results):
+                subtree_sides = halfspace_sides(parent_halfspaces)
+                while len(top_detections) > 0 and top_detections[0].sides < subtree_sides:
+                    yield top_detections.pop(0)
+                yield from subtree_detections
+                detector.stats.merge(subtree_stats)
+    finally:
+        shared.close()
+
+    yield from top_detections
@@ -1,160 +1,98 @@
 from reclaimer.hek.defs.sbsp import sbsp_def
-from struct import unpack, pack_into, calcsize
-from types import MethodType
-from typing import Tuple
+from rect_packer import pack, pack_smallest_pow2
+from tag_cache import load_bsp_arrays
+from vert_buffers import rendered_verts, lightmap_verts
 from PIL import Image
-from dataclasses import dataclass
+from scipy.spatial import cKDTree
+from scipy import ndimage
+import numpy as np
 import argparse
 
 DEBUG_MATCH = False
 
-rendered_vert_format = "<3f 3f 3f 3f 2f"
-rendered_vert_size = calcsize(rendered_vert_format)
-rendered_vert_unpacker = MethodType(unpack, rendered_vert_format)
-
-@dataclass
-class RenderedVert:
-    position: Tuple[float, float, float]
-    normal: Tuple[float, float, float]
-    bitangent: Tuple[float, float, float]
-    tangent: Tuple[float, float, float]
-    tex_uv: Tuple[float, float]
-
-    def load(buffer, i):
-        vert_offset = i * rendered_vert_size
-        x,y,z, i,j,k, b0,b1,b2, t0,t1,t2, u,v = rendered_vert_unpacker(buffer[vert_offset: vert_offset + rendered_vert_size])
-        return RenderedVert(position=(x, y, z), normal=(i, j, k), bitangent=(b0, b1, b2), tangent=(t0, t1, t2), tex_uv=(u, v))
-
-lm_vert_format = "<3f 2f"
-lm_vert_size = calcsize(lm_vert_format)
-lm_vert_unpacker = MethodType(unpack, lm_vert_format)
-lm_vert_packer = MethodType(pack_into, lm_vert_format)
-
-@dataclass
-class LightmapVert:
-    incident: Tuple[float, float, float]
-    lm_uv: Tuple[float, float]
-
-    def load(buffer, vert_count, i):
-        lm_vert_offset = vert_count * rendered_vert_size + i * lm_vert_size
-        i,j,k, u,v = lm_vert_unpacker(buffer[lm_vert_offset : lm_vert_offset + lm_vert_size])
-        return LightmapVert(incident=(i, j, k), lm_uv=(u, v))
-    
-    def store(buffer, vert_count, i, lm_vert):
-        lm_vert_offset = vert_count * rendered_vert_size + i * lm_vert_size
-        lm_vert_packer(buffer, lm_vert_offset, lm_vert.incident[0], lm_vert.incident[1], lm_vert.incident[2], lm_vert.lm_uv[0], lm_vert.lm_uv[1])
-    
-@dataclass
-class IndexedVert:
-    rendered: RenderedVert
-    lightmap: LightmapVert
-    bitmap_index: int
-    shader: str
-
-@dataclass
-class QueryVert:
-    position: Tuple[float, float, float]
-    normal: Tuple[float, float, float]
-    shader: str
-    tex_uv: Tuple[float, float]
-
-def build_kd(verts: list[IndexedVert], axis: int):
-    if len(verts) <= 8:
-        return (None, verts)
-    get_pos_on_axis = lambda v: v.rendered.position[axis]
-    verts.sort(key=get_pos_on_axis)
-    i_mid = int(len(verts) / 2)
-    pos_mid = get_pos_on_axis(verts[i_mid])
-    left = build_kd(verts[0 : i_mid], (axis + 1) % 3)
-    right = build_kd(verts[i_mid : len(verts)], (axis + 1) % 3)
-    return (axis, pos_mid, left, right)
-
-def query_kd(node, q: QueryVert, d: float) -> list[IndexedVert]:
-    if node[0] is None:
-        return node[1]
-    axis, v_mid, left, right = node
-    q_axis_pos = q.position[axis]
-    results = []
-    if q_axis_pos - d <= v_mid:
-        results += query_kd(left, q, d)
-    if q_axis_pos + d >= v_mid:
-        results += query_kd(right, q, d)
-    return results
-
-
-def sqdst3d(a, b):
-    a0, a1, a2 = a
-    b0, b1, b2 = b
-    return (a0 - b0) * (a0 - b0) + (a1 - b1) * (a1 - b1) + (a2 - b2) * (a2 - b2)
-
-def dot3d(a, b):
-    a0, a1, a2 = a
-    b0, b1, b2 = b
-    return (a0 * b0) + (a1 * b1) + (a2 * b2)
-
-def sqdst2d(a, b):
-    if a is None or b is None:
-        return 0
-    a0, a1 = a
-    b0, b1 = b
-    return (a0 - b0) * (a0 - b0) + (a1 - b1) * (a1 - b1)
-
-def find_match(src_kd, q: QueryVert, d: float, orig_bitmap_index: int, prev_matched_bitmap_index: int, prev_matched_lm_uv) -> IndexedVert:
-    candidates = query_kd(src_kd, q, d)
-
-    shader_pred = lambda c: c.shader == q.shader
-    dist_pred = lambda c: sqdst3d(q.position, c.rendered.position) <= d * d
-    normal_pred = lambda c: sqdst3d(q.normal, c.rendered.normal) < 0.001
-    tex_uv_pred = lambda c: sqdst2d(q.tex_uv, c.rendered.tex_uv) < 0.001
-    rate = lambda c: sqdst2d(prev_matched_lm_uv, c.lightmap.lm_uv)
-
-    candidates = list(filter(
-        lambda c:
-            shader_pred(c) and
-            dist_pred(c) and
-            normal_pred(c) and
-            tex_uv_pred(c),
-        candidates
-    ))
-    if len(candidates) == 0:
-        raise Exception("No candidates found for a vert. Increase d")
-    
-    candidates.sort(key=rate)
-    best_match: IndexedVert = candidates[0]
-    
-    if DEBUG_MATCH and orig_bitmap_index != best_match.bitmap_index:
-        print(f"\nquery: {q} {orig_bitmap_index} {prev_matched_bitmap_index}")
-        for c in candidates:
-            print(f"\ncandidate: {c}")
-        raise Exception("Bitmap index mismatch")
-    return best_match
-
-def load_src_verts(bsp_path):
-    bsp_tag = sbsp_def.build(filepath=bsp_path)
-    bsp = bsp_tag.data.tagdata
-    all_verts = []
-
-    for lightmap in bsp.lightmaps.STEPTREE:
-        # skip add-blended shaders like lights; they have no lightmaps
-        if lightmap.bitmap_index == -1:
-            continue
-        for material in lightmap.materials.STEPTREE:
-            vert_count = material.vertices_count # rendered verts count
-            lm_vert_count = material.lightmap_vertices_count # lm verts count
-            assert vert_count == lm_vert_count
-            vert_buffer = material.uncompressed_vertices.STEPTREE
-            for i in range(vert_count):
-                all_verts.append(IndexedVert(
-                    rendered=RenderedVert.load(vert_buffer, i),
-                    lightmap=LightmapVert.load(vert_buffer, vert_count, i),
-                    bitmap_index=lightmap.bitmap_index,
-                    shader=material.shader.filepath,
-                ))
-    return build_kd(all_verts, 0)
-
-def port_lm(src_bsp_path, dst_bsp_path, d, uv_transforms):
+# Source lightmap verts stored as contiguous arrays for batched matching.
+# Shaders are interned to integer ids so the shader predicate can be applied
+# as a vectorized mask alongside the normal and texture UV predicates.
+class VertIndex:
+    def __init__(self, positions, normals, tex_uvs, incidents, lm_uvs, bitmap_indices, shaders):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+        self.tex_uvs = np.asarray(tex_uvs, dtype=np.float64).reshape(-1, 2)
+        self.incidents = np.asarray(incidents, dtype=np.float64).reshape(-1, 3)
+        self.lm_uvs = np.asarray(lm_uvs, dtype=np.float64).reshape(-1, 2)
+        self.bitmap_indices = np.asarray(bitmap_indices, dtype=np.int32)
+        self.shader_ids = {}
+        self.shaders = np.array([self.shader_ids.setdefault(s, len(self.shader_ids)) for s in shaders], dtype=np.int32)
+        self.tree = cKDTree(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Returns an array of candidate source vert indices for each query vert,
+    # already filtered by distance, shader, normal, and texture UV similarity
+    def query(self, positions, normals, tex_uvs, shader, d):
+        shader_id = self.shader_ids.get(shader)
+        if shader_id is None or len(positions) == 0:
+            return [np.empty(0, dtype=np.intp) for _ in range(len(positions))]
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+        tex_uvs = np.asarray(tex_uvs, dtype=np.float64).reshape(-1, 2)
+
+        neighbours = self.tree.query_ball_point(positions, d, return_sorted=True)
+        counts = np.fromiter((len(n) for n in neighbours), dtype=np.intp, count=len(neighbours))
+        flat = np.fromiter((c for n in neighbours for c in n), dtype=np.intp, count=counts.sum())
+        owner = np.repeat(np.arange(len(positions)), counts)
+
+        normal_dst = np.sum((self.normals[flat] - normals[owner]) ** 2, axis=1)
+        tex_uv_dst = np.sum((self.tex_uvs[flat] - tex_uvs[owner]) ** 2, axis=1)
+        mask = (self.shaders[flat] == shader_id) & (normal_dst < 0.001) & (tex_uv_dst < 0.001)
+
+        kept_counts = np.bincount(owner[mask], minlength=len(positions))
+        return np.split(flat[mask], np.cumsum(kept_counts)[:-1])
+
+# Picks the best candidate for each query vert. Candidates are rated by how
+# close their lightmap UV is to the previous vert's match, since adjacent verts
+# in a material tend to belong to the same lightmap page region.
+def find_matches(src_index: VertIndex, candidates, orig_bitmap_index: int):
+    matches = np.empty(len(candidates), dtype=np.intp)
+    prev_matched_lm_uv = None
+    for i, vert_candidates in enumerate(candidates):
+        if len(vert_candidates) == 0:
+            raise Exception("No candidates found for a vert. Increase d")
+        if prev_matched_lm_uv is None:
+            best_match = vert_candidates[0]
+        else:
+            rate = np.sum((src_index.lm_uvs[vert_candidates] - prev_matched_lm_uv) ** 2, axis=1)
+            best_match = vert_candidates[np.argmin(rate)]
+
+        if DEBUG_MATCH and orig_bitmap_index != src_index.bitmap_indices[best_match]:
+            print(f"\nquery: {i} {orig_bitmap_index} {src_index.bitmap_indices[matches[i - 1]] if i > 0 else None}")
+            for c in vert_candidates:
+                print(f"\ncandidate: {c} {src_index.positions[c]} {src_index.lm_uvs[c]} {src_index.bitmap_indices[c]}")
+            raise Exception("Bitmap index mismatch")
+        matches[i] = best_match
+        prev_matched_lm_uv = src_index.lm_uvs[best_match]
+    return matches
+
+def load_src_verts(bsp_path, use_cache=True):
+    arrays = load_bsp_arrays(bsp_path, use_cache)
+    material_bitmap_indices = arrays["lightmap_bitmap_indices"][arrays["material_lightmaps"]]
+    material_vert_counts = arrays["material_vert_counts"]
+    material_lm_vert_counts = arrays["material_lm_vert_counts"]
+
+    # skip add-blended shaders like lights; they have no lightmaps, so no lm verts
+    lit_materials = material_bitmap_indices != -1
+    lit_vert_counts = material_vert_counts[lit_materials]
+    assert np.array_equal(lit_vert_counts, material_lm_vert_counts[lit_materials])
+    rendered = arrays["rendered_verts"][np.repeat(lit_materials, material_vert_counts)]
+    lm = arrays["lm_verts"][np.repeat(lit_materials, material_lm_vert_counts)]
+    vert_bitmap_indices = np.repeat(material_bitmap_indices[lit_materials], lit_vert_counts)
+    vert_shaders = np.repeat(arrays["material_shaders"][lit_materials], lit_vert_counts)
+    return VertIndex(rendered["position"], rendered["normal"], rendered["tex_uv"], lm["incident"], lm["lm_uv"], vert_bitmap_indices, vert_shaders.tolist())
+
+def port_lm(src_bsp_path, dst_bsp_path, d, uv_transforms, use_cache=True):
     print("Porting lightmap UVs")
-    src_kd = load_src_verts(src_bsp_path)
+    src_index = load_src_verts(src_bsp_path, use_cache)
     dst_bsp_tag = sbsp_def.build(filepath=dst_bsp_path)
     dst_bsp = dst_bsp_tag.data.tagdata
 
@@ -169,104 +107,100 @@ def port_lm(src_bsp_path, dst_bsp_path, d, uv_transforms):
             vert_count = material.vertices_count  # rendered verts count
             lm_vert_count = material.lightmap_vertices_count # lm verts count
             assert vert_count == lm_vert_count
-            vert_buffer = material.uncompressed_vertices.STEPTREE  # rendered verts buffer
-
-            prev_matched_bitmap_index = None
-            prev_matched_lm_uv = None
+            rendered = rendered_verts(material)
+            lm = lightmap_verts(material)
 
             print(f"Updating {vert_count} lightmap UVs for material {i_material}")
-            for i in range(vert_count):
-                rendered_vert = RenderedVert.load(vert_buffer, i)
-                query_vert = QueryVert(
-                    position=rendered_vert.position,
-                    normal=rendered_vert.normal,
-                    shader=material.shader.filepath,
-                    tex_uv=rendered_vert.tex_uv
-                )
+            candidates = src_index.query(rendered["position"], rendered["normal"], rendered["tex_uv"], material.shader.filepath, d)
+            matches = find_matches(src_index, candidates, orig_bitmap_index)
 
-                match = find_match(src_kd, query_vert, d, orig_bitmap_index, prev_matched_bitmap_index, prev_matched_lm_uv)
-                prev_matched_bitmap_index = match.bitmap_index
-                prev_matched_lm_uv = match.lightmap.lm_uv
-                transformed_uv = uv_transforms[match.bitmap_index](match.lightmap.lm_uv)
+            # transform each matched UV into its page's region of the uberlightmap
+            lm_uvs = src_index.lm_uvs[matches]
+            matched_bitmap_indices = src_index.bitmap_indices[matches]
+            for bitmap_index in np.unique(matched_bitmap_indices):
+                page_mask = matched_bitmap_indices == bitmap_index
+                lm_uvs[page_mask] = uv_transforms[bitmap_index](lm_uvs[page_mask])
 
-                LightmapVert.store(vert_buffer, vert_count, i, LightmapVert(
-                    incident=match.lightmap.incident,
-                    lm_uv=transformed_uv
-                ))
+            # lm views alias the tag's vertex buffer, so this writes the tag data
+            lm["incident"] = src_index.incidents[matches]
+            lm["lm_uv"] = lm_uvs
 
     print(f"Writing BSP tag to {dst_bsp_path}")
     dst_bsp_tag.serialize(backup=False, temp=False)
 
-def is_gap(img, x, y):
-    r, g, b, a = img.getpixel((x, y))
-    return (r == 0 and g == 0 and b == 255) or a == 0
-
-def is_vacant(dst_pages, x, y):
-    for dst_page in dst_pages:
-        dst_min_x, dst_min_y = dst_page[0]
-        dst_max_x, dst_max_y = dst_page[1]
-        if x >= dst_min_x and x < dst_max_x and y >= dst_min_y and y < dst_max_y:
-            return False
-    return True
-
-def is_vacant_rect(dst_pages, x_min, y_min, w, h):
-    for ty in range(y_min, y_min + h):
-        for tx in range(x_min, x_min + w):
-            if not is_vacant(dst_pages, tx, ty):
-                return False
-    return True
-
-def find_vacancy(dst_pages, dst_w, dst_h, page_w, page_h):
-    for dst_min_y in range(0, dst_h - page_h):
-        for dst_min_x in range(0, dst_w - page_w):
-            if is_vacant_rect(dst_pages, dst_min_x, dst_min_y, page_w, page_h):
-                return [(dst_min_x, dst_min_y), (dst_min_x + page_w, dst_min_y + page_h)]
-    return None
-
-def flatten_lm_bitmap(src_tif_path, dst_tif_path, dst_w, dst_h):
-    dst_img = Image.new("RGBA", (dst_w, dst_h))
-
+# Gaps between pages are pure blue or fully transparent
+def gap_mask(img):
+    pixels = np.asarray(img.convert("RGBA"))
+    r, g, b, a = pixels[..., 0], pixels[..., 1], pixels[..., 2], pixels[..., 3]
+    return ((r == 0) & (g == 0) & (b == 255)) | (a == 0)
+
+# Merges (min_x, min_y, max_x, max_y) boxes which overlap into their bounding
+# boxes. Overlapping pairs are found by sweeping the boxes in x order and
+# joined with union-find; a merged box can grow into one it didn't overlap
+# before, so this repeats until nothing merges, which is almost always once.
+def merge_overlapping(boxes):
+    while True:
+        parents = list(range(len(boxes)))
+        def root(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+        active = []
+        for i in sorted(range(len(boxes)), key=lambda i: boxes[i][0]):
+            a = boxes[i]
+            active = [j for j in active if boxes[j][2] > a[0]]
+            for j in active:
+                if a[1] < boxes[j][3] and boxes[j][1] < a[3]:
+                    parents[root(j)] = root(i)
+            active.append(i)
+        groups = {}
+        for i, box in enumerate(boxes):
+            groups.setdefault(root(i), []).append(box)
+        if len(groups) == len(boxes):
+            return boxes
+        boxes = [(min(b[0] for b in group), min(b[1] for b in group), max(b[2] for b in group), max(b[3] for b in group)) for group in groups.values()]
+
+# Finds page rectangles as [(min_x, min_y), (max_x, max_y), bitmap_index] with
+# exclusive maxes. Pages are the bounding boxes of edge-connected non-gap
+# regions, numbered in reading order (top to bottom, then left to right) to
+# match the order the source plate was laid out in.
+def find_pages(img):
+    labels, _count = ndimage.label(~gap_mask(img))
+    boxes = [(s[1].start, s[0].start, s[1].stop, s[0].stop) for s in ndimage.find_objects(labels) if s is not None]
+
+    # merge boxes which overlap, in case a page contains gap-coloured pixels
+    boxes = merge_overlapping(boxes)
+
+    boxes.sort(key=lambda box: (box[1], box[0]))
+    return [[(min_x, min_y), (max_x, max_y), bitmap_index] for bitmap_index, (min_x, min_y, max_x, max_y) in enumerate(boxes)]
+
+# When auto_size is set, dst_w and dst_h are the largest plate allowed and the
+# smallest power-of-two plate which fits all pages is used instead
+def flatten_lm_bitmap(src_tif_path, dst_tif_path, dst_w, dst_h, auto_size=False):
     src_img = Image.open(src_tif_path)
     src_w = src_img.size[0]
     src_h = src_img.size[1]
     print(f"Lightmap source plate is {src_w}x{src_h}")
-    src_pages = []
-    
-    # find pages
-    border = 1
-    in_gap = True
-    bitmap_index = 0
-    for y in range(border, src_h):
-        found_gap_y = is_gap(src_img, border, y)
-        if in_gap and not found_gap_y:
-            src_pages.append([(border, y), None, bitmap_index])
-            in_gap = False
-            bitmap_index += 1
-        elif not in_gap and found_gap_y:
-            for x in range(border, src_w):
-                if is_gap(src_img, x, y - 1):
-                    src_pages[-1][1] = (x, y)
-                    break
-                assert x != src_w - 1
-            in_gap = True
+    src_pages = find_pages(src_img)
     print(f"Found {len(src_pages)} pages")
 
     # pack pages into destination texture
-    total_page_area = 0
-    dst_area = dst_w * dst_h
     src_pages.sort(reverse=True, key=lambda pg: (pg[1][0] - pg[0][0]) * (pg[1][1] - pg[0][1]))
-    dst_pages = []
-    for src_page in src_pages:
-        src_min_x, src_min_y = src_page[0]
-        src_max_x, src_max_y = src_page[1]
-        page_w = src_max_x - src_min_x
-        page_h = src_max_y - src_min_y
-        vacancy = find_vacancy(dst_pages, dst_w, dst_h, page_w, page_h)
-        if vacancy is None:
+    page_sizes = [(pg[1][0] - pg[0][0], pg[1][1] - pg[0][1]) for pg in src_pages]
+    if auto_size:
+        packed = pack_smallest_pow2(page_sizes, dst_w, dst_h)
+        if packed is None:
+            raise Exception(f"Couldn't pack all pages into any plate up to {dst_w}x{dst_h}. Increase dimensions")
+        dst_w, dst_h, packer, origins = packed
+    else:
+        packed = pack(page_sizes, dst_w, dst_h)
+        if packed is None:
             raise Exception("Couldn't pack all pages. Increase dimensions")
-        total_page_area += page_w * page_h
-        dst_pages.append(vacancy)
-    print(f"Packed pages, with utilization: {total_page_area / dst_area}")
+        packer, origins = packed
+    dst_pages = [[(x, y), (x + w, y + h)] for (x, y), (w, h) in zip(origins, page_sizes)]
+    print(f"Packed pages into {dst_w}x{dst_h}, with utilization: {packer.utilization()}")
+    dst_img = Image.new("RGBA", (dst_w, dst_h))
 
     # copy to dst and build UV transforms
     print("Copying pages and creating UV transforms")
@@ -287,24 +221,28 @@ def flatten_lm_bitmap(src_tif_path, dst_tif_path, dst_w, dst_h):
         region = src_img.crop(src_box)
         dst_img.paste(region, dst_box)
 
+        # works on a single (u, v) or an Nx2 array of UVs
         uv_transform = (
-            lambda page_w,dst_min_x,dst_w,page_h,dst_min_y,dst_h: lambda uv: ((uv[0] * page_w + dst_min_x) / dst_w, (uv[1] * page_h + dst_min_y) / dst_h)
+            lambda page_w,dst_min_x,dst_w,page_h,dst_min_y,dst_h: lambda uv: (np.asarray(uv) * (page_w, page_h) + (dst_min_x, dst_min_y)) / (dst_w, dst_h)
         )(page_w,dst_min_x,dst_w,page_h,dst_min_y,dst_h)
         uv_transforms[bitmap_index] = uv_transform
     
     dst_img.save(dst_tif_path)
     return uv_transforms
 
-parser = argparse.ArgumentParser()
-parser.add_argument("src", help="Path to the donor BSP tag")
-parser.add_argument("dst", help="Path to the receiver BSP tag")
-parser.add_argument("d", type=float, help="Search distance")
-parser.add_argument("src_tif", help="Path to the lightmap tiff source plate")
-parser.add_argument("dst_tif", help="Path to write the flattened lightmap")
-parser.add_argument("dst_w", type=int, help="Width of flattened lightmap")
-parser.add_argument("dst_h", type=int, help="Width of flattened lightmap")
-args = parser.parse_args()
-
-uv_transforms = flatten_lm_bitmap(args.src_tif, args.dst_tif, args.dst_w, args.dst_h)
-port_lm(args.src, args.dst, args.d, uv_transforms)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src", help="Path to the donor BSP tag")
+    parser.add_argument("dst", help="Path to the receiver BSP tag")
+    parser.add_argument("d", type=float, help="Search distance")
+    parser.add_argument("src_tif", help="Path to the lightmap tiff source plate")
+    parser.add_argument("dst_tif", help="Path to write the flattened lightmap")
+    parser.add_argument("dst_w", type=int, help="Width of flattened lightmap")
+    parser.add_argument("dst_h", type=int, help="Height of flattened lightmap")
+    parser.add_argument("--no-cache", action="store_true", help="Always fully parse the donor BSP instead of using cached arrays")
+    parser.add_argument("--auto-size", action="store_true", help="Use the smallest power-of-two plate up to dst_w x dst_h which fits all pages")
+    args = parser.parse_args()
+
+    uv_transforms = flatten_lm_bitmap(args.src_tif, args.dst_tif, args.dst_w, args.dst_h, args.auto_size)
+    port_lm(args.src, args.dst, args.d, uv_transforms, not args.no_cache)
 
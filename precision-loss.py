@@ -0,0 +1,141 @@
+from collision_bsp import CollisionBSP, SURFACE_PLANE, START_VERTEX, END_VERTEX, INDEX_MASK
+from insanity import LevelTransform, translation_matrix
+from tag_cache import load_bsp_arrays
+from time import perf_counter
+import numpy as np
+import argparse
+import json
+
+# Measures how much of a BSP survives being moved by insanity.py. The tag
+# stores float32, so each translated vertex, plane distance and render vertex
+# position is rounded to the nearest float32 in the new location; this
+# compares those against the exact float64 values for any number of offsets.
+
+# Histogram bin edges for errors and distances: exactly zero, then decades
+# from 1e-9 up, with the last bin catching everything from 1 world unit
+HISTOGRAM_DECADES = np.arange(-9, 1)
+# Vertices further than this from their surface's plane count as off it
+DEFAULT_TOLERANCE = 0.001
+
+def quantize(values):
+    return values.astype(np.float32).astype(np.float64)
+
+# Counts of values which are zero, then below 1e-9, 1e-8, ... 1, then at least 1
+def error_histogram(values):
+    values = np.asarray(values, dtype=np.float64)
+    nonzero = values[values > 0.0]
+    bins = np.searchsorted(HISTOGRAM_DECADES, np.floor(np.log10(nonzero)), side="right")
+    return [int(np.sum(values == 0.0))] + np.bincount(bins, minlength=len(HISTOGRAM_DECADES) + 1).tolist()
+
+def histogram_labels():
+    return ["0"] + ["<1e{}".format(d) for d in HISTOGRAM_DECADES] + [">=1"]
+
+def error_stats(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "count": len(values),
+        "max": float(values.max(initial=0.0)),
+        "mean": float(values.mean()) if len(values) > 0 else 0.0,
+        "histogram": error_histogram(values),
+    }
+
+# Offsets from --offset and --sweep, in order
+def parse_offsets(offsets, sweeps):
+    result = [np.array(offset, dtype=np.float64) for offset in (offsets or [])]
+    for x, y, z, steps in (sweeps or []):
+        steps = int(steps)
+        if steps < 1:
+            raise Exception("sweep needs at least one step, not " + str(steps))
+        result.extend(np.array([x, y, z]) * (i / steps) for i in range(1, steps + 1))
+    return result
+
+class PrecisionAnalyzer:
+    def __init__(self, bsp_arrays, tolerance=DEFAULT_TOLERANCE):
+        self.collision_bsp = CollisionBSP.from_bsp_arrays(bsp_arrays)
+        self.tolerance = tolerance
+        self.vertices = self.collision_bsp.vertices.astype(np.float64)
+        self.planes = self.collision_bsp.planes.astype(np.float64)
+        self.render_positions = bsp_arrays["rendered_verts"]["position"].astype(np.float64)
+
+        pair_surfaces, self.pair_vertices = self.collision_bsp.surface_vertex_pairs()
+        self.pair_planes = self.collision_bsp.surfaces[pair_surfaces, SURFACE_PLANE].astype(np.int64) & INDEX_MASK
+        self.edge_ends = self.collision_bsp.edges[:, [START_VERTEX, END_VERTEX]].astype(np.int64)
+        self.original_edge_lengths = self.edge_lengths(self.vertices)
+        self.original_plane_distances = self.plane_distances(self.vertices, self.planes)
+
+    def edge_lengths(self, vertices):
+        return np.linalg.norm(vertices[self.edge_ends[:, 1]] - vertices[self.edge_ends[:, 0]], axis=1)
+
+    # Distance of each surface's vertices from the surface's plane
+    def plane_distances(self, vertices, planes):
+        pair_planes = planes[self.pair_planes]
+        return np.abs(np.einsum("ij,ij->i", vertices[self.pair_vertices], pair_planes[:, 0:3]) - pair_planes[:, 3])
+
+    def analyze(self, offset):
+        transform = LevelTransform(translation_matrix(offset))
+        exact_vertices = transform.points(self.vertices)
+        vertices = quantize(exact_vertices)
+        exact_planes = transform.planes(self.planes)
+        planes = quantize(exact_planes)
+        exact_render_positions = transform.points(self.render_positions)
+        render_positions = quantize(exact_render_positions)
+
+        plane_distances = self.plane_distances(vertices, planes)
+        edge_lengths = self.edge_lengths(vertices)
+        return {
+            "offset": offset.tolist(),
+            "collision_vertex_error": error_stats(np.linalg.norm(vertices - exact_vertices, axis=1)),
+            "plane_d_error": error_stats(np.abs(planes[:, 3] - exact_planes[:, 3])),
+            "render_vertex_error": error_stats(np.linalg.norm(render_positions - exact_render_positions, axis=1)),
+            "plane_vertex_distance": {
+                **error_stats(plane_distances),
+                "max_increase": float(np.max(plane_distances - self.original_plane_distances, initial=0.0)),
+                "off_plane": int(np.sum(plane_distances > self.tolerance)),
+                "off_plane_before": int(np.sum(self.original_plane_distances > self.tolerance)),
+            },
+            "collapsed_edges": int(np.sum((edge_lengths == 0.0) & (self.original_edge_lengths > 0.0))),
+        }
+
+def format_stats(name, stats):
+    return "  {:<24} max {:<10.3g} mean {:<10.3g} {}".format(name, stats["max"], stats["mean"], " ".join(str(c) for c in stats["histogram"]))
+
+def format_record(record):
+    distances = record["plane_vertex_distance"]
+    return "\n".join([
+        "Offset ({:g}, {:g}, {:g}):".format(*record["offset"]),
+        format_stats("collision vertex error", record["collision_vertex_error"]),
+        format_stats("plane d error", record["plane_d_error"]),
+        format_stats("render vertex error", record["render_vertex_error"]),
+        format_stats("vertex-plane distance", distances),
+        "  {} surface vertices off their plane (was {}), largest increase {:.3g}; {} collapsed edges".format(
+            distances["off_plane"], distances["off_plane_before"], distances["max_increase"], record["collapsed_edges"]),
+    ])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure float32 precision loss from translating a BSP with insanity.py")
+    parser.add_argument("bsp", help="Path to the BSP file to analyze")
+    parser.add_argument("--offset", type=float, nargs=3, action="append", metavar=("X", "Y", "Z"), help="Offset to analyze; can be given more than once")
+    parser.add_argument("--sweep", type=float, nargs=4, action="append", metavar=("X", "Y", "Z", "STEPS"), help="Analyze STEPS evenly spaced offsets from the origin out to (X, Y, Z)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Distance from its surface's plane at which a vertex counts as off it")
+    parser.add_argument("--format", choices=["text", "ndjson"], default="text", help="Output format")
+    parser.add_argument("--no-cache", action="store_true", help="Parse the tag instead of using the tag cache")
+    args = parser.parse_args()
+
+    offsets = parse_offsets(args.offset, args.sweep)
+    if len(offsets) == 0:
+        parser.error("give at least one --offset or --sweep")
+    start = perf_counter()
+    analyzer = PrecisionAnalyzer(load_bsp_arrays(args.bsp, use_cache=not args.no_cache), args.tolerance)
+    if args.format == "text":
+        print("Histogram bins: " + " ".join(histogram_labels()))
+    for offset in offsets:
+        record = analyzer.analyze(offset)
+        if args.format == "ndjson":
+            print(json.dumps({"type": "offset", **record}))
+        else:
+            print(format_record(record))
+    elapsed = perf_counter() - start
+    if args.format == "ndjson":
+        print(json.dumps({"type": "summary", "offsets": len(offsets), "seconds": elapsed}))
+    else:
+        print("Analyzed {} offsets in {:.3f}s".format(len(offsets), elapsed))
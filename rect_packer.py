@@ -0,0 +1,101 @@
+# MaxRects rectangle packing with the best-short-side-fit heuristic.
+# See: Jukka Jylänki, "A Thousand Ways to Pack the Bin"
+# Rectangles are (x, y, w, h) tuples. Pages are never rotated since the UV
+# transforms built from placements only scale and offset.
+
+class MaxRectsPacker:
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        # maximal free rectangles; together these are the unoccupied area
+        self.free_rects = [(0, 0, w, h)]
+        self.used_area = 0
+
+    def utilization(self):
+        return self.used_area / (self.w * self.h)
+
+    # Places a w*h rectangle and returns its (x, y) origin, or None if it doesn't fit
+    def insert(self, w, h):
+        best = None
+        best_short_side = None
+        best_long_side = None
+        for free_x, free_y, free_w, free_h in self.free_rects:
+            if w > free_w or h > free_h:
+                continue
+            leftover_x = free_w - w
+            leftover_y = free_h - h
+            short_side = min(leftover_x, leftover_y)
+            long_side = max(leftover_x, leftover_y)
+            if best is None or (short_side, long_side) < (best_short_side, best_long_side):
+                best = (free_x, free_y, w, h)
+                best_short_side = short_side
+                best_long_side = long_side
+        if best is None:
+            return None
+        self._occupy(best)
+        return (best[0], best[1])
+
+    def _occupy(self, used):
+        used_x, used_y, used_w, used_h = used
+        split_rects = []
+        for free in self.free_rects:
+            free_x, free_y, free_w, free_h = free
+            if (used_x >= free_x + free_w or used_x + used_w <= free_x or
+                    used_y >= free_y + free_h or used_y + used_h <= free_y):
+                split_rects.append(free)
+                continue
+            # keep the parts of the free rect left, right, above and below the used rect
+            if used_x > free_x:
+                split_rects.append((free_x, free_y, used_x - free_x, free_h))
+            if used_x + used_w < free_x + free_w:
+                split_rects.append((used_x + used_w, free_y, free_x + free_w - used_x - used_w, free_h))
+            if used_y > free_y:
+                split_rects.append((free_x, free_y, free_w, used_y - free_y))
+            if used_y + used_h < free_y + free_h:
+                split_rects.append((free_x, used_y + used_h, free_w, free_y + free_h - used_y - used_h))
+        self.free_rects = prune_contained(split_rects)
+        self.used_area += used_w * used_h
+
+def contains(outer, inner):
+    outer_x, outer_y, outer_w, outer_h = outer
+    inner_x, inner_y, inner_w, inner_h = inner
+    return (inner_x >= outer_x and inner_y >= outer_y and
+        inner_x + inner_w <= outer_x + outer_w and inner_y + inner_h <= outer_y + outer_h)
+
+# Drops free rects fully covered by another so the list stays maximal
+def prune_contained(rects):
+    rects = list(dict.fromkeys(rects))
+    rects.sort(key=lambda r: r[2] * r[3], reverse=True)
+    kept = []
+    for rect in rects:
+        if not any(contains(k, rect) for k in kept):
+            kept.append(rect)
+    return kept
+
+# Packs (w, h) sizes in the given order. Returns the packer and a list of
+# (x, y) origins, or None if any rectangle doesn't fit.
+def pack(sizes, dst_w, dst_h):
+    packer = MaxRectsPacker(dst_w, dst_h)
+    origins = []
+    for w, h in sizes:
+        origin = packer.insert(w, h)
+        if origin is None:
+            return None
+        origins.append(origin)
+    return packer, origins
+
+# Tries power-of-two plates from smallest to largest area (squarer first),
+# up to max_w*max_h, and returns (dst_w, dst_h, packer, origins) for the first fit
+def pack_smallest_pow2(sizes, max_w, max_h):
+    total_area = sum(w * h for w, h in sizes)
+    min_w = max((w for w, _h in sizes), default=1)
+    min_h = max((h for _w, h in sizes), default=1)
+    pow2_w = [1 << i for i in range(max_w.bit_length()) if min_w <= 1 << i <= max_w]
+    pow2_h = [1 << i for i in range(max_h.bit_length()) if min_h <= 1 << i <= max_h]
+    plates = [(w, h) for w in pow2_w for h in pow2_h if w * h >= total_area]
+    plates.sort(key=lambda p: (p[0] * p[1], max(p) / min(p), -p[0]))
+    for dst_w, dst_h in plates:
+        result = pack(sizes, dst_w, dst_h)
+        if result is not None:
+            return (dst_w, dst_h, *result)
+    return None
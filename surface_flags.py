@@ -0,0 +1,130 @@
+from reclaimer.hek.defs.sbsp import sbsp_def
+from collision_bsp import CollisionBSP, SURFACE_PLANE, SURFACE_FLAGS, MATERIAL, TWO_SIDED, INVISIBLE, CLIMBABLE, BREAKABLE, flagged, unflag
+import numpy as np
+import argparse
+
+# Bulk edits of collision surface flags and material indices. Surfaces are
+# selected by predicates evaluated over the whole surface array at once, and
+# all selected surfaces are edited as one array operation before the changed
+# rows are written back to the tag.
+
+FLAG_BITS = {
+    "two_sided": TWO_SIDED,
+    "invisible": INVISIBLE,
+    "climbable": CLIMBABLE,
+    "breakable": BREAKABLE,
+}
+
+def flag_mask(flag_names):
+    mask = 0
+    for name in flag_names:
+        if name not in FLAG_BITS:
+            raise Exception("Unknown surface flag " + name + ", expected one of " + ", ".join(FLAG_BITS))
+        mask |= FLAG_BITS[name]
+    return mask
+
+# Facing normal of each surface: its plane's normal, reversed for surfaces on
+# the back of their plane
+def surface_normals(collision_bsp):
+    surface_planes = collision_bsp.surfaces[:, SURFACE_PLANE]
+    normals = collision_bsp.planes[unflag(surface_planes), 0:3].astype(np.float64)
+    return np.where(flagged(surface_planes)[:, None], -normals, normals)
+
+# (min, max) corners of each surface's vertices, as two Nx3 arrays
+def surface_bounds(collision_bsp):
+    surface_count = len(collision_bsp.surfaces)
+    pair_surfaces, pair_vertices = collision_bsp.surface_vertex_pairs()
+    vertices = collision_bsp.vertices[pair_vertices].astype(np.float64)
+    mins = np.full((surface_count, 3), np.inf)
+    maxs = np.full((surface_count, 3), -np.inf)
+    np.minimum.at(mins, pair_surfaces, vertices)
+    np.maximum.at(maxs, pair_surfaces, vertices)
+    return mins, maxs
+
+# Boolean mask of the surfaces matching every given predicate:
+# * normal_angle: (min, max) degrees between the surface's facing normal and axis
+# * bbox: (min x, y, z, max x, y, z) the surface's bounds must overlap
+# * materials, leaves, surfaces: indices the surface's material, leaf or own
+#   index must be among
+# * has_flags, lacks_flags: flag names the surface must all have or all lack
+def select_surfaces(collision_bsp, normal_angle=None, axis=(0.0, 0.0, 1.0), bbox=None, materials=None, leaves=None, surfaces=None, has_flags=(), lacks_flags=()):
+    surface_count = len(collision_bsp.surfaces)
+    selected = np.ones(surface_count, dtype=bool)
+    if normal_angle is not None:
+        axis = np.asarray(axis, dtype=np.float64)
+        cosines = surface_normals(collision_bsp) @ (axis / np.linalg.norm(axis))
+        angles = np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0)))
+        selected &= (angles >= normal_angle[0]) & (angles <= normal_angle[1])
+    if bbox is not None:
+        mins, maxs = surface_bounds(collision_bsp)
+        selected &= np.all((mins <= np.asarray(bbox[3:6])) & (maxs >= np.asarray(bbox[0:3])), axis=1)
+    if materials is not None:
+        selected &= np.isin(collision_bsp.surfaces[:, MATERIAL], materials)
+    if leaves is not None:
+        leaf_surfaces = [s for leaf_index in leaves for s in collision_bsp.leaf_surfaces(leaf_index)]
+        selected &= np.isin(np.arange(surface_count), leaf_surfaces)
+    if surfaces is not None:
+        selected &= np.isin(np.arange(surface_count), surfaces)
+    flags = collision_bsp.surfaces[:, SURFACE_FLAGS]
+    selected &= flags & flag_mask(has_flags) == flag_mask(has_flags)
+    selected &= flags & flag_mask(lacks_flags) == 0
+    return selected
+
+# Sets and clears flags and sets the material of the selected surfaces in the
+# collision BSP's arrays, returning the mask of surfaces which changed
+def edit_surfaces(collision_bsp, selected, set_flags=(), clear_flags=(), material=None):
+    before = collision_bsp.surfaces.copy()
+    flags = collision_bsp.surfaces[selected, SURFACE_FLAGS]
+    collision_bsp.surfaces[selected, SURFACE_FLAGS] = (flags | flag_mask(set_flags)) & ~flag_mask(clear_flags)
+    if material is not None:
+        collision_bsp.surfaces[selected, MATERIAL] = material
+    return np.any(collision_bsp.surfaces != before, axis=1)
+
+# Selects and edits surfaces of a BSP tag. Dry runs only count the surfaces
+# which would change, from the tag cache.
+def edit_bsp_surfaces(bsp_path, selection, set_flags=(), clear_flags=(), material=None, dry_run=False):
+    if set(set_flags) & set(clear_flags):
+        raise Exception("Can't both set and clear " + ", ".join(sorted(set(set_flags) & set(clear_flags))))
+    if dry_run:
+        tag = None
+        collision_bsp = CollisionBSP.load(bsp_path)
+    else:
+        tag = sbsp_def.build(filepath=bsp_path)
+        collision_bsp = CollisionBSP.from_tag(tag)
+    selected = select_surfaces(collision_bsp, **selection)
+    changed = edit_surfaces(collision_bsp, selected, set_flags, clear_flags, material)
+    print("Selected {} of {} surfaces; {} {}".format(int(selected.sum()), len(selected), int(changed.sum()), "would change" if dry_run else "changed"))
+    if tag is not None and np.any(changed):
+        collision_bsp.write_back(tag)
+        tag.serialize(backup=False, temp=False)
+    return selected, changed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set or clear collision surface flags and materials on surfaces matching all the given filters")
+    parser.add_argument("bsp", help="Path to the BSP file to modify")
+    parser.add_argument("--set", action="append", default=[], choices=list(FLAG_BITS), help="Flag to set on the selected surfaces; can be given more than once")
+    parser.add_argument("--clear", action="append", default=[], choices=list(FLAG_BITS), help="Flag to clear on the selected surfaces; can be given more than once")
+    parser.add_argument("--material", type=int, help="Material index to give the selected surfaces")
+    parser.add_argument("--normal-angle", type=float, nargs=2, metavar=("MIN", "MAX"), help="Select surfaces whose facing normal is between these angles in degrees from --axis")
+    parser.add_argument("--axis", type=float, nargs=3, default=[0.0, 0.0, 1.0], metavar=("X", "Y", "Z"), help="Axis for --normal-angle, up by default")
+    parser.add_argument("--bbox", type=float, nargs=6, metavar=("MIN_X", "MIN_Y", "MIN_Z", "MAX_X", "MAX_Y", "MAX_Z"), help="Select surfaces overlapping this box")
+    parser.add_argument("--with-material", type=int, nargs="+", help="Select surfaces with any of these material indices")
+    parser.add_argument("--leaves", type=int, nargs="+", help="Select surfaces of any of these leaves")
+    parser.add_argument("--surfaces", type=int, nargs="+", help="Select these surface indices")
+    parser.add_argument("--has", action="append", default=[], choices=list(FLAG_BITS), help="Select surfaces with this flag set")
+    parser.add_argument("--lacks", action="append", default=[], choices=list(FLAG_BITS), help="Select surfaces with this flag clear")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the surfaces which would change, without modifying the tag")
+    args = parser.parse_args()
+    if not args.set and not args.clear and args.material is None:
+        parser.error("nothing to do, give --set, --clear or --material")
+    selection = {
+        "normal_angle": args.normal_angle,
+        "axis": args.axis,
+        "bbox": args.bbox,
+        "materials": args.with_material,
+        "leaves": args.leaves,
+        "surfaces": args.surfaces,
+        "has_flags": args.has,
+        "lacks_flags": args.lacks,
+    }
+    edit_bsp_surfaces(args.bsp, selection, args.set, args.clear, args.material, args.dry_run)
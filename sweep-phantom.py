@@ -0,0 +1,311 @@
+from collision_bsp import CollisionBSP, SubtreeSurfaces, SURFACE_FLAGS, TWO_SIDED
+from bsp_query import CollisionQuery
+from phantom import PhantomDetector
+from surface_flags import surface_normals
+from tag_cache import load_bsp_arrays
+from time import perf_counter
+import numpy as np
+import argparse
+import json
+
+# Ray directions as (axis, sign)
+DIRECTIONS = {
+    "down": (2, -1),
+    "up": (2, 1),
+    "+x": (0, 1),
+    "-x": (0, -1),
+    "+y": (1, 1),
+    "-y": (1, -1),
+}
+# Each ray's cast is nudged this far past the last transition before looking
+# for the next one, so casts starting on a plane always make progress
+TRANSITION_NUDGE = 0.0001
+# Rays with more solid intervals than this are cut short
+MAX_TRANSITIONS = 64
+# Upper bound on ray/triangle candidate pairs tested at once
+MAX_PAIRS = 4000000
+
+# Surfaces fanned into triangles: Tx3x3 corners, and each triangle's surface
+def surface_triangles(collision_bsp):
+    corners = []
+    triangle_surfaces = []
+    for surface_index in range(len(collision_bsp.surfaces)):
+        vert_indices = collision_bsp.surface_vertices(surface_index)
+        for i in range(1, len(vert_indices) - 1):
+            corners.append([vert_indices[0], vert_indices[i], vert_indices[i + 1]])
+            triangle_surfaces.append(surface_index)
+    corners = np.array(corners, dtype=np.int64).reshape(-1, 3)
+    return collision_bsp.vertices[corners], np.array(triangle_surfaces, dtype=np.int64)
+
+# A grid of parallel rays through box (2x3 min and max) along an axis. Rays
+# start on the box face they enter through and are spaced at cell centres
+# over the other two axes.
+class RayGrid:
+    def __init__(self, box, spacing, axis, sign):
+        self.box = box
+        self.spacing = spacing
+        self.axis = axis
+        self.sign = sign
+        self.grid_axes = [a for a in range(3) if a != axis]
+        extents = box[1, self.grid_axes] - box[0, self.grid_axes]
+        self.shape = tuple(np.maximum(np.floor(extents / spacing).astype(np.int64), 1).tolist())
+        self.count = self.shape[0] * self.shape[1]
+        self.length = box[1, axis] - box[0, axis]
+        self.direction = np.zeros(3)
+        self.direction[axis] = sign
+
+    def origins(self, ray_indices):
+        grid_u, grid_v = np.divmod(ray_indices, self.shape[1])
+        origins = np.empty((len(ray_indices), 3))
+        origins[:, self.grid_axes[0]] = self.box[0, self.grid_axes[0]] + (grid_u + 0.5) * self.spacing
+        origins[:, self.grid_axes[1]] = self.box[0, self.grid_axes[1]] + (grid_v + 0.5) * self.spacing
+        origins[:, self.axis] = self.box[0 if self.sign > 0 else 1, self.axis]
+        return origins
+
+    def points(self, ray_indices, t):
+        return self.origins(ray_indices) + self.direction * (t * self.length)[:, None]
+
+    # All ray/triangle crossings as (ray, t, triangle) arrays. Triangles are
+    # binned to the grid cells their bounding boxes cover, and each candidate
+    # pair is tested in the 2D grid plane.
+    def crossings(self, triangles):
+        u_axis, v_axis = self.grid_axes
+        mins = triangles.min(axis=1)
+        maxs = triangles.max(axis=1)
+        u0 = np.maximum(np.ceil((mins[:, u_axis] - self.box[0, u_axis]) / self.spacing - 0.5), 0).astype(np.int64)
+        u1 = np.minimum(np.floor((maxs[:, u_axis] - self.box[0, u_axis]) / self.spacing - 0.5), self.shape[0] - 1).astype(np.int64)
+        v0 = np.maximum(np.ceil((mins[:, v_axis] - self.box[0, v_axis]) / self.spacing - 0.5), 0).astype(np.int64)
+        v1 = np.minimum(np.floor((maxs[:, v_axis] - self.box[0, v_axis]) / self.spacing - 0.5), self.shape[1] - 1).astype(np.int64)
+        u_counts = np.maximum(u1 - u0 + 1, 0)
+        v_counts = np.maximum(v1 - v0 + 1, 0)
+        pair_counts = u_counts * v_counts
+
+        rays = []
+        ts = []
+        hit_triangles = []
+        cumulative_counts = np.cumsum(pair_counts)
+        batch_start = 0
+        while batch_start < len(triangles):
+            # batches of up to MAX_PAIRS pairs, but always at least one triangle
+            done_count = cumulative_counts[batch_start - 1] if batch_start > 0 else 0
+            batch_end = max(int(np.searchsorted(cumulative_counts, done_count + MAX_PAIRS, side="right")), batch_start + 1)
+            batch = np.arange(batch_start, batch_end)
+            batch_start = batch_end
+            if pair_counts[batch].sum() == 0:
+                continue
+            pair_triangles = np.repeat(batch, pair_counts[batch])
+            firsts = np.repeat(np.cumsum(pair_counts[batch]) - pair_counts[batch], pair_counts[batch])
+            offsets = np.arange(len(pair_triangles)) - firsts
+            grid_u = u0[pair_triangles] + offsets // v_counts[pair_triangles]
+            grid_v = v0[pair_triangles] + offsets % v_counts[pair_triangles]
+            ray_indices = grid_u * self.shape[1] + grid_v
+            origins = self.origins(ray_indices)
+
+            inside, along = triangles_crossed(triangles[pair_triangles], origins, self.axis, self.grid_axes)
+            rays.append(ray_indices[inside])
+            ts.append((along[inside] - origins[inside, self.axis]) * self.sign / self.length)
+            hit_triangles.append(pair_triangles[inside])
+
+        if len(rays) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)
+        return np.concatenate(rays), np.concatenate(ts), np.concatenate(hit_triangles)
+
+# Whether each Nx3x3 triangle contains the matching origin projected along
+# axis, and where along axis it does
+def triangles_crossed(triangles, origins, axis, grid_axes):
+    u_axis, v_axis = grid_axes
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    def edge_function(p, q, r):
+        return (q[:, u_axis] - p[:, u_axis]) * (r[:, v_axis] - p[:, v_axis]) - (q[:, v_axis] - p[:, v_axis]) * (r[:, u_axis] - p[:, u_axis])
+    area = edge_function(a, b, c)
+    w_a = edge_function(b, c, origins)
+    w_b = edge_function(c, a, origins)
+    w_c = edge_function(a, b, origins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w_a, w_b, w_c = w_a / area, w_b / area, w_c / area
+        # shared edges are included from both sides, which at worst reports
+        # a crossing twice
+        inside = (area != 0.0) & (w_a >= 0.0) & (w_b >= 0.0) & (w_c >= 0.0)
+    along = w_a * a[:, axis] + w_b * b[:, axis] + w_c * c[:, axis]
+    return inside, along
+
+# Where the rays (of a RayGrid) pass from open into solid space according to
+# the bsp3d tree, as (ray, t, plane, leaf) arrays. Rays starting in solid
+# space don't count that as a transition.
+def tree_transitions(query, grid, ray_indices):
+    nudge = TRANSITION_NUDGE / grid.length
+    rays = []
+    ts = []
+    planes = []
+    leaves = []
+    active = ray_indices
+    t = np.zeros(len(active))
+    ends = grid.points(active, np.ones(len(active)))
+    for _ in range(MAX_TRANSITIONS):
+        if len(active) == 0:
+            break
+        hits = query.cast_segments(grid.points(active, t), ends, into_solid=True)
+        hit_t = np.where(hits.hit, t + np.where(hits.hit, hits.t, 0.0) * (1.0 - t), 1.0)
+        entered = hits.hit & (hits.plane != -1)
+        rays.append(active[entered])
+        ts.append(hit_t[entered])
+        planes.append(hits.plane[entered])
+        leaves.append(hits.leaf[entered])
+
+        # continue from where each ray gets back into open space
+        active, t, ends = active[hits.hit], np.minimum(hit_t[hits.hit] + nudge, 1.0), ends[hits.hit]
+        opens = query.cast_segments(grid.points(active, t), ends, into_solid=False)
+        open_t = np.where(opens.hit, opens.t, 1.0)
+        t = np.where(opens.hit, np.minimum(t + open_t * (1.0 - t) + nudge, 1.0), 1.0)
+        keep = t < 1.0
+        active, t, ends = active[keep], t[keep], ends[keep]
+    return np.concatenate(rays), np.concatenate(ts), np.concatenate(planes), np.concatenate(leaves)
+
+# For each (ray, t) query, whether there's a (ray, t) in the sorted targets
+# within tolerance along the same ray
+def near_along_ray(query_rays, query_ts, target_rays, target_ts, tolerance):
+    # rays are spaced 2 apart in key space so t in [0, 1] never overlaps
+    target_keys = target_rays * 2.0 + target_ts
+    order = np.argsort(target_keys)
+    target_keys = target_keys[order]
+    query_keys = query_rays * 2.0 + query_ts
+    found = np.zeros(len(query_keys), dtype=bool)
+    if len(target_keys) == 0:
+        return found
+    right = np.searchsorted(target_keys, query_keys)
+    for neighbour in [np.maximum(right - 1, 0), np.minimum(right, len(target_keys) - 1)]:
+        found |= np.abs(target_keys[neighbour] - query_keys) <= tolerance
+    return found
+
+# Groups of findings by key, with a count, bounds, and one sample point
+def group_findings(groups, kind, keys, points, direction_name):
+    for key, point in zip(keys, points.tolist()):
+        group = groups.get((kind, key))
+        if group is None:
+            group = groups[(kind, key)] = {"count": 0, "min": point, "max": point, "sample": point, "directions": set()}
+        group["count"] += 1
+        group["min"] = np.minimum(group["min"], point).tolist()
+        group["max"] = np.maximum(group["max"], point).tolist()
+        group["directions"].add(direction_name)
+
+# Sweeps rays over box (2x3 min and max, or the BSP's world bounds) and
+# compares where the tree turns solid with where the rays actually cross
+# surfaces. "phantom" findings are where the tree turns solid with no
+# surface within tolerance, grouped by (plane, leaf). "hole" findings are
+# where a ray crosses the front of a one-sided surface but the tree is still
+# open just past it, grouped by surface.
+def sweep(bsp_path, spacing=0.25, box=None, directions=["down", "+x", "+y"], tolerance=0.01, chunk_size=200000, use_cache=True):
+    bsp_arrays = load_bsp_arrays(bsp_path, use_cache)
+    collision_bsp = CollisionBSP.from_bsp_arrays(bsp_arrays)
+    if box is None:
+        box = bsp_arrays["world_bounds"].T.astype(np.float64)
+    query = CollisionQuery(collision_bsp)
+    triangles, triangle_surfaces = surface_triangles(collision_bsp)
+    # facing normals, flipped for surfaces on the back of their plane
+    normals = surface_normals(collision_bsp)
+    one_sided = collision_bsp.surfaces[:, SURFACE_FLAGS] & TWO_SIDED == 0
+
+    groups = {}
+    stats = {"rays": 0, "surface_crossings": 0, "tree_transitions": 0}
+    for direction_name in directions:
+        grid = RayGrid(box, spacing, *DIRECTIONS[direction_name])
+        cross_rays, cross_ts, cross_triangles = grid.crossings(triangles)
+        cross_surfaces = triangle_surfaces[cross_triangles]
+        # rays enter solid space through the front of surfaces
+        entering = normals[cross_surfaces] @ grid.direction < 0.0
+        t_tolerance = tolerance / grid.length
+        stats["rays"] += grid.count
+        stats["surface_crossings"] += len(cross_rays)
+
+        for chunk_start in range(0, grid.count, chunk_size):
+            ray_indices = np.arange(chunk_start, min(chunk_start + chunk_size, grid.count))
+            rays, ts, planes, leaves = tree_transitions(query, grid, ray_indices)
+            stats["tree_transitions"] += len(rays)
+            surfaced = near_along_ray(rays, ts, cross_rays[entering], cross_ts[entering], t_tolerance)
+            phantom = ~surfaced
+            group_findings(groups, "phantom", zip(planes[phantom].tolist(), leaves[phantom].tolist()), grid.points(rays[phantom], ts[phantom]), direction_name)
+
+            in_chunk = entering & one_sided[cross_surfaces] & (cross_rays >= ray_indices[0]) & (cross_rays <= ray_indices[-1])
+            in_chunk &= cross_ts + t_tolerance < 1.0
+            probes = grid.points(cross_rays[in_chunk], np.minimum(cross_ts[in_chunk] + t_tolerance, 1.0))
+            hole = ~query.points_solid(probes)
+            group_findings(groups, "hole", cross_surfaces[in_chunk][hole].tolist(), probes[hole], direction_name)
+
+    findings = []
+    for (kind, key), group in groups.items():
+        finding = {"kind": kind}
+        if kind == "phantom":
+            finding["plane"], finding["leaf"] = key
+        else:
+            finding["surface"] = key
+        finding.update(group)
+        finding["directions"] = sorted(group["directions"])
+        findings.append(finding)
+    findings.sort(key=lambda f: (f["kind"], -f["count"]))
+    return collision_bsp, findings, stats
+
+def format_finding(finding):
+    where = "plane={} leaf={}".format(finding["plane"], finding["leaf"]) if finding["kind"] == "phantom" else "surface={}".format(finding["surface"])
+    return "{} {} rays={} min=({:.2f}, {:.2f}, {:.2f}) max=({:.2f}, {:.2f}, {:.2f}) directions={}".format(
+        finding["kind"].capitalize(),
+        where,
+        finding["count"],
+        *finding["min"],
+        *finding["max"],
+        ",".join(finding["directions"])
+    )
+
+# Checks the heuristic detector against the sweep: which detected planes the
+# sweep also found phantom BSP on, and which phantom planes it missed
+def compare_detector(collision_bsp, findings):
+    detections = PhantomDetector(collision_bsp, SubtreeSurfaces(collision_bsp)).scan()
+    detected_planes = set(d.plane for d in detections)
+    swept_planes = set(f["plane"] for f in findings if f["kind"] == "phantom")
+    return {
+        "detections": len(detections),
+        "confirmed_planes": sorted(detected_planes & swept_planes),
+        "unconfirmed_planes": sorted(detected_planes - swept_planes),
+        "missed_planes": sorted(swept_planes - detected_planes),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bsp", help="Path to the BSP file to sweep")
+    parser.add_argument("--spacing", type=float, default=0.25, help="Distance between neighbouring rays in world units")
+    parser.add_argument("--box", type=float, nargs=6, metavar=("MIN_X", "MIN_Y", "MIN_Z", "MAX_X", "MAX_Y", "MAX_Z"), help="Sweep only this box instead of the BSP's world bounds")
+    parser.add_argument("--directions", default="down,+x,+y", help="Comma separated ray directions from: " + ", ".join(DIRECTIONS))
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Distance between a tree transition and a surface still treated as the same place")
+    parser.add_argument("--chunk-size", type=int, default=200000, help="Rays cast through the tree at once")
+    parser.add_argument("--compare-detector", action="store_true", help="Also run the phantom detector and compare its planes with the sweep's")
+    parser.add_argument("--format", choices=["text", "ndjson"], default="text", help="Output format")
+    parser.add_argument("--no-cache", action="store_true", help="Parse the tag instead of using the tag cache")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    box = np.array(args.box, dtype=np.float64).reshape(2, 3) if args.box else None
+    collision_bsp, findings, stats = sweep(args.bsp, args.spacing, box, args.directions.split(","), args.tolerance, args.chunk_size, not args.no_cache)
+    stats["seconds"] = round(perf_counter() - start, 3)
+    comparison = compare_detector(collision_bsp, findings) if args.compare_detector else None
+
+    if args.format == "ndjson":
+        for finding in findings:
+            print(json.dumps({"type": "finding", **finding}))
+        if comparison is not None:
+            print(json.dumps({"type": "comparison", **comparison}))
+        print(json.dumps({"type": "summary", **stats}))
+    else:
+        for finding in findings:
+            print(format_finding(finding))
+        if comparison is not None:
+            print("Detector: {} detections; planes confirmed by sweep: {}; unconfirmed: {}; phantom planes missed: {}".format(
+                comparison["detections"],
+                comparison["confirmed_planes"],
+                comparison["unconfirmed_planes"],
+                comparison["missed_planes"]
+            ))
+        print("Swept {} rays with {} surface crossings and {} tree transitions in {:.3f}s".format(
+            stats["rays"],
+            stats["surface_crossings"],
+            stats["tree_transitions"],
+            stats["seconds"]
+        ))
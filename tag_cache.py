@@ -0,0 +1,111 @@
+from reclaimer.hek.defs.sbsp import sbsp_def
+from vert_buffers import rendered_vert_dtype, lm_vert_dtype, rendered_verts, lightmap_verts
+from importlib.metadata import version
+import numpy as np
+import hashlib
+import os
+
+# Parsing a large BSP tag with reclaimer takes seconds, so read-only tools can
+# load the arrays they need from a cache keyed by the tag's content hash. Bump
+# CACHE_FORMAT_VERSION whenever the extracted arrays change shape or meaning.
+CACHE_FORMAT_VERSION = 2
+CACHE_DIR = os.environ.get("BSP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "halo-bsp-experiments"))
+
+def block_rows(block_array, width, dtype):
+    return np.array(block_array, dtype=dtype).reshape(-1, width)
+
+# Columns follow the field order of the reclaimer blocks, e.g. bsp3d_nodes are
+# (plane, back_child, front_child) and edges are (start_vertex, end_vertex,
+# forward_edge, reverse_edge, left_surface, right_surface).
+def extract_collision_arrays(collision_bsp):
+    bsp2d_nodes = collision_bsp.bsp2d_nodes.STEPTREE
+    leaves = collision_bsp.leaves.STEPTREE
+    surfaces = collision_bsp.surfaces.STEPTREE
+    verts = collision_bsp.vertices.STEPTREE
+    return {
+        "bsp3d_nodes": block_rows(collision_bsp.bsp3d_nodes.STEPTREE, 3, np.int32),
+        "planes": block_rows(collision_bsp.planes.STEPTREE, 4, np.float32),
+        "leaves": np.array([(l.flags.data, l.bsp2d_reference_count, l.first_bsp2d_reference) for l in leaves], dtype=np.int32).reshape(-1, 3),
+        "bsp2d_references": block_rows(collision_bsp.bsp2d_references.STEPTREE, 2, np.int32),
+        "bsp2d_node_planes": np.array([n[0:3] for n in bsp2d_nodes], dtype=np.float32).reshape(-1, 3),
+        "bsp2d_node_children": np.array([n[3:5] for n in bsp2d_nodes], dtype=np.int32).reshape(-1, 2),
+        "surfaces": np.array([(s.plane, s.first_edge, s.flags.data, s.breakable_surface, s.material) for s in surfaces], dtype=np.int32).reshape(-1, 5),
+        "edges": block_rows(collision_bsp.edges.STEPTREE, 6, np.int32),
+        "vertices": np.array([v[0:3] for v in verts], dtype=np.float32).reshape(-1, 3),
+        "vertex_first_edges": np.array([v.first_edge for v in verts], dtype=np.int32),
+    }
+
+# Rendered and lightmap verts of all materials are concatenated, with
+# material_vert_counts and material_lm_vert_counts giving each material's share
+def extract_lightmap_arrays(bsp):
+    lightmap_bitmap_indices = []
+    material_lightmaps = []
+    material_shaders = []
+    material_vert_counts = []
+    material_lm_vert_counts = []
+    rendered_blocks = [np.empty(0, rendered_vert_dtype)]
+    lm_blocks = [np.empty(0, lm_vert_dtype)]
+    for i_lightmap, lightmap in enumerate(bsp.lightmaps.STEPTREE):
+        lightmap_bitmap_indices.append(lightmap.bitmap_index)
+        for material in lightmap.materials.STEPTREE:
+            material_lightmaps.append(i_lightmap)
+            material_shaders.append(material.shader.filepath)
+            material_vert_counts.append(material.vertices_count)
+            material_lm_vert_counts.append(material.lightmap_vertices_count)
+            rendered_blocks.append(rendered_verts(material))
+            lm_blocks.append(lightmap_verts(material))
+    return {
+        "lightmap_bitmap_indices": np.array(lightmap_bitmap_indices, dtype=np.int32),
+        "material_lightmaps": np.array(material_lightmaps, dtype=np.int32),
+        "material_shaders": np.array(material_shaders, dtype=str),
+        "material_vert_counts": np.array(material_vert_counts, dtype=np.int32),
+        "material_lm_vert_counts": np.array(material_lm_vert_counts, dtype=np.int32),
+        "rendered_verts": np.concatenate(rendered_blocks),
+        "lm_verts": np.concatenate(lm_blocks),
+    }
+
+# Collision arrays are prefixed with "collision_"; only the first collision BSP
+# is extracted since that's all the tools use. world_bounds holds the (min,
+# max) rows of the BSP's x, y, and z bounds.
+def extract_bsp_arrays(bsp_tag):
+    bsp = bsp_tag.data.tagdata
+    arrays = extract_lightmap_arrays(bsp)
+    # rows of (min, max) for x, y, and z
+    arrays["world_bounds"] = np.array([list(bsp.world_bounds_x), list(bsp.world_bounds_y), list(bsp.world_bounds_z)], dtype=np.float32)
+    collision_bsps = bsp.collision_bsp.STEPTREE
+    if len(collision_bsps) > 0:
+        for name, array in extract_collision_arrays(collision_bsps[0]).items():
+            arrays["collision_" + name] = array
+    return arrays
+
+def cache_key(bsp_path):
+    hasher = hashlib.sha1()
+    with open(bsp_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    hasher.update(f"format={CACHE_FORMAT_VERSION};reclaimer={version('reclaimer')}".encode())
+    return hasher.hexdigest()
+
+def cache_path(bsp_path):
+    return os.path.join(CACHE_DIR, cache_key(bsp_path) + ".npz")
+
+# Returns the dict of arrays for a BSP tag, from the cache when the tag's
+# content is unchanged or else by fully parsing it and updating the cache
+def load_bsp_arrays(bsp_path, use_cache=True):
+    path = cache_path(bsp_path) if use_cache else None
+    if path is not None and os.path.exists(path):
+        with np.load(path, allow_pickle=False) as cached:
+            return {name: cached[name] for name in cached.files}
+
+    arrays = extract_bsp_arrays(sbsp_def.build(filepath=bsp_path))
+    if path is not None:
+        store_bsp_arrays(path, arrays)
+    return arrays
+
+def store_bsp_arrays(path, arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename so concurrent readers never see a partial file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
@@ -0,0 +1,18 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports one of the hyphenated tool scripts, which can't be imported by name,
+# as a module with underscores instead. It's registered like an imported
+# module so worker processes can unpickle its functions.
+def load_script(file_name):
+    module_name = file_name[:-3].replace("-", "_")
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,159 @@
+from reclaimer.hek.defs.sbsp import sbsp_def
+from collision_bsp import CollisionBSP, TAG_BLOCKS, FLAG, write_row
+import numpy as np
+
+# Small hand-built collision BSPs for tests
+
+def flag(index):
+    return (index | FLAG) - (1 << 32)
+
+# The faces of a box as (axis, side), side 0 being the min face
+BOX_FACES = [(axis, side) for axis in range(3) for side in range(2)]
+
+# Collision arrays of surfaces given as vertex index loops, with the edges
+# between them linked the way the tag links them: each edge is walked start
+# to end by its left surface, through forward edges, and end to start by its
+# right surface, through reverse edges
+def surface_arrays(vertices, loops, surface_planes):
+    edges = []
+    edge_indices = {}
+    for surface_index, loop in enumerate(loops):
+        for a, b in zip(loop, loop[1:] + loop[:1]):
+            if (b, a) in edge_indices:
+                edges[edge_indices[(b, a)]][5] = surface_index
+            else:
+                edge_indices[(a, b)] = len(edges)
+                edges.append([a, b, -1, -1, surface_index, -1])
+    surface_edges = [[edge_indices.get((a, b), edge_indices.get((b, a))) for a, b in zip(loop, loop[1:] + loop[:1])] for loop in loops]
+    for surface_index, loop_edges in enumerate(surface_edges):
+        for edge_index, next_edge_index in zip(loop_edges, loop_edges[1:] + loop_edges[:1]):
+            edges[edge_index][2 if edges[edge_index][4] == surface_index else 3] = next_edge_index
+    first_edges = [next(e for e, edge in enumerate(edges) if v in edge[0:2]) for v in range(len(vertices))]
+    return {
+        "surfaces": [(plane, loop_edges[0], 0, -1, 0) for plane, loop_edges in zip(surface_planes, surface_edges)],
+        "edges": edges,
+        "vertices": vertices,
+        "vertex_first_edges": first_edges,
+    }
+
+# A solid box with a face surface on each side, as a chain of bsp3d nodes,
+# one per face in BOX_FACES order, each with an open leaf holding the face's
+# surface outside it and the next node inside. Faces in reversed_faces have
+# their plane stored facing into the box, so the surface's plane index is
+# flagged and the open leaf is the node's back child.
+def box_arrays(box_min=(0.0, 0.0, 0.0), box_max=(1.0, 1.0, 1.0), reversed_faces=()):
+    box = np.array([box_min, box_max], dtype=np.float64)
+    # corner x + 2y + 4z takes each axis from the min (0) or max (1) bound
+    vertices = [[box[(corner >> axis) & 1, axis] for axis in range(3)] for corner in range(8)]
+    planes = []
+    bsp3d_nodes = []
+    leaves = []
+    bsp2d_references = []
+    loops = []
+    surface_planes = []
+    for face, (axis, side) in enumerate(BOX_FACES):
+        normal = np.zeros(3)
+        normal[axis] = 1.0 if side == 1 else -1.0
+        dist = float(normal @ box[side])
+        inside = face + 1 if face + 1 < len(BOX_FACES) else -1
+        if face in reversed_faces:
+            planes.append((*(-normal), -dist))
+            bsp3d_nodes.append((face, flag(face), inside))
+            surface_planes.append(flag(face))
+        else:
+            planes.append((*normal, dist))
+            bsp3d_nodes.append((face, inside, flag(face)))
+            surface_planes.append(face)
+        leaves.append((0, 1, face))
+        bsp2d_references.append((surface_planes[-1], flag(face)))
+        # corners counterclockwise seen from outside the box
+        u_axis, v_axis = (axis + 1) % 3, (axis + 2) % 3
+        corners = [c for c in range(8) if (c >> axis) & 1 == side]
+        angles = [np.arctan2(vertices[c][v_axis] - box.mean(axis=0)[v_axis], vertices[c][u_axis] - box.mean(axis=0)[u_axis]) for c in corners]
+        loop = [corners[i] for i in np.argsort(angles)]
+        loops.append(loop if side == 1 else loop[::-1])
+    return {
+        "bsp3d_nodes": bsp3d_nodes,
+        "planes": planes,
+        "leaves": leaves,
+        "bsp2d_references": bsp2d_references,
+        "bsp2d_node_planes": np.empty((0, 3)),
+        "bsp2d_node_children": np.empty((0, 2)),
+        **surface_arrays(vertices, loops, surface_planes),
+    }
+
+def box_bsp(box_min=(0.0, 0.0, 0.0), box_max=(1.0, 1.0, 1.0), reversed_faces=()):
+    return CollisionBSP(box_arrays(box_min, box_max, reversed_faces))
+
+# A row of boxes 0 < x - 4i < 2, -1 < y < 1, -1 < z < 1, split apart by
+# balanced x = 4i - 1 nodes. Each box is a chain of nodes, one per face, with
+# an empty leaf on the outside, ending in a phantom BSP candidate: a node on
+# z = 0 with a leaf front child holding a quad whose first edge passes through
+# the box along y = 0. Its back child is -1 for "phantom" regions, making the
+# box's candidate a phantom, and the front leaf for "fixed" regions. Returns
+# the BSP and each region's candidate node.
+def phantom_regions_bsp(kinds):
+    arrays = {"bsp3d_nodes": [], "planes": [], "leaves": [], "bsp2d_references": [], "surfaces": [], "edges": [], "vertices": []}
+    candidates = []
+
+    def add(name, row):
+        arrays[name].append(row)
+        return len(arrays[name]) - 1
+
+    def region(i):
+        x = 4.0 * i
+        box_planes = [(1, 0, 0, x), (-1, 0, 0, -x - 2), (0, 1, 0, -1), (0, -1, 0, -1), (0, 0, 1, -1), (0, 0, -1, -1)]
+        first_node = len(arrays["bsp3d_nodes"])
+        for j, plane in enumerate(box_planes):
+            inside = first_node + j + 1
+            add("bsp3d_nodes", (add("planes", plane), flag(add("leaves", (0, 0, 0))), inside))
+        candidate_plane = add("planes", (0, 0, 1, 0))
+        surface_leaf = add("leaves", (0, 1, len(arrays["bsp2d_references"])))
+        back_child = -1 if kinds[i] == "phantom" else flag(surface_leaf)
+        candidates.append(add("bsp3d_nodes", (candidate_plane, back_child, flag(surface_leaf))))
+        surface = len(arrays["surfaces"])
+        first_edge = len(arrays["edges"])
+        first_vertex = len(arrays["vertices"])
+        add("bsp2d_references", (candidate_plane, flag(surface)))
+        add("surfaces", (candidate_plane, first_edge, 0, -1, 0))
+        for vertex in [(x - 1, 0, 0), (x + 3, 0, 0), (x + 3, 10, 0), (x - 1, 10, 0)]:
+            add("vertices", vertex)
+        # quad edges with no right surface, whose reverse edges just go back
+        for j in range(4):
+            add("edges", (first_vertex + j, first_vertex + (j + 1) % 4, first_edge + (j + 1) % 4, first_edge + (j - 1) % 4, surface, -1))
+        return first_node
+
+    def split(lo, hi):
+        if hi - lo == 1:
+            return region(lo)
+        # odd splits put the extra region at the back, so the shallower
+        # region is scanned first
+        mid = (lo + hi + 1) // 2
+        node = add("bsp3d_nodes", None)
+        plane = add("planes", (1, 0, 0, 4.0 * mid - 1))
+        back_child = split(lo, mid)
+        arrays["bsp3d_nodes"][node] = (plane, back_child, split(mid, hi))
+        return node
+
+    split(0, len(kinds))
+    edges = arrays["edges"]
+    return CollisionBSP({
+        **arrays,
+        "bsp2d_node_planes": np.empty((0, 3)),
+        "bsp2d_node_children": np.empty((0, 2)),
+        "vertex_first_edges": [next(e for e, edge in enumerate(edges) if v == edge[0]) for v in range(len(arrays["vertices"]))],
+    }), candidates
+
+# Writes a collision BSP into a new BSP tag at path
+def write_bsp_tag(collision_bsp, path):
+    bsp_tag = sbsp_def.build()
+    bsp_tag.data.tagdata.collision_bsp.STEPTREE.extend(1)
+    tag_collision_bsp = bsp_tag.data.tagdata.collision_bsp.STEPTREE[0]
+    for block_name, columns in TAG_BLOCKS:
+        block = tag_collision_bsp[block_name].STEPTREE
+        block.extend(len(getattr(collision_bsp, columns[0][0])))
+        for name, fields in columns:
+            for row, values in zip(block, getattr(collision_bsp, name).tolist()):
+                write_row(row, fields, values if isinstance(values, list) else [values])
+    bsp_tag.serialize(filepath=str(path), backup=False, temp=False)
+    return str(path)
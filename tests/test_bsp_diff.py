@@ -0,0 +1,105 @@
+from collision_bsp import CollisionBSP, PLANE, BACK_CHILD, FRONT_CHILD, BSP2D_REF_PLANE, BSP2D_NODE, SURFACE_PLANE, START_VERTEX, END_VERTEX, LEFT_SURFACE, RIGHT_SURFACE, FLAG, NULL_INDEX, flagged, unflag
+from vert_buffers import rendered_vert_dtype
+from synthetic_bsp import phantom_regions_bsp
+from scripts import load_script
+import numpy as np
+
+bsp_diff = load_script("bsp-diff.py")
+
+# References renumbered through mapping, keeping their flag. With
+# only_flagged, unflagged ones (bsp2d nodes among surfaces) are kept as is.
+def renumber(references, mapping, only_flagged=False):
+    references = references.astype(np.int64)
+    selected = references != NULL_INDEX
+    if only_flagged:
+        selected &= flagged(references)
+    mapped = mapping[unflag(references[selected])]
+    references[selected] = mapped | (flagged(references[selected]) * FLAG)
+    return np.where(references >= FLAG, references - (1 << 32), references)
+
+# Rows reordered so old row i ends up at mapping[i]
+def reorder(rows, mapping):
+    reordered = np.empty_like(rows)
+    reordered[mapping] = rows
+    return reordered
+
+# The same BSP with its vertices, planes and surfaces renumbered at random
+def permuted(collision_bsp, rng):
+    arrays = {name: array.copy() for name, array in collision_bsp.arrays().items()}
+    vertex_mapping = rng.permutation(len(arrays["vertices"]))
+    plane_mapping = rng.permutation(len(arrays["planes"]))
+    surface_mapping = rng.permutation(len(arrays["surfaces"]))
+
+    arrays["vertices"] = reorder(arrays["vertices"], vertex_mapping)
+    arrays["vertex_first_edges"] = reorder(arrays["vertex_first_edges"], vertex_mapping)
+    arrays["edges"][:, [START_VERTEX, END_VERTEX]] = vertex_mapping[arrays["edges"][:, [START_VERTEX, END_VERTEX]]]
+
+    arrays["planes"] = reorder(arrays["planes"], plane_mapping)
+    for name, column in (("bsp3d_nodes", PLANE), ("bsp2d_references", BSP2D_REF_PLANE), ("surfaces", SURFACE_PLANE)):
+        arrays[name][:, column] = renumber(arrays[name][:, column], plane_mapping)
+
+    arrays["surfaces"] = reorder(arrays["surfaces"], surface_mapping)
+    arrays["edges"][:, [LEFT_SURFACE, RIGHT_SURFACE]] = renumber(arrays["edges"][:, [LEFT_SURFACE, RIGHT_SURFACE]], surface_mapping)
+    arrays["bsp2d_references"][:, BSP2D_NODE] = renumber(arrays["bsp2d_references"][:, BSP2D_NODE], surface_mapping, only_flagged=True)
+    arrays["bsp2d_node_children"] = renumber(arrays["bsp2d_node_children"], surface_mapping, only_flagged=True)
+    return CollisionBSP(arrays)
+
+def assert_all_matched(stats):
+    assert (stats["matched"], stats["removed"], stats["added"]) == (stats["old"], 0, 0)
+
+def test_renumbered_bsp_is_identical():
+    collision_bsp, _candidates = phantom_regions_bsp(["phantom", "fixed", "phantom", "fixed"])
+    result = bsp_diff.diff_collision_bsps(collision_bsp, permuted(collision_bsp, np.random.default_rng(0)))
+    for name in ("collision_vertices", "planes", "surfaces"):
+        assert_all_matched(result[name])
+        assert result[name]["moved"] == 0
+    assert result["bsp3d"]["identical"]
+    assert result["bsp3d"]["old_changed"] == result["bsp3d"]["new_changed"] == 0
+    assert result["bsp3d"]["lowest_changed"] == []
+
+def test_moved_vertex_and_swapped_subtree():
+    collision_bsp, _candidates = phantom_regions_bsp(["phantom", "fixed", "phantom"])
+    edited = permuted(collision_bsp, np.random.default_rng(1))
+    edited.vertices[0, 0] += bsp_diff.DEFAULT_RADIUS / 2
+    # the root's back child splits the first two regions; swap them
+    split_node = int(edited.bsp3d_nodes[0, BACK_CHILD])
+    edited.bsp3d_nodes[split_node, [BACK_CHILD, FRONT_CHILD]] = edited.bsp3d_nodes[split_node, [FRONT_CHILD, BACK_CHILD]]
+
+    result = bsp_diff.diff_collision_bsps(collision_bsp, edited)
+    for name in ("collision_vertices", "planes", "surfaces"):
+        assert_all_matched(result[name])
+    assert result["collision_vertices"]["moved"] == 1
+    assert result["planes"]["moved"] == 0
+    assert not result["bsp3d"]["identical"]
+    # the swapped node and the root above it
+    assert result["bsp3d"]["new_changed"] == 2
+    assert result["bsp3d"]["lowest_changed"] == [{"node": split_node, "plane": int(unflag(edited.bsp3d_nodes[split_node, PLANE])), "depth": 1}]
+
+# Render vertex arrays as load_bsp_arrays gives them, for materials given as
+# (shader, lightmap) pairs, with each vertex of positions given to the
+# material at the same index of vertex_materials
+def render_arrays(materials, lightmap_pages, positions, vertex_materials):
+    order = np.argsort(vertex_materials, kind="stable")
+    verts = np.zeros(len(positions), dtype=rendered_vert_dtype)
+    verts["position"] = np.array(positions)[order]
+    verts["normal"] = [0.0, 0.0, 1.0]
+    return {
+        "lightmap_bitmap_indices": np.array(lightmap_pages, dtype=np.int32),
+        "material_lightmaps": np.array([lightmap for _shader, lightmap in materials], dtype=np.int32),
+        "material_shaders": np.array([shader for shader, _lightmap in materials], dtype=str),
+        "material_vert_counts": np.bincount(vertex_materials, minlength=len(materials)).astype(np.int32),
+        "rendered_verts": verts,
+    }
+
+def test_render_vertex_changing_lightmap_page():
+    # one shader in two lightmaps on pages 3 and 5, and another on page 3
+    materials = [("shaders\\floor", 0), ("shaders\\floor", 1), ("shaders\\wall", 0)]
+    positions = [(float(i), 0.0, 0.0) for i in range(6)]
+    old_arrays = render_arrays(materials, [3, 5], positions, [0, 0, 0, 1, 1, 2])
+    # vertex 2 moves into the page 5 lightmap
+    new_arrays = render_arrays(materials, [3, 5], positions, [0, 0, 1, 1, 1, 2])
+
+    result = bsp_diff.diff_render_vertices(old_arrays, new_arrays)
+    assert_all_matched(result["render_vertices"])
+    assert result["render_vertices"]["moved"] == 0
+    assert result["lightmap_pages"] == {"moved_verts": 1, "transitions": [{"old_page": 3, "new_page": 5, "verts": 1}]}
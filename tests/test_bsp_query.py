@@ -0,0 +1,28 @@
+from collision_bsp import CollisionBSP, FLAG
+from bsp_query import CollisionQuery
+import numpy as np
+import pytest
+
+# One node on the z = 0 plane with open space (leaf 0) above and solid below
+def floor_bsp():
+    return CollisionBSP({
+        "bsp3d_nodes": [(0, -1, (0 | FLAG) - (1 << 32))],
+        "planes": [(0, 0, 1, 0)],
+        "leaves": [(0, 0, 0)],
+        "bsp2d_references": np.empty((0, 2)),
+        "bsp2d_node_planes": np.empty((0, 3)),
+        "bsp2d_node_children": np.empty((0, 2)),
+        "surfaces": np.empty((0, 5)),
+        "edges": np.empty((0, 6)),
+        "vertices": np.empty((0, 3)),
+        "vertex_first_edges": np.empty(0),
+    })
+
+def test_cast_rays_hits_floor():
+    hits = CollisionQuery(floor_bsp()).cast_rays([(0, 0, 1), (0, 0, 1)], [(0, 0, -2), (0, 0, 1)], 10)
+    np.testing.assert_array_equal(hits.hit, [True, False])
+    np.testing.assert_allclose(hits.point[0], (0, 0, 0))
+
+def test_cast_rays_rejects_zero_directions():
+    with pytest.raises(Exception, match="zero length direction, the first is ray 1"):
+        CollisionQuery(floor_bsp()).cast_rays([(0, 0, 1), (0, 0, 1)], [(0, 0, -1), (0, 0, 0)], 10)
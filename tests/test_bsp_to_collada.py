@@ -0,0 +1,39 @@
+from collision_bsp import CollisionBSP, SURFACE_PLANE, INDEX_MASK
+from synthetic_bsp import box_arrays, write_bsp_tag
+from scripts import ROOT
+import xml.etree.ElementTree as ET
+import numpy as np
+import os
+import subprocess
+import sys
+
+COLLADA_NS = {"c": "http://www.collada.org/2005/11/COLLADASchema"}
+
+# A box with corners and plane normals that need all of float32's precision
+def precise_box_bsp():
+    arrays = box_arrays((0.1, -2.3, 1.0 / 3.0), (1234.567, 7.77, 3.14159), reversed_faces=(1, 4))
+    rng = np.random.default_rng(0)
+    planes = np.array(arrays["planes"])
+    planes[:, 0:3] += rng.uniform(-1e-4, 1e-4, (len(planes), 3))
+    planes[:, 0:3] /= np.linalg.norm(planes[:, 0:3], axis=1)[:, None]
+    arrays["planes"] = planes
+    return CollisionBSP(arrays)
+
+def test_streamed_geometry_round_trips_float32(tmp_path):
+    bsp_path = write_bsp_tag(precise_box_bsp(), tmp_path / "box.scenario_structure_bsp")
+    dae_path = str(tmp_path / "box.dae")
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, "bsp-to-collada.py"), bsp_path, "--stream", "-o", dae_path],
+        check=True, capture_output=True, env={**os.environ, "BSP_CACHE_DIR": str(tmp_path / "cache")},
+    )
+    collision_bsp = CollisionBSP.load(bsp_path, use_cache=False)
+
+    geometries = ET.parse(dae_path).getroot().findall(".//c:library_geometries/c:geometry", COLLADA_NS)
+    assert len(geometries) == len(collision_bsp.surfaces)
+    for geometry in geometries:
+        surface_index = int(geometry.get("id")[len("surface_"):-len("-geometry")])
+        arrays = {a.get("id"): np.array(a.text.split(), dtype=np.float64) for a in geometry.findall(".//c:float_array", COLLADA_NS)}
+        positions = arrays[f"surface_{surface_index}-geometry_verts-array"].reshape(-1, 3)
+        normal = arrays[f"surface_{surface_index}-geometry_normals-array"]
+        np.testing.assert_array_equal(positions.astype(np.float32), collision_bsp.vertices[collision_bsp.surface_vertices(surface_index)].astype(np.float32))
+        np.testing.assert_array_equal(normal.astype(np.float32), collision_bsp.planes[collision_bsp.surfaces[surface_index, SURFACE_PLANE] & INDEX_MASK, 0:3].astype(np.float32))
@@ -0,0 +1,60 @@
+from bsp_validation import validate_collision_bsp, check_ranges, check_edge_loops, check_surface_planes, check_tree, DEFAULT_TOLERANCE
+from collision_bsp import BACK_CHILD, FRONT_CHILD, FORWARD_EDGE, LEFT_SURFACE, RIGHT_SURFACE
+from synthetic_bsp import flag, box_bsp, phantom_regions_bsp
+import numpy as np
+import pytest
+
+def issues_of(check, collision_bsp, *args):
+    issues = []
+    check(collision_bsp, issues, *args)
+    return [(issue.check, issue.message, issue.indices) for issue in issues]
+
+@pytest.mark.parametrize("collision_bsp", [
+    box_bsp(),
+    box_bsp((-3.0, 2.0, 0.5), (1.0, 7.0, 4.0), reversed_faces=(1, 4)),
+    phantom_regions_bsp(["phantom", "fixed", "phantom"])[0],
+], ids=["box", "reversed faces", "phantom regions"])
+def test_valid_bsps_have_no_issues(collision_bsp):
+    assert validate_collision_bsp(collision_bsp) == []
+
+def test_broken_forward_edge():
+    collision_bsp = box_bsp()
+    edges = collision_bsp.edges
+    surface = edges[0, LEFT_SURFACE]
+    edges[0, FORWARD_EDGE] = next(e for e in range(len(edges)) if surface not in edges[e, [LEFT_SURFACE, RIGHT_SURFACE]])
+    assert issues_of(check_edge_loops, collision_bsp) == [("edge_loops", "edges whose next edge doesn't border the same surface", [0])]
+
+def test_out_of_range_leaf():
+    collision_bsp = box_bsp()
+    collision_bsp.bsp3d_nodes[2, FRONT_CHILD] = flag(len(collision_bsp.leaves))
+    assert issues_of(check_ranges, collision_bsp) == [("ranges", "bsp3d nodes with a child out of range", [2])]
+    assert [issue.check for issue in validate_collision_bsp(collision_bsp)] == ["ranges"]
+
+def test_vertex_off_its_plane():
+    collision_bsp = box_bsp()
+    # corner (1, 1, 1) raised off the z = 1 face, staying on the x = 1 and
+    # y = 1 faces
+    collision_bsp.vertices[7, 2] += 10 * DEFAULT_TOLERANCE
+    assert issues_of(check_surface_planes, collision_bsp, DEFAULT_TOLERANCE) == [("surface_planes", f"surfaces with vertices further than {DEFAULT_TOLERANCE} from their plane", [5])]
+    assert issues_of(check_surface_planes, collision_bsp, 20 * DEFAULT_TOLERANCE) == []
+
+def test_cycle():
+    collision_bsp = box_bsp()
+    # the innermost node leads back to the fourth
+    collision_bsp.bsp3d_nodes[5, BACK_CHILD] = 3
+    issues = issues_of(check_tree, collision_bsp, False)
+    assert ("tree", "bsp3d nodes in or below a cycle", [3, 4, 5]) in issues
+    assert ("tree", "bsp3d nodes under several parents", [3]) in issues
+    assert issues_of(check_tree, collision_bsp, True) == [("tree", "bsp3d nodes in or below a cycle", [3, 4, 5])]
+
+def test_shared_subtree():
+    collision_bsp = box_bsp()
+    # a new node between the fourth node and its leaf, which also leads to
+    # the innermost node, giving it two parents
+    shared_node = len(collision_bsp.bsp3d_nodes)
+    collision_bsp.bsp3d_nodes = np.vstack([collision_bsp.bsp3d_nodes, [3, 5, collision_bsp.bsp3d_nodes[3, FRONT_CHILD]]])
+    collision_bsp.bsp3d_nodes[3, FRONT_CHILD] = shared_node
+    assert issues_of(check_ranges, collision_bsp) == []
+    assert issues_of(check_tree, collision_bsp, False) == [("tree", "bsp3d nodes under several parents", [5])]
+    assert issues_of(check_tree, collision_bsp, True) == []
+    assert validate_collision_bsp(collision_bsp, allow_shared=True) == []
@@ -0,0 +1,69 @@
+from collision_bsp import SubtreeSurfaces, PLANE, FRONT_CHILD, SURFACE_PLANE, FLAG, INDEX_MASK, NULL_INDEX
+from synthetic_bsp import box_bsp, phantom_regions_bsp
+import numpy as np
+import pytest
+
+# Surfaces under a bsp3d child reference, gathered recursively front first
+def collect_surfaces(collision_bsp, child_index):
+    if child_index == NULL_INDEX:
+        return []
+    if child_index & FLAG != 0:
+        return collision_bsp.leaf_surfaces(child_index & INDEX_MASK)
+    _plane, back_child, front_child = collision_bsp.bsp3d_nodes[child_index].tolist()
+    return collect_surfaces(collision_bsp, front_child) + collect_surfaces(collision_bsp, back_child)
+
+def collect_plane_surface(collision_bsp, node_index):
+    plane, _back_child, front_child = collision_bsp.bsp3d_nodes[node_index].tolist()
+    on_plane = [s for s in collect_surfaces(collision_bsp, front_child) if collision_bsp.surfaces[s, SURFACE_PLANE] & INDEX_MASK == plane & INDEX_MASK]
+    return on_plane[-1] if len(on_plane) > 0 else -1
+
+# Nodes in the subtree under a node, including it
+def collect_nodes(collision_bsp, child_index):
+    if child_index & FLAG != 0:
+        return []
+    _plane, back_child, front_child = collision_bsp.bsp3d_nodes[child_index].tolist()
+    return [child_index] + collect_nodes(collision_bsp, front_child) + collect_nodes(collision_bsp, back_child)
+
+def assert_matches_recursion(subtree_surfaces, collision_bsp, node_indices):
+    for node_index in node_indices:
+        assert subtree_surfaces.surfaces_under(node_index).tolist() == collect_surfaces(collision_bsp, node_index)
+        assert subtree_surfaces.plane_surface(node_index) == collect_plane_surface(collision_bsp, node_index)
+
+@pytest.mark.parametrize("collision_bsp", [
+    box_bsp(reversed_faces=(0, 3)),
+    phantom_regions_bsp(["phantom", "fixed", "phantom", "fixed", "phantom"])[0],
+], ids=["box", "phantom regions"])
+def test_subtree_surfaces_match_recursion(collision_bsp):
+    subtree_surfaces = SubtreeSurfaces(collision_bsp)
+    assert_matches_recursion(subtree_surfaces, collision_bsp, range(len(collision_bsp.bsp3d_nodes)))
+    for leaf_index in range(len(collision_bsp.leaves)):
+        assert subtree_surfaces.surfaces_under(leaf_index | FLAG).tolist() == collision_bsp.leaf_surfaces(leaf_index)
+    assert subtree_surfaces.surfaces_under(NULL_INDEX).tolist() == []
+    # rebuilding from the arrays gives the same lookups
+    copied = SubtreeSurfaces(collision_bsp, subtree_surfaces.arrays())
+    assert_matches_recursion(copied, collision_bsp, range(len(collision_bsp.bsp3d_nodes)))
+
+# Points one region's candidate node at the next region's surface leaf and
+# plane, and appends a copy of another candidate. update_nodes refreshes the
+# edited and appended nodes' plane surfaces, while the flattened ranges of
+# the edited node and its ancestors keep the surfaces from before.
+def test_update_nodes_refreshes_edited_plane_surfaces():
+    collision_bsp, candidates = phantom_regions_bsp(["phantom", "phantom", "phantom", "phantom"])
+    subtree_surfaces = SubtreeSurfaces(collision_bsp)
+    nodes = collision_bsp.bsp3d_nodes
+    before = {node_index: collect_surfaces(collision_bsp, node_index) for node_index in range(len(nodes))}
+    ancestors = {node_index for node_index in range(len(nodes)) if candidates[0] in collect_nodes(collision_bsp, node_index)}
+
+    edited = candidates[0]
+    nodes[edited, PLANE] = nodes[candidates[1], PLANE]
+    nodes[edited, FRONT_CHILD] = nodes[candidates[1], FRONT_CHILD]
+    appended = len(nodes)
+    collision_bsp.bsp3d_nodes = nodes = np.vstack([nodes, nodes[candidates[2]]])
+    subtree_surfaces.update_nodes([edited, appended])
+
+    assert subtree_surfaces.plane_surface(edited) == collect_plane_surface(collision_bsp, edited) == subtree_surfaces.plane_surface(candidates[1])
+    assert subtree_surfaces.plane_surface(edited) != -1
+    assert subtree_surfaces.plane_surface(appended) == subtree_surfaces.plane_surface(candidates[2]) != -1
+    for node_index in ancestors:
+        assert subtree_surfaces.surfaces_under(node_index).tolist() == before[node_index]
+    assert_matches_recursion(subtree_surfaces, collision_bsp, [n for n in range(appended) if n not in ancestors])
@@ -0,0 +1,43 @@
+from synthetic_bsp import box_bsp, write_bsp_tag
+from scripts import load_script
+import tag_cache
+import json
+import pytest
+
+fix_phantom = load_script("fix-phantom.py")
+
+# A directory with a clean box BSP and a tag too short to parse, with the tag
+# cache and clean markers kept under tmp_path
+@pytest.fixture
+def tags_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tag_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(fix_phantom, "CLEAN_DIR", str(tmp_path / "cache" / "phantom-clean"))
+    tags = tmp_path / "tags"
+    tags.mkdir()
+    write_bsp_tag(box_bsp(), tags / "box.scenario_structure_bsp")
+    (tags / "broken.scenario_structure_bsp").write_bytes(b"not a tag")
+    return str(tags)
+
+def test_fix_dir_reports_broken_tags_and_carries_on(tags_dir, capsys):
+    results = fix_phantom.fix_dir(tags_dir, report_only=True, jobs=2, output_format="text")
+    assert [(r["status"], r["phantoms"]) for r in results] == [("clean", 0), ("error", 0)]
+    assert results[1]["bsp"].endswith("broken.scenario_structure_bsp")
+    assert results[1]["error"] != ""
+    out = capsys.readouterr().out
+    lines = out.splitlines()
+    assert lines[1].split()[0:3] == ["box.scenario_structure_bsp", "clean", "0"]
+    assert lines[2].split()[0:3] == ["broken.scenario_structure_bsp", "error", "0"]
+    assert "\nbroken.scenario_structure_bsp: " + results[1]["error"] + "\n" in out
+    assert "2 maps scanned (0 skipped as clean, 1 failed)" in lines[-1]
+
+    # the clean tag is skipped next time, but the broken one is tried again
+    results = fix_phantom.fix_dir(tags_dir, report_only=True, jobs=1, output_format="json")
+    assert [r["status"] for r in results] == ["skipped", "error"]
+    assert json.loads(capsys.readouterr().out) == results
+
+def test_fix_dir_streams_error_records(tags_dir, capsys):
+    fix_phantom.fix_dir(tags_dir, report_only=True, jobs=1, output_format="ndjson")
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    errors = [r for r in records if r["status"] == "error"]
+    assert len(records) == 2
+    assert len(errors) == 1 and errors[0]["type"] == "summary" and errors[0]["error"] != ""
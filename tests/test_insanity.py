@@ -0,0 +1,308 @@
+from reclaimer.hek.defs.sbsp import sbsp_def
+from reclaimer.hek.defs.scnr import scnr_def
+from vert_buffers import rendered_vert_dtype, lm_vert_dtype, iter_materials
+from bsp_query import projection_axes
+from insanity import offset_level, transform_level, level_matrix
+from struct import unpack_from, pack_into
+import numpy as np
+import shutil
+
+OFFSET = (1234.5678, -987.654321, 31.4159)
+
+def flag(index):
+    return (index | 0x80000000) - (1 << 32)
+
+def set_xyz(point, values):
+    point.x, point.y, point.z = values
+
+def set_plane(plane, normal, d):
+    plane.i, plane.j, plane.k = normal
+    plane.d = d
+
+def unit_vectors(rng, count):
+    vectors = rng.normal(size=(count, 3))
+    return vectors / np.linalg.norm(vectors, axis=1)[:, None]
+
+def add_points(block, rng, count):
+    for point in rng.uniform(-500, 500, (count, 3)).tolist():
+        block.STEPTREE.extend(1)
+        set_xyz(block.STEPTREE[-1], point)
+
+def add_planes(block, rng, count):
+    for normal in unit_vectors(rng, count).tolist():
+        block.STEPTREE.extend(1)
+        set_plane(block.STEPTREE[-1], normal, rng.uniform(-500, 500))
+
+def set_bounds(bounds_x, bounds_y, bounds_z, rng):
+    for axis_bounds in (bounds_x, bounds_y, bounds_z):
+        axis_bounds[0], axis_bounds[1] = sorted(rng.uniform(-500, 500, 2).tolist())
+
+# A level with a few of everything insanity.py moves, at random positions
+def build_level(tmp_path):
+    rng = np.random.default_rng(0)
+    bsp_tag = sbsp_def.build()
+    bsp = bsp_tag.data.tagdata
+
+    bsp.collision_bsp.STEPTREE.extend(1)
+    collision_bsp = bsp.collision_bsp.STEPTREE[-1]
+    add_planes(collision_bsp.planes, rng, 4)
+    add_points(collision_bsp.vertices, rng, 12)
+    # one bsp2d tree of two nodes on each of two planes
+    for plane_index in (1, 3):
+        bsp2d_root = len(collision_bsp.bsp2d_nodes.STEPTREE)
+        collision_bsp.bsp2d_references.STEPTREE.extend(1)
+        reference = collision_bsp.bsp2d_references.STEPTREE[-1]
+        reference.plane, reference.bsp2d_node = plane_index, bsp2d_root
+        for children in ((bsp2d_root + 1, flag(0)), (flag(1), flag(2))):
+            collision_bsp.bsp2d_nodes.STEPTREE.extend(1)
+            node = collision_bsp.bsp2d_nodes.STEPTREE[-1]
+            node.plane_i, node.plane_j = unit_vectors(rng, 1)[0, 0:2].tolist()
+            node.plane_d = rng.uniform(-500, 500)
+            node.left_child, node.right_child = children
+
+    for bitmap_index in (0, -1):
+        bsp.lightmaps.STEPTREE.extend(1)
+        lightmap = bsp.lightmaps.STEPTREE[-1]
+        lightmap.bitmap_index = bitmap_index
+        lightmap.materials.STEPTREE.extend(1)
+        material = lightmap.materials.STEPTREE[-1]
+        set_xyz(material.centroid, rng.uniform(-500, 500, 3).tolist())
+        set_plane(material.plane, unit_vectors(rng, 1)[0].tolist(), rng.uniform(-500, 500))
+        vert_count = 30
+        lm_vert_count = 0 if bitmap_index == -1 else vert_count
+        rendered = np.zeros(vert_count, rendered_vert_dtype)
+        rendered["position"] = rng.uniform(-500, 500, (vert_count, 3))
+        rendered["normal"] = unit_vectors(rng, vert_count)
+        lm = np.zeros(lm_vert_count, lm_vert_dtype)
+        lm["incident"] = unit_vectors(rng, lm_vert_count)
+        material.vertices_count = vert_count
+        material.lightmap_vertices_count = lm_vert_count
+        material.uncompressed_vertices.STEPTREE = bytearray(rendered.tobytes() + lm.tobytes())
+        material.uncompressed_vertices.size = len(material.uncompressed_vertices.STEPTREE)
+
+    bsp.lens_flare_markers.STEPTREE.extend(2)
+    for flare_marker in bsp.lens_flare_markers.STEPTREE:
+        set_xyz(flare_marker.position, rng.uniform(-500, 500, 3).tolist())
+
+    bsp.clusters.STEPTREE.extend(1)
+    cluster = bsp.clusters.STEPTREE[-1]
+    cluster.subclusters.STEPTREE.extend(2)
+    for subcluster in cluster.subclusters.STEPTREE:
+        set_bounds(subcluster.world_bounds_x, subcluster.world_bounds_y, subcluster.world_bounds_z, rng)
+    cluster.mirrors.STEPTREE.extend(1)
+    mirror = cluster.mirrors.STEPTREE[-1]
+    set_plane(mirror.plane, unit_vectors(rng, 1)[0].tolist(), rng.uniform(-500, 500))
+    add_points(mirror.vertices, rng, 4)
+
+    bsp.cluster_portals.STEPTREE.extend(1)
+    cluster_portal = bsp.cluster_portals.STEPTREE[-1]
+    set_xyz(cluster_portal.centroid, rng.uniform(-500, 500, 3).tolist())
+    cluster_portal.bounding_radius = 12.5
+    add_points(cluster_portal.vertices, rng, 4)
+
+    bsp.breakable_surfaces.STEPTREE.extend(1)
+    set_xyz(bsp.breakable_surfaces.STEPTREE[-1].centroid, rng.uniform(-500, 500, 3).tolist())
+    bsp.breakable_surfaces.STEPTREE[-1].radius = 3.25
+
+    bsp.fog_planes.STEPTREE.extend(1)
+    fog_plane = bsp.fog_planes.STEPTREE[-1]
+    set_plane(fog_plane.plane, unit_vectors(rng, 1)[0].tolist(), rng.uniform(-500, 500))
+    add_points(fog_plane.vertices, rng, 4)
+
+    bsp.weather_polyhedras.STEPTREE.extend(1)
+    weather_polyhedra = bsp.weather_polyhedras.STEPTREE[-1]
+    set_xyz(weather_polyhedra.bounding_sphere_center, rng.uniform(-500, 500, 3).tolist())
+    weather_polyhedra.bounding_sphere_radius = 40.0
+    add_planes(weather_polyhedra.planes, rng, 3)
+
+    bsp.markers.STEPTREE.extend(2)
+    for marker, rotation in zip(bsp.markers.STEPTREE, rng.normal(size=(2, 4)).tolist()):
+        set_xyz(marker.position, rng.uniform(-500, 500, 3).tolist())
+        marker.rotation[:] = (np.array(rotation) / np.linalg.norm(rotation)).tolist()
+
+    set_bounds(bsp.world_bounds_x, bsp.world_bounds_y, bsp.world_bounds_z, rng)
+    bsp.vehicle_floor, bsp.vehicle_ceiling = -20.75, 480.125
+
+    scenario_tag = scnr_def.build()
+    scenario = scenario_tag.data.tagdata
+    scenario.player_starting_locations.STEPTREE.extend(3)
+    for player_spawn in scenario.player_starting_locations.STEPTREE:
+        set_xyz(player_spawn.position, rng.uniform(-500, 500, 3).tolist())
+        player_spawn.facing = rng.uniform(0, 6)
+
+    bsp_path = str(tmp_path / "level.scenario_structure_bsp")
+    scenario_path = str(tmp_path / "level.scenario")
+    bsp_tag.serialize(filepath=bsp_path, backup=False, temp=False)
+    scenario_tag.serialize(filepath=scenario_path, backup=False, temp=False)
+    return bsp_path, scenario_path
+
+# The original offset_level, which offset each field of each block in turn
+def offset_level_per_field(bsp_path, scenario_path, offset):
+    def offset_point(point):
+        point.x += offset[0]
+        point.y += offset[1]
+        point.z += offset[2]
+
+    def offset_plane(plane):
+        plane.d += np.dot(np.array([plane.i, plane.j, plane.k]), np.array(offset))
+
+    def offset_bounds(bounds_x, bounds_y, bounds_z):
+        for axis, axis_bounds in enumerate((bounds_x, bounds_y, bounds_z)):
+            axis_bounds[0] += offset[axis]
+            axis_bounds[1] += offset[axis]
+
+    bsp_tag = sbsp_def.build(filepath=bsp_path)
+    bsp = bsp_tag.data.tagdata
+    scenario_tag = scnr_def.build(filepath=scenario_path)
+    scenario = scenario_tag.data.tagdata
+
+    for collision_bsp in bsp.collision_bsp.STEPTREE:
+        for plane in collision_bsp.planes.STEPTREE:
+            offset_plane(plane)
+        for vert in collision_bsp.vertices.STEPTREE:
+            offset_point(vert)
+    for _lightmap, material in iter_materials(bsp):
+        offset_point(material.centroid)
+        vert_buffer = material.uncompressed_vertices.STEPTREE
+        for i in range(material.vertices_count):
+            x, y, z = unpack_from("<3f", vert_buffer, i * 56)
+            pack_into("<3f", vert_buffer, i * 56, x + offset[0], y + offset[1], z + offset[2])
+    for flare_marker in bsp.lens_flare_markers.STEPTREE:
+        offset_point(flare_marker.position)
+    for cluster in bsp.clusters.STEPTREE:
+        for subcluster in cluster.subclusters.STEPTREE:
+            offset_bounds(subcluster.world_bounds_x, subcluster.world_bounds_y, subcluster.world_bounds_z)
+        for mirror in cluster.mirrors.STEPTREE:
+            offset_plane(mirror.plane)
+            for vert in mirror.vertices.STEPTREE:
+                offset_point(vert)
+    for cluster_portal in bsp.cluster_portals.STEPTREE:
+        offset_point(cluster_portal.centroid)
+        for vert in cluster_portal.vertices.STEPTREE:
+            offset_point(vert)
+    for surface in bsp.breakable_surfaces.STEPTREE:
+        offset_point(surface.centroid)
+    for fog_plane in bsp.fog_planes.STEPTREE:
+        offset_plane(fog_plane.plane)
+        for vert in fog_plane.vertices.STEPTREE:
+            offset_point(vert)
+    for weather_polyhedra in bsp.weather_polyhedras.STEPTREE:
+        offset_point(weather_polyhedra.bounding_sphere_center)
+        for plane in weather_polyhedra.planes.STEPTREE:
+            offset_plane(plane)
+    for marker in bsp.markers.STEPTREE:
+        offset_point(marker.position)
+    for leaf_map_portal in bsp.leaf_map_portals.STEPTREE:
+        for vert in leaf_map_portal.vertices.STEPTREE:
+            offset_point(vert)
+    offset_bounds(bsp.world_bounds_x, bsp.world_bounds_y, bsp.world_bounds_z)
+    bsp.vehicle_floor += offset[2]
+    bsp.vehicle_ceiling += offset[2]
+    for player_spawn in scenario.player_starting_locations.STEPTREE:
+        offset_point(player_spawn.position)
+
+    bsp_tag.serialize(backup=False, temp=False)
+    scenario_tag.serialize(backup=False, temp=False)
+
+def rows(blocks, width):
+    return [tuple(block[0:width]) for block in blocks]
+
+def bounds(bounds_x, bounds_y, bounds_z):
+    return [tuple(axis_bounds[0:2]) for axis_bounds in (bounds_x, bounds_y, bounds_z)]
+
+def file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+# The bulk offset path has to serialize exactly what the per-field path did.
+# It also moves two things the per-field path missed, which are the intended
+# differences: bsp2d node lines, by the offset projected onto their surface
+# plane's 2D axes, and material planes, which were skipped for fear of their
+# zero length normals (a zero normal just gets a zero offset).
+def test_offset_level_matches_per_field_offset(tmp_path):
+    bsp_path, scenario_path = build_level(tmp_path)
+    for name in ("per_field", "bulk"):
+        (tmp_path / name).mkdir()
+        shutil.copy(bsp_path, tmp_path / name)
+        shutil.copy(scenario_path, tmp_path / name)
+    per_field_bsp_path = str(tmp_path / "per_field" / "level.scenario_structure_bsp")
+    bulk_bsp_path = str(tmp_path / "bulk" / "level.scenario_structure_bsp")
+    offset_level_per_field(per_field_bsp_path, str(tmp_path / "per_field" / "level.scenario"), OFFSET)
+    offset_level(bulk_bsp_path, str(tmp_path / "bulk" / "level.scenario"), OFFSET)
+
+    original = sbsp_def.build(filepath=bsp_path).data.tagdata
+    per_field = sbsp_def.build(filepath=per_field_bsp_path).data.tagdata
+    bulk_tag = sbsp_def.build(filepath=bulk_bsp_path)
+    bulk = bulk_tag.data.tagdata
+
+    per_field_collision = per_field.collision_bsp.STEPTREE[0]
+    bulk_collision = bulk.collision_bsp.STEPTREE[0]
+    assert rows(bulk_collision.vertices.STEPTREE, 3) == rows(per_field_collision.vertices.STEPTREE, 3)
+    assert rows(bulk_collision.planes.STEPTREE, 4) == rows(per_field_collision.planes.STEPTREE, 4)
+    assert [(rows([m.position], 3), rows([m.rotation], 4)) for m in bulk.markers.STEPTREE] == [(rows([m.position], 3), rows([m.rotation], 4)) for m in per_field.markers.STEPTREE]
+    assert bounds(bulk.world_bounds_x, bulk.world_bounds_y, bulk.world_bounds_z) == bounds(per_field.world_bounds_x, per_field.world_bounds_y, per_field.world_bounds_z)
+    assert [bounds(s.world_bounds_x, s.world_bounds_y, s.world_bounds_z) for s in bulk.clusters.STEPTREE[0].subclusters.STEPTREE] == [bounds(s.world_bounds_x, s.world_bounds_y, s.world_bounds_z) for s in per_field.clusters.STEPTREE[0].subclusters.STEPTREE]
+    for (_lightmap, bulk_material), (_per_field_lightmap, per_field_material) in zip(iter_materials(bulk), iter_materials(per_field)):
+        assert bytes(bulk_material.uncompressed_vertices.STEPTREE) == bytes(per_field_material.uncompressed_vertices.STEPTREE)
+
+    # bsp2d node lines move by the offset along their surface plane's axes
+    original_collision = original.collision_bsp.STEPTREE[0]
+    original_planes = np.array(rows(original_collision.planes.STEPTREE, 4))
+    node_planes = np.array([1, 1, 3, 3])
+    axes, _dominant = projection_axes(original_planes[node_planes, 0:3])
+    original_lines = np.array(rows(original_collision.bsp2d_nodes.STEPTREE, 3))
+    bulk_lines = np.array(rows(bulk_collision.bsp2d_nodes.STEPTREE, 3))
+    expected_d = original_lines[:, 2] + np.einsum("ij,ij->i", original_lines[:, 0:2], np.array(OFFSET)[axes])
+    np.testing.assert_array_equal(bulk_lines[:, 0:2], original_lines[:, 0:2])
+    np.testing.assert_allclose(bulk_lines[:, 2], expected_d, rtol=1e-6)
+    assert rows(per_field_collision.bsp2d_nodes.STEPTREE, 3) == rows(original_collision.bsp2d_nodes.STEPTREE, 3)
+    # and material planes by the offset along their normal
+    for (_lightmap, bulk_material), (_original_lightmap, original_material) in zip(iter_materials(bulk), iter_materials(original)):
+        normal = np.array(original_material.plane[0:3])
+        assert tuple(bulk_material.plane[0:3]) == tuple(original_material.plane[0:3])
+        assert bulk_material.plane.d == np.float32(original_material.plane.d + np.dot(normal, OFFSET))
+
+    # with those put back, everything else in both tags is bit-identical
+    for bulk_node, per_field_node in zip(bulk_collision.bsp2d_nodes.STEPTREE, per_field_collision.bsp2d_nodes.STEPTREE):
+        bulk_node.plane_d = per_field_node.plane_d
+    for (_lightmap, bulk_material), (_per_field_lightmap, per_field_material) in zip(iter_materials(bulk), iter_materials(per_field)):
+        bulk_material.plane.d = per_field_material.plane.d
+    bulk_tag.serialize(backup=False, temp=False)
+    assert file_bytes(bulk_bsp_path) == file_bytes(per_field_bsp_path)
+    assert file_bytes(str(tmp_path / "bulk" / "level.scenario")) == file_bytes(str(tmp_path / "per_field" / "level.scenario"))
+
+def test_transform_level_turns_default_directions_and_keeps_zero_planes(tmp_path):
+    bsp_path, scenario_path = build_level(tmp_path)
+    bsp_tag = sbsp_def.build(filepath=bsp_path)
+    bsp = bsp_tag.data.tagdata
+    bsp.default_distant_light_0_direction[:] = [1.0, 0.0, 0.0]
+    bsp.default_distant_light_1_direction[:] = [0.0, 1.0, 0.0]
+    bsp.default_shadow_vector[:] = [0.0, 0.0, -2.0]
+    material = bsp.lightmaps.STEPTREE[0].materials.STEPTREE[0]
+    set_plane(material.plane, (0.0, 0.0, 0.0), 7.5)
+    bsp_tag.serialize(backup=False, temp=False)
+
+    # a quarter turn about z, doubled in size, then moved
+    transform_level(bsp_path, scenario_path, level_matrix(OFFSET, (0.0, 0.0, 90.0), 2.0))
+    bsp = sbsp_def.build(filepath=bsp_path).data.tagdata
+    np.testing.assert_allclose(bsp.default_distant_light_0_direction[0:3], [0.0, 1.0, 0.0], atol=1e-7)
+    np.testing.assert_allclose(bsp.default_distant_light_1_direction[0:3], [-1.0, 0.0, 0.0], atol=1e-7)
+    np.testing.assert_allclose(bsp.default_shadow_vector[0:3], [0.0, 0.0, -2.0], atol=1e-7)
+    assert tuple(bsp.lightmaps.STEPTREE[0].materials.STEPTREE[0].plane[0:4]) == (0.0, 0.0, 0.0, 7.5)
+
+def test_transform_level_keeps_lines_of_unreferenced_bsp2d_nodes(tmp_path, capsys):
+    bsp_path, scenario_path = build_level(tmp_path)
+    bsp_tag = sbsp_def.build(filepath=bsp_path)
+    collision_bsp = bsp_tag.data.tagdata.collision_bsp.STEPTREE[0]
+    collision_bsp.bsp2d_nodes.STEPTREE.extend(1)
+    orphan = collision_bsp.bsp2d_nodes.STEPTREE[-1]
+    orphan.plane_i, orphan.plane_j, orphan.plane_d = 0.6, 0.8, 12.5
+    orphan[3], orphan[4] = flag(0), flag(1)
+    bsp_tag.serialize(backup=False, temp=False)
+    original_lines = np.array(rows(sbsp_def.build(filepath=bsp_path).data.tagdata.collision_bsp.STEPTREE[0].bsp2d_nodes.STEPTREE, 3))
+
+    transform_level(bsp_path, scenario_path, level_matrix(OFFSET, (0.0, 0.0, 90.0), 2.0))
+    assert "1 bsp2d nodes aren't under any bsp2d reference" in capsys.readouterr().err
+    lines = np.array(rows(sbsp_def.build(filepath=bsp_path).data.tagdata.collision_bsp.STEPTREE[0].bsp2d_nodes.STEPTREE, 3))
+    np.testing.assert_array_equal(lines[-1], original_lines[-1])
+    assert not np.allclose(lines[:-1], original_lines[:-1])
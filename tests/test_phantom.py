@@ -0,0 +1,162 @@
+from collision_bsp import CollisionBSP, SubtreeSurfaces, START_VERTEX, END_VERTEX, PLANE, BACK_CHILD, FRONT_CHILD, FLAG
+from phantom import PhantomDetector, edge_inside_polyhedron, edges_inside_polyhedron, halfspace_planes, halfspace_sides, paths_to_nodes, recheck, scan_parallel, COPLANAR_THRESHOLD, DEGENERATE_INTERVAL, ON_PLANE_THRESHOLD
+from synthetic_bsp import phantom_regions_bsp
+import numpy as np
+import pytest
+
+def flag(index):
+    return (index | FLAG) - (1 << 32)
+
+# A tree whose nodes bound the box 0 < x < width, -1 < y < 1, -1 < z < 1, one
+# plane per node with the box on the front side (the other side goes to an
+# empty leaf). Under them, a node on the z = 0 plane has a -1 back child and
+# a leaf front child holding one quad surface: a phantom BSP candidate. Of
+# the quad's edges only the first, from edge_start to edge_end, can pass
+# through the box; the rest are far outside it.
+def phantom_candidate_bsp(width, edge_start, edge_end):
+    box_planes = [(1, 0, 0, 0), (-1, 0, 0, -width), (0, 1, 0, -1), (0, -1, 0, -1), (0, 0, 1, -1), (0, 0, -1, -1)]
+    planes = box_planes + [(0, 0, 1, 0)]
+    candidate_node = len(box_planes)
+    # empty leaves for the box nodes' back children, then the surface's leaf
+    surface_leaf = candidate_node
+    bsp3d_nodes = [(i, flag(i), i + 1) for i in range(len(box_planes))]
+    bsp3d_nodes.append((candidate_node, -1, flag(surface_leaf)))
+    leaves = [(0, 0, 0)] * len(box_planes) + [(0, 1, 0)]
+
+    x_start, y_start = edge_start
+    x_end, y_end = edge_end
+    vertices = [(x_start, y_start, 0), (x_end, y_end, 0), (x_end, 10, 0), (x_start, 10, 0)]
+    # quad edges, each on surface 0 with no neighbour
+    edges = [(i, (i + 1) % 4, (i + 1) % 4, -1, 0, -1) for i in range(4)]
+    return CollisionBSP({
+        "bsp3d_nodes": bsp3d_nodes,
+        "planes": planes,
+        "leaves": leaves,
+        "bsp2d_references": [(candidate_node, flag(0))],
+        "bsp2d_node_planes": np.empty((0, 3)),
+        "bsp2d_node_children": np.empty((0, 2)),
+        "surfaces": [(candidate_node, 0, 0, -1, 0)],
+        "edges": edges,
+        "vertices": vertices,
+        "vertex_first_edges": [0, 1, 2, 3],
+    })
+
+# Clips edges one at a time with the scalar reference kernel
+class ScalarPhantomDetector(PhantomDetector):
+    def edges_inside_halfspaces(self, edge_indices, halfspaces):
+        normals, dists = halfspace_planes(self.collision_bsp, halfspaces)
+        planes = list(zip(normals, dists))
+        edges = self.collision_bsp.edges
+        verts = self.collision_bsp.vertices
+        inside = np.array([
+            edge_inside_polyhedron(verts[edges[e, START_VERTEX]], verts[edges[e, END_VERTEX]], planes)
+            for e in edge_indices
+        ], dtype=bool)
+        no_interval = np.full(len(edge_indices), np.nan)
+        return inside, no_interval, no_interval
+
+def detection_keys(detections):
+    return [(d.plane, d.surface, d.edge, d.leaf, d.path, d.node, d.sides) for d in detections]
+
+# An edge in the z = 0 plane from x = -100 to x = 3000 which passes y = -1
+# just outside the box (by offset) where it crosses it. It slopes away from
+# the y = -1 plane slowly enough to cross it before the edge starts, so the
+# plane is never crossed and isn't coplanar, leaving only the on-plane
+# threshold to decide if the crossing is inside.
+def on_plane_edge(offset):
+    slope = 4e-8
+    return (-100, -1 - offset + 100 * slope), (3000, -1 - offset - 3000 * slope)
+
+CASES = {
+    "crossing": (2, (-1, 0), (3, 0), True),
+    "degenerate interval": (DEGENERATE_INTERVAL * 0.98, (-1, 0), (3, 0), False),
+    "just long enough interval": (DEGENERATE_INTERVAL * 1.02, (-1, 0), (3, 0), True),
+    "coplanar with a box plane": (2, (-1, -1 + COPLANAR_THRESHOLD * 0.5), (3, -1 + COPLANAR_THRESHOLD * 0.5), False),
+    "just off a box plane": (2, (-1, -1 + COPLANAR_THRESHOLD * 2), (3, -1 + COPLANAR_THRESHOLD * 2), True),
+    "on a box plane": (2, *on_plane_edge(ON_PLANE_THRESHOLD * 0.5), True),
+    "just outside a box plane": (2, *on_plane_edge(ON_PLANE_THRESHOLD * 2), False),
+    "missing the box": (2, (-1, 2), (3, 2), False),
+}
+
+@pytest.mark.parametrize("width, edge_start, edge_end, is_phantom", CASES.values(), ids=CASES.keys())
+def test_batched_scan_matches_scalar(width, edge_start, edge_end, is_phantom):
+    collision_bsp = phantom_candidate_bsp(width, edge_start, edge_end)
+    batched = PhantomDetector(collision_bsp).scan()
+    scalar = ScalarPhantomDetector(collision_bsp).scan()
+    assert detection_keys(batched) == detection_keys(scalar)
+    assert len(batched) == (1 if is_phantom else 0)
+    if is_phantom:
+        detection = batched[0]
+        assert (detection.plane, detection.surface, detection.edge, detection.node) == (6, 0, 0, 6)
+        assert detection.path == [0, 1, 2, 3, 4, 5]
+        assert 0.0 <= detection.t_entry < detection.t_exit <= 1.0
+
+def test_batched_kernel_matches_scalar_on_random_edges():
+    rng = np.random.default_rng(0)
+    normals = rng.normal(size=(6, 3))
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    dists = rng.uniform(-1, 0, 6)
+    # endpoints near the planes at a range of scales around the thresholds
+    starts = rng.normal(size=(2000, 3)) * rng.choice([1e-6, 1e-5, 1e-4, 1e-2, 1], size=(2000, 1))
+    ends = starts + rng.normal(size=(2000, 3)) * rng.choice([1e-3, 0.05, 1, 5], size=(2000, 1))
+    inside, _t_entry, _t_exit = edges_inside_polyhedron(starts, ends, normals, dists)
+    planes = list(zip(normals, dists))
+    expected = [edge_inside_polyhedron(start, end, planes) for start, end in zip(starts, ends)]
+    np.testing.assert_array_equal(inside, expected)
+    assert inside.any() and not inside.all()
+
+def test_paths_to_nodes_match_the_scan():
+    collision_bsp, candidates = phantom_regions_bsp(["phantom", "phantom", "phantom", "fixed"])
+    detections = PhantomDetector(collision_bsp).scan()
+    paths = paths_to_nodes(collision_bsp, candidates[0:3])
+    assert [node for node, _halfspaces in paths] == [d.node for d in detections]
+    for (_node, halfspaces), detection in zip(paths, detections):
+        assert [node for _plane, _is_front, node in halfspaces] == detection.path
+        assert halfspace_sides(halfspaces) == detection.sides
+
+# Fixes one phantom, breaks the fix of another region, and re-splits a third
+# region's box under a node appended to the array, then checks recheck gives
+# what a full scan of the edited tree does
+def test_recheck_matches_a_full_scan_after_edits():
+    collision_bsp, candidates = phantom_regions_bsp(["phantom", "fixed", "phantom", "phantom", "fixed"])
+    detector = PhantomDetector(collision_bsp, SubtreeSurfaces(collision_bsp))
+    previous = detector.scan()
+    assert sorted(d.node for d in previous) == [candidates[0], candidates[2], candidates[3]]
+
+    nodes = collision_bsp.bsp3d_nodes
+    nodes[candidates[0], BACK_CHILD] = nodes[candidates[0], FRONT_CHILD]
+    nodes[candidates[1], BACK_CHILD] = -1
+    # region 3's first box node is reached through a new node on the same
+    # plane, whose back child is the old node's empty leaf
+    region_node = candidates[3] - 6
+    parent, side = [int(i[0]) for i in np.nonzero(nodes[:, [BACK_CHILD, FRONT_CHILD]] == region_node)]
+    appended = len(nodes)
+    collision_bsp.bsp3d_nodes = np.vstack([nodes, [nodes[region_node, PLANE], nodes[region_node, BACK_CHILD], region_node]])
+    collision_bsp.bsp3d_nodes[parent, [BACK_CHILD, FRONT_CHILD][side]] = appended
+    modified = [candidates[0], candidates[1], parent, appended]
+
+    rechecked = recheck(detector, modified, previous)
+    full = PhantomDetector(collision_bsp, SubtreeSurfaces(collision_bsp)).scan()
+    assert detection_keys(rechecked) == detection_keys(full)
+    assert sorted(d.node for d in full) == sorted([candidates[1], candidates[2], candidates[3]])
+    assert [d.sides for d in rechecked] == sorted(d.sides for d in rechecked)
+    assert appended in next(d for d in full if d.node == candidates[3]).path
+
+def detections_in_parallel(collision_bsp, jobs, split_depth):
+    detector = PhantomDetector(collision_bsp, SubtreeSurfaces(collision_bsp))
+    return list(scan_parallel(detector, jobs, split_depth)), detector.stats
+
+# The regions' candidates are 8 or 9 nodes deep, so a split depth of 9 leaves
+# some detections to the top of the tree to merge between the subtrees', and
+# 30 is deeper than the tree
+@pytest.mark.parametrize("split_depth", [1, 2, 4, 9, 30])
+def test_parallel_scan_matches_serial_scan(split_depth):
+    collision_bsp, _candidates = phantom_regions_bsp(["phantom", "fixed", "phantom", "phantom", "phantom", "fixed", "phantom"])
+    serial_detector = PhantomDetector(collision_bsp, SubtreeSurfaces(collision_bsp))
+    serial = serial_detector.scan()
+    assert len(serial) == 5
+    parallel, parallel_stats = detections_in_parallel(collision_bsp, 2, split_depth)
+    assert detection_keys(parallel) == detection_keys(serial)
+    assert [(d.t_entry, d.t_exit) for d in parallel] == [(d.t_entry, d.t_exit) for d in serial]
+    assert parallel_stats.nodes_visited == serial_detector.stats.nodes_visited
+    assert parallel_stats.candidates_checked == serial_detector.stats.candidates_checked
@@ -0,0 +1,98 @@
+from reclaimer.hek.defs.sbsp import sbsp_def
+from vert_buffers import rendered_vert_dtype, lm_vert_dtype
+from port_lm import load_src_verts, find_pages, merge_overlapping
+from PIL import Image
+import numpy as np
+
+# Adds a lightmap with one material of vert_count random verts. Unlit
+# lightmaps (bitmap_index -1, like add-blended lights) have no lm verts.
+def add_lightmap(bsp, rng, bitmap_index, shader, vert_count):
+    bsp.lightmaps.STEPTREE.extend(1)
+    lightmap = bsp.lightmaps.STEPTREE[-1]
+    lightmap.bitmap_index = bitmap_index
+    lightmap.materials.STEPTREE.extend(1)
+    material = lightmap.materials.STEPTREE[-1]
+    material.shader.filepath = shader
+    rendered = np.zeros(vert_count, rendered_vert_dtype)
+    rendered["position"] = rng.uniform(0, 100, (vert_count, 3))
+    rendered["normal"] = [0, 0, 1]
+    rendered["tex_uv"] = rng.uniform(0, 1, (vert_count, 2))
+    lm_vert_count = 0 if bitmap_index == -1 else vert_count
+    lm = np.zeros(lm_vert_count, lm_vert_dtype)
+    lm["incident"] = rng.uniform(-1, 1, (lm_vert_count, 3))
+    lm["lm_uv"] = rng.uniform(0, 1, (lm_vert_count, 2))
+    material.vertices_count = vert_count
+    material.lightmap_vertices_count = lm_vert_count
+    material.uncompressed_vertices.STEPTREE = bytearray(rendered.tobytes() + lm.tobytes())
+    material.uncompressed_vertices.size = len(material.uncompressed_vertices.STEPTREE)
+    return rendered, lm
+
+def test_load_src_verts_skips_unlit_materials(tmp_path):
+    rng = np.random.default_rng(0)
+    bsp_tag = sbsp_def.build()
+    bsp = bsp_tag.data.tagdata
+    first_rendered, first_lm = add_lightmap(bsp, rng, 0, "shaders\\floor", 20)
+    add_lightmap(bsp, rng, -1, "shaders\\light", 7)
+    second_rendered, second_lm = add_lightmap(bsp, rng, 1, "shaders\\wall", 12)
+    bsp_path = str(tmp_path / "level.scenario_structure_bsp")
+    bsp_tag.serialize(filepath=bsp_path, backup=False, temp=False)
+
+    src_index = load_src_verts(bsp_path, use_cache=False)
+    assert len(src_index) == 32
+    np.testing.assert_array_equal(src_index.positions, np.concatenate([first_rendered["position"], second_rendered["position"]]))
+    np.testing.assert_array_equal(src_index.lm_uvs, np.concatenate([first_lm["lm_uv"], second_lm["lm_uv"]]))
+    np.testing.assert_array_equal(src_index.bitmap_indices, [0] * 20 + [1] * 12)
+    assert set(src_index.shader_ids) == {"shaders\\floor", "shaders\\wall"}
+
+# The merge find_pages used to do, restarting after every merge
+def merge_overlapping_pairwise(boxes):
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+def test_merge_overlapping_matches_pairwise_merge():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        corners = rng.integers(0, 64, (int(rng.integers(1, 30)), 2))
+        sizes = rng.integers(1, 12, corners.shape)
+        boxes = [tuple(box) for box in np.concatenate([corners, corners + sizes], axis=1).tolist()]
+        assert sorted(merge_overlapping(boxes)) == sorted(merge_overlapping_pairwise(boxes))
+    # merging the first two grows the result into the third
+    boxes = [(0, 0, 10, 1), (2, 5, 3, 6), (4, 0, 5, 6)]
+    assert merge_overlapping(boxes) == [(0, 0, 10, 6)]
+
+def test_find_pages():
+    pixels = np.zeros((16, 16, 4), dtype=np.uint8)
+    pixels[..., 2] = 255
+    pixels[..., 3] = 255
+    def fill(min_x, min_y, max_x, max_y):
+        pixels[min_y:max_y, min_x:max_x] = (200, 100, 50, 255)
+    # a page whose gap-coloured pixels split off a piece inside the bounding
+    # box of the rest
+    fill(1, 1, 6, 2)
+    fill(1, 1, 2, 5)
+    fill(3, 3, 6, 5)
+    # two pages touching only at a corner
+    fill(8, 1, 11, 4)
+    fill(11, 4, 14, 7)
+    # a page below them
+    fill(1, 9, 7, 15)
+    pages = find_pages(Image.fromarray(pixels, "RGBA"))
+    assert pages == [
+        [(1, 1), (6, 5), 0],
+        [(8, 1), (11, 4), 1],
+        [(11, 4), (14, 7), 2],
+        [(1, 9), (7, 15), 3],
+    ]
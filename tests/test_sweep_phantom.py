@@ -0,0 +1,83 @@
+from synthetic_bsp import box_bsp, write_bsp_tag
+from scripts import load_script
+from bsp_query import CollisionQuery
+import numpy as np
+
+sweep_phantom = load_script("sweep-phantom.py")
+
+# The unit box's bottom face (face 4) is on a plane stored facing up, into
+# the box, so its surface is on the back of its plane
+REVERSED_BOTTOM = (4,)
+# Grid boxes with a single ray through (0.3, 0.6) along z, from z = 2 going
+# down or z = -1 going up, which crosses the top face at z = 1 and the bottom
+# at z = 0
+ONE_RAY_BOX = np.array([(-0.2, 0.1, -1.0), (0.8, 1.1, 2.0)])
+
+def test_crossings_finds_top_and_bottom_faces():
+    collision_bsp = box_bsp(reversed_faces=REVERSED_BOTTOM)
+    triangles, triangle_surfaces = sweep_phantom.surface_triangles(collision_bsp)
+    grid = sweep_phantom.RayGrid(ONE_RAY_BOX, 1.0, *sweep_phantom.DIRECTIONS["down"])
+    assert grid.count == 1
+    rays, ts, hit_triangles = grid.crossings(triangles)
+    order = np.argsort(ts)
+    np.testing.assert_array_equal(rays, [0, 0])
+    np.testing.assert_allclose(ts[order], [1.0 / 3.0, 2.0 / 3.0])
+    np.testing.assert_array_equal(triangle_surfaces[hit_triangles[order]], [5, 4])
+    np.testing.assert_allclose(grid.points(rays[order], ts[order]), [(0.3, 0.6, 1.0), (0.3, 0.6, 0.0)])
+
+def test_tree_transitions_enter_through_the_face_hit_first():
+    collision_bsp = box_bsp(reversed_faces=REVERSED_BOTTOM)
+    query = CollisionQuery(collision_bsp)
+    for direction_name, face in [("down", 5), ("up", 4)]:
+        grid = sweep_phantom.RayGrid(ONE_RAY_BOX, 1.0, *sweep_phantom.DIRECTIONS[direction_name])
+        rays, ts, planes, leaves = sweep_phantom.tree_transitions(query, grid, np.arange(grid.count))
+        np.testing.assert_array_equal(rays, [0])
+        np.testing.assert_allclose(ts, [1.0 / 3.0])
+        np.testing.assert_array_equal(planes, [face])
+        np.testing.assert_array_equal(leaves, [face])
+
+def test_near_along_ray_only_matches_the_same_ray():
+    found = sweep_phantom.near_along_ray(
+        np.array([0, 0, 1, 2]), np.array([0.5, 0.9, 0.5, 0.0]),
+        np.array([1, 0, 2]), np.array([0.2, 0.505, 0.999]),
+        0.01
+    )
+    np.testing.assert_array_equal(found, [True, False, False, False])
+    assert not sweep_phantom.near_along_ray(np.array([0]), np.array([0.5]), np.empty(0, dtype=np.int64), np.empty(0), 0.01).any()
+
+def test_group_findings_counts_and_bounds_by_key():
+    groups = {}
+    sweep_phantom.group_findings(groups, "phantom", [(1, 2), (3, 4)], np.array([(0.0, 1.0, 2.0), (5.0, 5.0, 5.0)]), "down")
+    sweep_phantom.group_findings(groups, "phantom", [(1, 2)], np.array([(-1.0, 3.0, 0.0)]), "+x")
+    sweep_phantom.group_findings(groups, "hole", [7], np.array([(1.0, 1.0, 1.0)]), "down")
+    assert sorted(groups) == [("hole", 7), ("phantom", (1, 2)), ("phantom", (3, 4))]
+    group = groups[("phantom", (1, 2))]
+    assert group["count"] == 2
+    assert group["min"] == [-1.0, 1.0, 0.0]
+    assert group["max"] == [0.0, 3.0, 2.0]
+    assert group["sample"] == [0.0, 1.0, 2.0]
+    assert group["directions"] == {"down", "+x"}
+    assert groups[("phantom", (3, 4))]["count"] == 1
+
+def test_sweep_finds_nothing_on_a_closed_box(tmp_path):
+    bsp_path = write_bsp_tag(box_bsp(reversed_faces=(0, 2, 4)), tmp_path / "box.scenario_structure_bsp")
+    box = np.array([(-1.0, -1.0, -1.0), (2.0, 2.0, 2.0)])
+    _collision_bsp, findings, stats = sweep_phantom.sweep(bsp_path, 0.3, box, list(sweep_phantom.DIRECTIONS), use_cache=False)
+    assert findings == []
+    assert stats["tree_transitions"] > 0
+
+# With the tree's top plane raised to z = 1.5 and its bottom plane (reversed)
+# raised to z = 0.5, rays going down turn solid 0.5 above the top surface, and
+# rays going up pass the bottom surface into space the tree has as open
+def test_sweep_finds_phantoms_and_holes(tmp_path):
+    collision_bsp = box_bsp(reversed_faces=REVERSED_BOTTOM)
+    collision_bsp.planes[5, 3] = 1.5
+    collision_bsp.planes[4, 3] = 0.5
+    bsp_path = write_bsp_tag(collision_bsp, tmp_path / "box.scenario_structure_bsp")
+    _collision_bsp, findings, _stats = sweep_phantom.sweep(bsp_path, 1.0, ONE_RAY_BOX, ["down", "up"], use_cache=False)
+    summary = sorted((f["kind"], f.get("plane"), f.get("leaf"), f.get("surface"), f["directions"]) for f in findings)
+    assert summary == [
+        ("hole", None, None, 4, ["up"]),
+        ("phantom", 4, 4, None, ["up"]),
+        ("phantom", 5, 5, None, ["down"]),
+    ]
@@ -0,0 +1,34 @@
+from collision_bsp import CollisionBSP
+from bsp_validation import validate_collision_bsp, CHECKS, DEFAULT_TOLERANCE
+from time import perf_counter
+import argparse
+import json
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check a BSP tag's collision BSP for broken links, open edge loops, off-plane vertices and malformed trees")
+    parser.add_argument("bsp", help="Path to the BSP file to check")
+    parser.add_argument("--checks", default=",".join(CHECKS), help="Comma separated checks to run from: " + ", ".join(CHECKS))
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Distance from their plane at which surface vertices are reported")
+    parser.add_argument("--allow-shared", action="store_true", help="Don't report subtrees and leaves with several parents")
+    parser.add_argument("--format", choices=["text", "ndjson"], default="text", help="Output format")
+    parser.add_argument("--no-cache", action="store_true", help="Parse the tag instead of using the tag cache")
+    args = parser.parse_args()
+
+    checks = args.checks.split(",")
+    for check in checks:
+        if check not in CHECKS:
+            parser.error(f"unknown check {check}")
+    start = perf_counter()
+    collision_bsp = CollisionBSP.load(args.bsp, use_cache=not args.no_cache)
+    issues = validate_collision_bsp(collision_bsp, checks, args.tolerance, args.allow_shared)
+    elapsed = perf_counter() - start
+    if args.format == "ndjson":
+        for issue in issues:
+            print(json.dumps({"type": "issue", **issue.to_record()}))
+        print(json.dumps({"type": "summary", "bsp": args.bsp, "issues": len(issues), "seconds": elapsed}))
+    else:
+        for issue in issues:
+            print(issue)
+        print("{}: {} issues found in {:.3f}s".format(args.bsp, len(issues), elapsed))
+    sys.exit(1 if len(issues) > 0 else 0)
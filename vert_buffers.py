@@ -0,0 +1,40 @@
+import numpy as np
+
+# A material's uncompressed_vertices buffer holds vertices_count rendered verts
+# followed by lightmap_vertices_count lightmap verts. The views returned here
+# alias the tag's bytearray, so writing to them updates the tag in place.
+
+# <3f 3f 3f 3f 2f>
+rendered_vert_dtype = np.dtype([
+    ("position", "<f4", 3),
+    ("normal", "<f4", 3),
+    ("bitangent", "<f4", 3),
+    ("tangent", "<f4", 3),
+    ("tex_uv", "<f4", 2),
+])
+rendered_vert_size = rendered_vert_dtype.itemsize
+
+# <3f 2f>
+lm_vert_dtype = np.dtype([
+    ("incident", "<f4", 3),
+    ("lm_uv", "<f4", 2),
+])
+lm_vert_size = lm_vert_dtype.itemsize
+
+def rendered_verts(material):
+    vert_buffer = material.uncompressed_vertices.STEPTREE
+    return np.frombuffer(vert_buffer, dtype=rendered_vert_dtype, count=material.vertices_count, offset=0)
+
+def lightmap_verts(material):
+    vert_buffer = material.uncompressed_vertices.STEPTREE
+    lm_vert_offset = material.vertices_count * rendered_vert_size
+    return np.frombuffer(vert_buffer, dtype=lm_vert_dtype, count=material.lightmap_vertices_count, offset=lm_vert_offset)
+
+# Yields (lightmap, material) pairs for every material in the BSP
+def iter_materials(bsp, skip_unlit=False):
+    for lightmap in bsp.lightmaps.STEPTREE:
+        # add-blended shaders like lights have no lightmaps
+        if skip_unlit and lightmap.bitmap_index == -1:
+            continue
+        for material in lightmap.materials.STEPTREE:
+            yield lightmap, material